@@ -4,8 +4,12 @@
 # June 2019
 #===============================================================================
 
-from .io import create_index, apply_alphabet, print_tree, write_tree
+from .io import create_index, index_chunks, apply_alphabet
+from .io import write_corpus, read_corpus, print_tree, write_tree
+from .diagnostics import Diagnostics
 from .generation import rand_tree, rand_data
-from .likelihood import bf
+from .likelihood import bf, ctw
 from .optimisation import mlhd
-from .sampling import mcmc
\ No newline at end of file
+from .sampling import mcmc, mcmc_parallel, resume
+from .suffix import SuffixIndex
+from .tree import CountIndex, NetworkWindow
\ No newline at end of file
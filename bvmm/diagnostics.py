@@ -0,0 +1,184 @@
+#===============================================================================
+# BVMM
+# Convergence Diagnostics
+#===============================================================================
+
+import numpy as np
+from . import tree
+
+class Diagnostics:
+    '''
+    Computes convergence diagnostics for an MCMC run as it progresses.
+
+    The tracked quantities are the size (node count) of the sampled tree, its
+    log posterior probability (relative to that of the initial tree), and the
+    inclusion indicators of the nodes that have been sampled most often. The
+    samples themselves are not stored: they are summarised by a bounded number
+    of batches, and whenever the limit is reached neighbouring batches are
+    merged (doubling the batch size). The effective sample size of each quantity
+    is estimated from the variance of its batch means, and its split R-hat
+    statistic by comparing the first and second halves of the run.
+
+    The nodes to track are chosen at the first check, and their indicators are
+    summarised from then on. After a run, the results are available as `ess`
+    and `rhat`, dictionaries keyed by 'size', 'lposterior', and the path (see
+    `tree.path_to`) of each tracked node.
+
+    Args:
+        nodes: the number of nodes whose inclusion indicators are tracked.
+        interval: the number of samples between consecutive checks.
+        min_ess: the effective sample size that every quantity must reach for
+            the run to count as converged.
+        max_rhat: the split R-hat value that no quantity may exceed for the run
+            to count as converged.
+        stop: whether the run should be stopped as soon as it has converged.
+        batches: the maximum number of batches to keep for each quantity.
+    '''
+    def __init__(self, nodes=10, interval=1000, min_ess=400, max_rhat=1.01,
+            stop=False, batches=64):
+        self.nodes = nodes
+        self.interval = interval
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.stop = stop
+        self.batches = batches + batches % 2
+        self.reset()
+
+    def reset(self):
+        '''
+        Discards the results of any previous run.
+        '''
+        self.samples = 0
+        self.converged = False
+        self.ess, self.rhat = {}, {}
+        self._scalars = _Batches(2, self.batches)
+        self._pending = [0, 0, 0, 0] # sums and sums of squares.
+        self._pending_size = 0
+        self._ids = None
+        self._paths = []
+        self._node_batches = None
+        self._node_counts = None
+        self._node_pending = 0
+
+    def record(self, root, lposterior):
+        '''
+        Records a single sample, which must have just been added to the tree's
+        sample counts (see `tree.add_sample`).
+
+        Returns:
+            True if the run should be stopped.
+        '''
+        self.samples += 1
+        n, p = root.node_count, self._pending
+        p[0] += n
+        p[1] += n*n
+        p[2] += lposterior
+        p[3] += lposterior*lposterior
+        self._pending_size += 1
+        if self._pending_size == self._scalars.size:
+            self._scalars.add(p[0:4:2], p[1:4:2])
+            self._pending, self._pending_size = [0, 0, 0, 0], 0
+        if self._ids is not None:
+            self._node_pending += 1
+            if self._node_pending == self._node_batches.size:
+                counts = tree._current_sample_counts(root.tree, self._ids)
+                sums = counts - self._node_counts
+                self._node_batches.add(sums, sums)
+                self._node_counts, self._node_pending = counts, 0
+        if self.samples % self.interval == 0:
+            if self._ids is None:
+                self._track(root)
+            self.update()
+            return self.stop and self.converged
+        return False
+
+    def update(self):
+        '''
+        Recomputes the diagnostics from the batches completed so far.
+        '''
+        ess, rhat = self._scalars.ess(), self._scalars.rhat()
+        self.ess = {'size': ess[0], 'lposterior': ess[1]}
+        self.rhat = {'size': rhat[0], 'lposterior': rhat[1]}
+        ready = self._scalars.count >= 4
+        if self._ids is not None and len(self._ids) > 0:
+            ess = self._node_batches.ess()
+            rhat = self._node_batches.rhat()
+            for i, path in enumerate(self._paths):
+                self.ess[path], self.rhat[path] = ess[i], rhat[i]
+            ready &= self._node_batches.count >= 4
+        self.converged = bool(
+            ready and min(self.ess.values()) >= self.min_ess and
+            max(self.rhat.values()) <= self.max_rhat)
+
+    def _track(self, root):
+        # Chooses the (non-root) nodes with the largest sample counts.
+        t = root.tree
+        counts = tree._current_sample_counts(t, np.arange(1, t.size))
+        order = np.argsort(-counts, kind='stable')[:self.nodes]
+        self._ids = 1 + order[counts[order] > 0]
+        self._paths = [tuple(tree.path_to(tree.Node(t, v)))
+                       for v in self._ids.tolist()]
+        self._node_batches = _Batches(len(self._ids), self.batches)
+        self._node_counts = counts[self._ids-1]
+
+class _Batches:
+    '''
+    Summarises a sequence of vectors by the sums and sums of squares of their
+    entries over consecutive batches of equal size.
+    '''
+    def __init__(self, width, limit):
+        self.sums = np.zeros((limit, width))
+        self.squares = np.zeros((limit, width))
+        self.count = 0 # the number of completed batches.
+        self.size = 1 # the number of samples in each batch.
+
+    def add(self, sums, squares):
+        '''
+        Adds a completed batch, merging neighbouring batches if necessary.
+        '''
+        self.sums[self.count] = sums
+        self.squares[self.count] = squares
+        self.count += 1
+        if self.count == len(self.sums):
+            half = self.count // 2
+            for a in (self.sums, self.squares):
+                a[:half] = a[0::2] + a[1::2]
+                a[half:] = 0
+            self.count, self.size = half, 2*self.size
+
+    def ess(self):
+        '''
+        Returns the batch-means estimate of each entry's effective sample size.
+        '''
+        k, b = self.count, self.size
+        n = k*b
+        if k < 2:
+            return np.zeros(self.sums.shape[1])
+        sums = self.sums[:k]
+        var = np.maximum(self.squares[:k].sum(0)/n - (sums.sum(0)/n)**2, 0)
+        batch_var = (sums/b).var(0, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ess = np.where(batch_var > 0, n*var/(b*batch_var), n)
+        return np.minimum(ess, n)
+
+    def rhat(self):
+        '''
+        Returns each entry's split R-hat statistic, comparing the first and last
+        halves of the batches (omitting the middle batch if there is an odd
+        number of them).
+        '''
+        h, b = self.count // 2, self.size
+        m = h*b
+        if h == 0 or m < 2:
+            return np.full(self.sums.shape[1], np.inf)
+        means, variances = [], []
+        for part in (slice(0, h), slice(self.count-h, self.count)):
+            s, q = self.sums[part].sum(0), self.squares[part].sum(0)
+            means.append(s/m)
+            variances.append(np.maximum(q - s*s/m, 0)/(m-1))
+        within = (variances[0] + variances[1])/2
+        between = m*(means[0] - means[1])**2/2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rhat = np.sqrt(((m-1)/m*within + between/m)/within)
+        return np.where(within > 0, rhat,
+                        np.where(between > 0, np.inf, 1.0))
@@ -0,0 +1,150 @@
+#===============================================================================
+# BVMM
+# Order-Statistic Index
+#===============================================================================
+
+import numpy as np
+
+class FenwickTree:
+    '''
+    Maintains a list of non-negative integer weights and their prefix sums.
+
+    A Fenwick (binary indexed) tree stores, at each position `i` (counting from
+    one), the sum of the weights in the range `(i - lowbit(i), i]`, where
+    `lowbit(i)` is the largest power of two that divides `i`. Updating a weight
+    or finding the element at which the cumulative weight first exceeds a given
+    value then takes time proportional to the logarithm of the number of
+    elements. The sums are held in a plain list, since the operations touch one
+    entry at a time.
+
+    Args:
+        weights: the initial weights.
+    '''
+    def __init__(self, weights):
+        # Each partial sum is a difference of two prefix sums.
+        n = len(weights)
+        prefix = np.zeros(n+1, np.int64)
+        np.cumsum(weights, out=prefix[1:])
+        i = np.arange(1, n+1)
+        self.sums = [0] + (prefix[i] - prefix[i - (i & -i)]).tolist()
+        self.step = 1 << (n.bit_length() - 1) if n > 0 else 0
+        self.total = int(prefix[-1])
+
+    def add(self, i, delta):
+        '''
+        Adds `delta` to the weight of element `i`.
+        '''
+        # (Numpy integers would make every step of the loop much slower.)
+        sums, n, delta = self.sums, len(self.sums) - 1, int(delta)
+        self.total += delta
+        i = int(i) + 1
+        while i <= n:
+            sums[i] += delta
+            i += i & -i
+
+    def select(self, k):
+        '''
+        Finds the first element at which the cumulative weight exceeds `k`.
+
+        Returns:
+            The element's index, and `k` less the weights of all preceding
+            elements.
+        '''
+        pos, step, sums, n = 0, self.step, self.sums, len(self.sums) - 1
+        while step > 0:
+            j = pos + step
+            if j <= n and sums[j] <= k:
+                pos = j
+                k -= sums[j]
+            step >>= 1
+        return pos, k
+
+class IndexedSet:
+    '''
+    A set of integers that supports selection of its k-th smallest member.
+
+    Membership is recorded as an array of flags, which is divided into blocks
+    whose sizes are maintained by a Fenwick tree. Selection finds the right
+    block in logarithmic time and then scans that block alone, and a batch of
+    insertions or removals costs one Fenwick update per block that it touches.
+
+    Args:
+        size: the number of integers (starting from zero) that may be members.
+    '''
+    shift = 6 # members are grouped into blocks of 2**shift.
+    small = 16 # batches up to this size are added one member at a time.
+
+    def __init__(self, size):
+        self.flags = np.zeros(size, np.bool_)
+        self._build()
+
+    def _build(self):
+        blocks = -(-len(self.flags) >> self.shift)
+        padded = np.zeros(blocks << self.shift, np.bool_)
+        padded[:len(self.flags)] = self.flags
+        sizes = padded.reshape(blocks, -1).sum(1)
+        self.blocks = FenwickTree(sizes)
+
+    @property
+    def total(self):
+        return self.blocks.total
+
+    def resize(self, size):
+        '''
+        Changes the range of possible members (keeping those that are in range).
+        '''
+        flags = np.zeros(size, np.bool_)
+        m = min(size, len(self.flags))
+        flags[:m] = self.flags[:m]
+        self.flags = flags
+        self._build()
+
+    def add(self, i):
+        '''
+        Adds `i` to the set (it must not already be a member).
+        '''
+        self.flags[i] = True
+        self.blocks.add(i >> self.shift, 1)
+
+    def remove(self, i):
+        '''
+        Removes `i` from the set (it must be a member).
+        '''
+        self.flags[i] = False
+        self.blocks.add(i >> self.shift, -1)
+
+    def update(self, indices, member):
+        '''
+        Adds a set of distinct non-members to the set, or removes a set of
+        distinct members from it.
+        '''
+        if len(indices) == 0:
+            return
+        self.flags[indices] = member
+        sign = 1 if member else -1
+        if len(indices) <= self.small:
+            # A few indices are grouped into runs that share a block (as the
+            # children of a node usually do) without building arrays.
+            block, count = -1, 0
+            for i in np.asarray(indices).tolist():
+                if i >> self.shift != block:
+                    if count > 0:
+                        self.blocks.add(block, sign*count)
+                    block, count = i >> self.shift, 0
+                count += 1
+            if count > 0:
+                self.blocks.add(block, sign*count)
+            return
+        blocks, counts = np.unique(np.asarray(indices) >> self.shift,
+                                   return_counts=True)
+        for b, c in zip(blocks.tolist(), counts.tolist()):
+            self.blocks.add(b, sign*c)
+
+    def select(self, k):
+        '''
+        Returns the k-th smallest member of the set (counting from zero).
+        '''
+        b, k = self.blocks.select(k)
+        start = b << self.shift
+        block = self.flags[start:start + (1 << self.shift)]
+        return start + int(block.nonzero()[0][k])
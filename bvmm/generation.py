@@ -3,6 +3,7 @@
 # Tree and Data Generation Functions
 #===============================================================================
 
+import bisect
 import numpy as np
 from . import tree
 from . import likelihood
@@ -21,10 +22,11 @@ def rand_tree(n, alphabet, alpha=None):
     '''
     alpha = likelihood._verify_alpha(alpha, alphabet)
     opts = tree.Options(False, height_step=1)
-    root = tree.create_tree(0, [], alphabet)
+    root = tree.create_tree(0, [], alphabet, dense=True)
     _rand_counts(root, alpha)
     for i in range(n):
-        v = tree.attachment(root, np.random.randint(0, root.attachment_count))
+        a = np.random.randint(0, root.attachment_count)
+        v = tree.nth_attachment(root, a)
         tree.activate(v, [], alphabet, opts)
         _rand_counts(v, alpha)
     return root
@@ -33,33 +35,153 @@ def _rand_counts(v, alpha):
     '''
     Assigns counts to a subtree, and marks nodes as attachments where necessary.
     '''
-    if v.counts is None:
-        tree.update_counts(v, attachments=1)
-    v.counts = np.random.dirichlet(alpha)
-    for w in v.children:
-        _rand_counts(w, alpha)
+    stack = [v]
+    while stack:
+        v = stack.pop()
+        if v.counts is None:
+            tree.add_attachment(v)
+        v.counts = np.random.dirichlet(alpha)
+        stack.extend(reversed(v.children))
 
-def rand_data(root, n):
+def rand_data(root, n, sequences=None):
     '''
-    Returns an array of data generated (recursively) from a given tree.
+    Returns an array of data generated from a given tree.
+
+    The tree is first compiled into a finite-state machine whose states are the
+    contexts (suffixes of the data generated so far) that determine the next
+    symbol, so that each symbol can be generated with a table lookup rather
+    than a traversal of the tree. Several sequences can also be generated
+    at once, in which case they are advanced in lockstep, using vectorised
+    operations.
 
     Args:
         root: the root of the tree used for data generation.
         n: the desired length of the data array.
+        sequences: the number of independent sequences to generate, or None to
+            generate a single one.
+
+    Returns:
+        An int32 array of length `n`, or a list of `sequences` such arrays.
     '''
-    indices = list(range(len(root.counts)))
-    data = []
-    for i in range(n):
-        v = _node_from(root, data)
-        data.append(np.random.choice(indices, p=v.counts/v.counts.sum()))
+    machine = _compile(root)
+    if sequences is None:
+        return _rand_sequence(machine, n)
+    return list(_rand_sequences(machine, n, sequences))
+
+def _compile(root):
+    '''
+    Compiles the active nodes of a tree into a finite-state machine.
+
+    Each state is a context: the symbols most recently generated, newest first.
+    The active nodes are not enough on their own, because the node reached by
+    appending a symbol to a context may depend on symbols older than those in
+    the context. Each context is therefore supplemented by its suffixes (which
+    take the distribution of the deepest active node along their paths), after
+    which the next state is always determined by the current one.
+
+    Returns:
+        A tuple containing the transition table (indexed by state and symbol),
+        the row of the cumulative distribution table used by each state, and
+        the cumulative distribution table itself.
+    '''
+    t, k = root.tree, len(root.tree.alphabet)
+    states = {(): 0}
+    nodes = [root.id] # the node that generates the symbols of each state.
+    stack = [(root.id, ())]
+    while stack:
+        v, context = stack.pop()
+        for w in tree._children(t, v):
+            if t.is_active[w]:
+                c = context + (int(t.index[w]),)
+                states[c] = len(nodes)
+                nodes.append(w)
+                stack.append((w, c))
+    contexts = list(states)
+    for c in contexts: # the list grows as suffixes are added.
+        if c and c[1:] not in states:
+            states[c[1:]] = len(nodes)
+            nodes.append(_node_from(root, c[:0:-1]).id)
+            contexts.append(c[1:])
+
+    # Each state inherits the transitions of its parent (the state with its
+    # oldest symbol removed), except for those that lead to longer contexts.
+    longer = {}
+    for c in contexts:
+        if c:
+            longer.setdefault(c[1:], []).append(c)
+    trans = np.zeros((len(contexts), k), np.int32)
+    for c in sorted(contexts, key=len):
+        s = states[c]
+        if c:
+            trans[s] = trans[states[c[:-1]]]
+        for d in longer.get(c, ()):
+            trans[s, d[0]] = states[d]
+    rows, row = np.unique(nodes, return_inverse=True)
+    counts = np.array([tree.Node(t, v).counts for v in rows.tolist()], float)
+    cdf = np.cumsum(counts, 1)
+    cdf /= cdf[:, -1:]
+    return trans, row.astype(np.int32), cdf
+
+def _rand_sequence(machine, n):
+    '''
+    Generates a single sequence from a compiled tree, one symbol at a time.
+    '''
+    trans, row, cdf = machine
+    rows = [None] * len(cdf) # converted to lists as they are first needed.
+    nexts = [None] * len(trans)
+    row = row.tolist()
+    data = np.empty(n, np.int32)
+    s = 0
+    for start in range(0, n, _block_size):
+        block = np.random.random(min(_block_size, n - start)).tolist()
+        for i, u in enumerate(block, start):
+            r = row[s]
+            c = rows[r]
+            if c is None:
+                c = rows[r] = cdf[r].tolist()
+            x = bisect.bisect_right(c, u)
+            data[i] = x
+            d = nexts[s]
+            if d is None:
+                d = nexts[s] = trans[s].tolist()
+            s = d[x]
+    return data
+
+def _rand_sequences(machine, n, m):
+    '''
+    Generates `m` independent sequences from a compiled tree in lockstep.
+    '''
+    trans, row, cdf = machine
+    k = cdf.shape[1]
+    # The rows are offset so that they can be searched as a single array. The
+    # last symbol with a non-zero probability guards against rounding errors.
+    flat = (cdf + np.arange(len(cdf))[:,None]).ravel()
+    probs = np.diff(cdf, 1, prepend=0)
+    last = k - 1 - np.argmax(probs[:,::-1] > 0, 1)
+    data = np.empty((m, n), np.int32)
+    states = np.zeros(m, np.int32)
+    step = max(1, _block_size // m)
+    for start in range(0, n, step):
+        block = np.random.random((min(step, n - start), m))
+        for i, u in enumerate(block, start):
+            r = row[states]
+            x = np.searchsorted(flat, r + u, 'right') - r*k
+            x = np.minimum(x, last[r])
+            data[:,i] = x
+            states = trans[states, x]
     return data
 
+_block_size = 1 << 16 # the number of random values to draw at a time.
+
 def _node_from(v, prefix):
     '''
     Returns the node reached by traversing the given list of indices in reverse.
     '''
     i = 1
-    while len(prefix) >= i and v.children[prefix[-i]].is_active:
-        v = v.children[prefix[-i]]
+    while len(prefix) >= i:
+        w = v.child(prefix[-i])
+        if w is None or not w.is_active:
+            break
+        v = w
         i += 1
     return v
\ No newline at end of file
@@ -3,55 +3,138 @@
 # Input and Output Functions
 #===============================================================================
 
-def create_index(data, kind='sequence'):
+import collections
+import itertools
+import numpy as np
+from . import tree
+
+def create_index(data, kind='sequence', alphabet=None):
     '''
     Converts a character-based data set to an integer-based one.
 
     Args:
-        data: if `kind` is 'sequence', a list containing consecutive symbol
-            strings, or a list of such lists. If `kind` is 'network', one or
-            more lists containing pairs of symbols.
+        data: if `kind` is 'sequence', a list (or array) containing consecutive
+            symbol strings, or a list of such lists. If `kind` is 'network',
+            one or more lists containing pairs of symbols.
         kind: either 'sequence' or 'network'.
+        alphabet: an existing alphabet (as returned by a previous call) to
+            extend. Symbols that it doesn't contain are appended to it in place.
 
     Returns:
-        The integer-based data set, along with a second list containing the
+        The integer-based data set, as an int32 array (with two columns for
+        network data) or a list of such arrays, along with a list containing the
         symbol corresponding to each integer (accessible via `alphabet[i]`).
+        Symbols are numbered in the order in which they first appear.
     '''
-    def index_sequence(array):
-        if isinstance(array, str):
-            raise TypeError
-        output = []
-        for x in array:
-            i = index.setdefault(x, len(index))
-            output.append(i)
-        return output
-
-    def index_network(array):
-        if array and isinstance(array[0], str):
-            raise TypeError
-        output = []
-        for x, y in array:
-            i = index.setdefault(x, len(index))
-            j = index.setdefault(y, len(index))
-            output.append((i, j))
-        return output
-    
-    index = {}
-    if kind.lower() == 'sequence':
-        index_func = index_sequence
-    elif kind.lower() == 'network':
-        index_func = index_network
-    else:
+    return next(index_chunks([data], kind, alphabet))
+
+def index_chunks(chunks, kind='sequence', alphabet=None):
+    '''
+    Converts a character-based data set to an integer-based one chunk by chunk,
+    so that a data set that is too large to hold in memory (as symbol strings)
+    can be converted as it is read.
+
+    Args:
+        chunks: an iterable of data sets, each in a form accepted by
+            `create_index` (for example, the symbols of consecutive parts of a
+            large file).
+        kind: either 'sequence' or 'network'.
+        alphabet: an existing alphabet to extend, as in `create_index`.
+
+    Yields:
+        The integer-based version of each chunk, along with the alphabet, which
+        is a single list that is extended as new symbols are encountered.
+    '''
+    _check_kind(kind)
+    if alphabet is None:
+        alphabet = []
+    index = _symbol_index(alphabet)
+    for data in chunks:
+        if _nested_symbols(data, kind):
+            arrays = [_index_array(array, kind, index) for array in data]
+        else:
+            arrays = _index_array(data, kind, index)
+        if len(index) > len(alphabet):
+            alphabet.extend(list(index)[len(alphabet):])
+        yield arrays, alphabet
+
+def apply_alphabet(data, alphabet, kind='sequence'):
+    '''
+    Converts an integer-based data set to a character-based one.
+
+    Args:
+        data: one or more lists or arrays, containing consecutive indices if
+            `kind` is 'sequence', or pairs of indices if `kind` is 'network'.
+        alphabet: a list containing the symbols represented by the indices.
+        kind: the data type, either 'sequence' or 'network'.
+
+    Returns:
+        The symbols, as an object array (with two columns for network data) or a
+        list of such arrays.
+    '''
+    def apply_array(array):
+        return symbols[np.asarray(array, np.intp).reshape(shape)]
+
+    _check_kind(kind)
+    symbols = np.empty(len(alphabet), object)
+    symbols[:] = alphabet
+    shape = (-1, 2) if kind.lower() == 'network' else (-1,)
+    if tree._nested(data, kind.lower()):
+        return [apply_array(array) for array in data]
+    return apply_array(data)
+
+def _check_kind(kind):
+    # Raises an exception if the given data type is invalid.
+    if kind.lower() not in ('sequence', 'network'):
         raise ValueError("Invalid data type specified. Valid options are "
                          "'sequence' and 'network'.")
+
+def _symbol_index(alphabet):
+    # Returns a dictionary mapping symbols to indices, in which looking up a
+    # missing symbol assigns it the next index.
+    index = collections.defaultdict(None, zip(alphabet, range(len(alphabet))))
+    index.default_factory = index.__len__
+    return index
+
+def _nested_symbols(data, kind):
+    # Whether a character-based data set is a list of sequences rather than a
+    # single one.
     try:
-        return [index_func(array) for array in data], list(index.keys())
-    except TypeError:
-        return index_func(data), list(index.keys())
+        x = next(iter(data))
+        if kind.lower() == 'network':
+            x = x[0]
+        return not isinstance(x, str) and iter(x) is not None
+    except (TypeError, IndexError, StopIteration):
+        return False
 
-def apply_alphabet(data, alphabet, kind='sequence'):
+def _index_array(array, kind, index):
+    # Converts a single sequence of symbols (or of pairs of symbols) to an array
+    # of indices, adding any new symbols to the index. Arrays are factorised by
+    # numpy, and other sequences by a single pass of dictionary lookups.
+    shape = (-1, 2) if kind.lower() == 'network' else (-1,)
+    if isinstance(array, np.ndarray):
+        flat = array.reshape(-1)
+        unique, first, inverse = np.unique(flat, return_index=True,
+                                           return_inverse=True)
+        order = np.argsort(first, kind='stable')
+        lookup = np.empty(len(unique), np.int32)
+        lookup[order] = np.fromiter(map(index.__getitem__,
+                                        unique[order].tolist()),
+                                    np.int32, len(unique))
+        return lookup[inverse.reshape(-1)].reshape(shape)
+    if kind.lower() == 'network':
+        array = itertools.chain.from_iterable(array)
+    return np.fromiter(map(index.__getitem__, array), np.int32).reshape(shape)
+
+def write_corpus(filename, data, alphabet, kind='sequence'):
     '''
-    Converts an integer-based data set to a character-based one.
+    Writes an integer-based data set to a binary corpus file, which can be read
+    back (as memory-mapped arrays) by `read_corpus`.
+
+    The file consists of a fixed-size header, the alphabet (each symbol is
+    stored as a UTF-8 string), the offset at which each sequence starts, and
+    the data, as a single array of little-endian 32-bit integers (with two
+    columns for network data).
 
     Args:
         data: one or more lists, containing consecutive indices if `kind` is
@@ -59,22 +142,71 @@ def apply_alphabet(data, alphabet, kind='sequence'):
         alphabet: a list containing the symbols represented by the indices.
         kind: the data type, either 'sequence' or 'network'.
     '''
-    def apply_sequence(array):
-        return [alphabet[i] for i in array]
-    def apply_network(array):
-        return [(alphabet[i], alphabet[j]) for i, j in array]
-
-    if kind.lower() == 'sequence':
-        apply_func = apply_sequence
-    elif kind.lower() == 'network':
-        apply_func = apply_network
+    _check_kind(kind)
+    kind = kind.lower()
+    arrays = tree._arrays(data, kind)
+    symbols = [str(x).encode('utf-8') for x in alphabet]
+    offsets = np.cumsum([0] + [len(a) for a in arrays], dtype='<i8')
+    header = np.zeros(1, _corpus_header)
+    header['magic'] = _corpus_magic
+    header['version'] = 1
+    header['kind'] = _corpus_kinds.index(kind)
+    header['nested'] = tree._nested(data, kind)
+    header['symbols'] = len(symbols)
+    header['sequences'] = len(arrays)
+    header['entries'] = offsets[-1]
+    header['alphabet_bytes'] = sum(len(x) for x in symbols)
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.array([len(x) for x in symbols], '<u4').tobytes())
+        f.write(b''.join(symbols))
+        f.write(b'\0' * (-f.tell() % 8))
+        f.write(offsets.tobytes())
+        for a in arrays:
+            f.write(a.astype('<i4').tobytes())
+
+def read_corpus(filename):
+    '''
+    Reads a binary corpus file written by `write_corpus`.
+
+    The data are memory-mapped rather than read, so loading a corpus takes very
+    little time, and processes that read the same corpus share its memory. The
+    arrays can be given to `create_tree`, `mcmc` and so on directly.
+
+    Returns:
+        The data set, as a read-only array (or a list of arrays, one per
+        sequence, if a list of sequences was written), its alphabet, and its
+        type ('sequence' or 'network').
+    '''
+    with open(filename, 'rb') as f:
+        header = np.frombuffer(f.read(_corpus_header.itemsize), _corpus_header)
+        if len(header) == 0 or header['magic'][0] != _corpus_magic:
+            raise ValueError('{} is not a corpus file.'.format(filename))
+        header = header[0]
+        lengths = np.frombuffer(f.read(4*int(header['symbols'])), '<u4')
+        blob = f.read(int(header['alphabet_bytes']))
+        ends = np.cumsum(lengths).tolist()
+        alphabet = [blob[e-n:e].decode('utf-8')
+                    for e, n in zip(ends, lengths.tolist())]
+        f.seek(-f.tell() % 8, 1)
+        m = int(header['sequences'])
+        offsets = np.frombuffer(f.read(8*(m+1)), '<i8').tolist()
+        start = f.tell()
+    kind = _corpus_kinds[header['kind']]
+    shape = (int(header['entries']),) + ((2,) if kind == 'network' else ())
+    if shape[0] > 0:
+        array = np.memmap(filename, '<i4', 'r', start, shape)
     else:
-        raise ValueError("Invalid data type specified. Valid options are "
-                         "'sequence' and 'network'.")
-    try:
-        return [apply_func(array) for array in data]
-    except TypeError:
-        return apply_func(data)
+        array = np.zeros(shape, '<i4')
+    arrays = [array[offsets[i]:offsets[i+1]] for i in range(m)]
+    return arrays if header['nested'] else array, alphabet, kind
+
+_corpus_magic = b'BVMM'
+_corpus_kinds = ['sequence', 'network']
+_corpus_header = np.dtype([('magic', 'S4'), ('version', '<u4'),
+                           ('kind', '<u4'), ('nested', '<u4'),
+                           ('symbols', '<u8'), ('sequences', '<u8'),
+                           ('entries', '<u8'), ('alphabet_bytes', '<u8')])
 
 def print_tree(v, alphabet, full=False, min_samples=1e-16, max_counts=None,
         verbose=False, prefix=''):
@@ -97,34 +229,41 @@ def print_tree(v, alphabet, full=False, min_samples=1e-16, max_counts=None,
             node will be limited.
         verbose: if true, nodes with no associated symbol counts will also be
             printed, along with debugging information for each node.
-        prefix: a prefix string to attach to all of the printed nodes (used
-            internally for recursive calls).
+        prefix: a prefix string to attach to all of the printed nodes.
     '''
-    valid = _valid(v, full, min_samples) 
-    if not valid or v.counts is None and not verbose:
-        return
-
-    prefix += str(v.symbol)
-    smpl = _num_str(v.sample_count, 3, 5)
+    # An explicit stack (rather than recursion) keeps deep trees within
+    # Python's recursion limit; children are pushed in reverse so that they are
+    # printed in order.
     if max_counts is None:
         max_counts = len(alphabet)
-    if v.counts is None:
-        cnts = 'None'
-    else:
-        cnts = sorted(zip(alphabet, v.counts), key=lambda z: z[1], reverse=True)
-        cnts = cnts[:max_counts]
-        cnts = ', '.join(str(x) + ': ' + _num_str(c) for x, c in cnts if c > 0)
-
-    if verbose:
-        print('{:5} {} [{}]'.format(prefix + ':', smpl, cnts))
-        print(' '*12 + '({}active, {} nds, {} lvs, {} atts)'.format(
-            '' if v.is_active else 'in',
-            v.node_count, v.leaf_count, v.attachment_count
-        ))
-    else:
-        print('{:5} {} [{}]'.format(prefix + ':', smpl, cnts))
-    for w in v.children:
-        print_tree(w, alphabet, full, min_samples, max_counts, verbose, prefix)
+    stack = [(v, prefix)]
+    while stack:
+        v, prefix = stack.pop()
+        valid = _valid(v, full, min_samples)
+        if not valid or v.counts is None and not verbose:
+            continue
+
+        prefix += str(v.symbol)
+        smpl = _num_str(v.sample_count, 3, 5)
+        if v.counts is None:
+            cnts = 'None'
+        else:
+            xs, cnts = v.sparse_counts
+            cnts = sorted(zip([alphabet[x] for x in xs], cnts),
+                          key=lambda z: z[1], reverse=True)
+            cnts = cnts[:max_counts]
+            cnts = ', '.join(str(x) + ': ' + _num_str(c) for x, c in cnts
+                             if c > 0)
+
+        if verbose:
+            print('{:5} {} [{}]'.format(prefix + ':', smpl, cnts))
+            print(' '*12 + '({}active, {} nds, {} lvs, {} atts)'.format(
+                '' if v.is_active else 'in',
+                v.node_count, v.leaf_count, v.attachment_count
+            ))
+        else:
+            print('{:5} {} [{}]'.format(prefix + ':', smpl, cnts))
+        stack.extend((w, prefix) for w in reversed(v.children))
 
 def _num_str(x, decimal=2, padding=0):
     if x == int(x):
@@ -188,12 +327,20 @@ def _valid(v, full=False, min_samples=1e-16):
     return True
 
 def _visit_valid(f, v, full=False, min_samples=1e-16, args=None):
-    if not _valid(v, full, min_samples):
-        return
-    if args is not None:
-        args = f(v, args)
-    else:
-        f(v)
-    for w in v.children:
-        _visit_valid(f, w, full, min_samples, args)
-    return args
\ No newline at end of file
+    # Visits the valid nodes of a subtree in depth-first order, passing each
+    # node the value returned by its parent's visit (if `args` is given). The
+    # value returned by the visit of `v` itself is returned.
+    result = None
+    stack = [(v, args)]
+    while stack:
+        v, args = stack.pop()
+        if not _valid(v, full, min_samples):
+            continue
+        if args is not None:
+            args = f(v, args)
+        else:
+            f(v)
+        if result is None:
+            result = args
+        stack.extend((w, args) for w in reversed(v.children))
+    return result
@@ -3,6 +3,7 @@
 # Probability and Likelihood Functions
 #===============================================================================
 
+import collections
 import math
 import numpy as np
 from . import tree
@@ -15,7 +16,7 @@ def _verify_alpha(alpha, alphabet):
         raise ValueError('The alpha array must have the same length as the '
                          'alphabet array.')
     else:
-        return alpha
+        return np.asarray(alpha, float)
 
 def _prior_function(prior):
     if prior.lower() == 'uniform':
@@ -57,32 +58,57 @@ def lpoisson_ratio(k, l):
         k: the size of the current tree.
         l: the size of the proposed tree.
     '''
+    logs = _logs(max(k, l))
     if k > l:
-        return sum(math.log(x) for x in range(l+1, k+1))
+        return sum(logs[l+1:k+1])
     else:
-        return sum(-math.log(x) for x in range(k+1, l+1))
+        return -sum(logs[k+1:l+1])
 
-def lbirth_ratio(v, alpha):
+_log_table = [0.0] # log(x) for each x > 0, extended as needed.
+
+def _logs(n):
+    # Returns a table of logarithms up to log(n); the ratios of size priors are
+    # sums of consecutive entries. (Sums are taken term by term rather than as
+    # differences of log-factorials, whose rounding errors can turn a ratio of
+    # exactly zero into a tiny non-zero value.)
+    if n >= len(_log_table):
+        m = max(n+1, 2*len(_log_table))
+        _log_table.extend(math.log(x) for x in range(len(_log_table), m))
+    return _log_table
+
+def lbirth_ratio(v, alpha, table=None):
     '''
     Returns the log-likelihood ratio for a proposed birth move.
 
+    Only the symbols that follow the state of `v` are considered: the terms for
+    every other symbol cancel out, since the counts involved are the same
+    before and after the move.
+
     Args:
         v: the inactive attachment node that is to be activated (possibly).
         alpha: the 'concentration' vector that is used to parameterise the
             Dirichlet prior on the nodes' categorical distributions.
+        table: an optional `LogGammaTable` for the tree's counts.
     '''
-    ucounts = np.array(v.parent.counts) # holds effective counts before birth.
-    for w in v.parent.children:
-        if w.node_count > 0 and w != v: # the '!=' only applies when
-            ucounts -= w.counts         # calculating a death ratio.
-    l = np.sum(gammaln(ucounts-v.counts+alpha)) - np.sum(gammaln(ucounts+alpha))
-    l += np.sum(gammaln(v.counts+alpha)) - np.sum(gammaln(alpha))
-    usm, vsm, asm = np.sum(ucounts), np.sum(v.counts), np.sum(alpha)
-    l += -gammaln(usm-vsm+asm) + gammaln(usm+asm)
-    l += -gammaln(vsm+asm) + gammaln(asm)
+    t, u = v.tree, v.tree.parent[v.id]
+    xs, counts = tree._sparse_counts(t, v.id)
+    vsm = counts.sum()
+    # The effective counts before the birth are the parent's residual counts,
+    # which already exclude those of its active children (including `v` itself
+    # when calculating a death ratio).
+    ucounts = tree._counts_at(t, u, xs, residual=True)
+    usm = t.residual_total[u]
+    if t.is_active[v.id]:
+        ucounts += counts
+        usm += vsm
+    lg, lga, lgs = _lgamma(alpha, table, usm)
+    l = np.sum(lg(xs, ucounts-counts) - lg(xs, ucounts) + lg(xs, counts) -
+               lga(xs))
+    l += -lgs(usm-vsm) + lgs(usm)
+    l += -lgs(vsm) + lgs(0)
     return l
 
-def ldeath_ratio(v, alpha):
+def ldeath_ratio(v, alpha, table=None):
     '''
     Returns the log-likelihood ratio for a proposed death move.
 
@@ -90,33 +116,41 @@ def ldeath_ratio(v, alpha):
         v: the active leaf node that is to be deactivated (possibly).
         alpha: the 'concentration' vector that is used to parameterise the
             Dirichlet prior on the nodes' categorical distributions.
+        table: an optional `LogGammaTable` for the tree's counts.
     '''
-    return -lbirth_ratio(v, alpha)
+    return -lbirth_ratio(v, alpha, table)
 
-def full_lbirth_ratio(v, alpha):
+def full_lbirth_ratio(v, alpha, table=None):
     '''
     Returns the log-likelihood ratio for a proposed child-complete birth move.
 
+    As in `lbirth_ratio`, only the symbols that follow the state of `v` (and
+    those of its children) are considered.
+
     Args:
         v: the attachment node (which is viewed as a leaf when treating the tree
             as full) which is to be activated (possibly).
         alpha: the 'concentration' vector that is used to parameterise the
             Dirichlet prior on the nodes' categorical distributions.
+        table: an optional `LogGammaTable` for the tree's counts.
     '''
-    ccounts = np.zeros_like(v.counts) # holds the sum of the children's counts.
-    vsm, asm = np.sum(v.counts), np.sum(alpha)
-    abeta = np.sum(gammaln(alpha)) - gammaln(asm)
-    l = -np.sum(gammaln(v.counts+alpha)) + gammaln(vsm+asm)
-    for w in v.children:
-        if w.counts is not None:
-            ccounts += w.counts
-            l += np.sum(gammaln(w.counts+alpha)) - gammaln(np.sum(w.counts)+asm)
-            l -= abeta
-    csm = np.sum(ccounts)
-    l += np.sum(gammaln(v.counts-ccounts+alpha)) - gammaln(vsm-csm+asm)
+    t = v.tree
+    xs, counts = tree._sparse_counts(t, v.id)
+    vsm = counts.sum()
+    lg, lga, lgs = _lgamma(alpha, table, vsm)
+    # The entries of the children's counts are gathered together, and each is
+    # added to the count of `v` for the same symbol.
+    wentries, wowners, n = tree._child_entries(t, v.id)
+    wxs, wcounts = t.symbols[wentries], t.counts[wentries]
+    i = np.searchsorted(xs, wxs)
+    ccounts = np.bincount(i[wcounts > 0], wcounts[wcounts > 0], len(xs))
+    wsm = np.bincount(wowners, wcounts, n)
+    l = (lg(xs, counts-ccounts) - lg(xs, counts)).sum() + lgs(vsm)
+    l += (lg(wxs, wcounts) - lga(wxs)).sum() - lgs(wsm).sum()
+    l += n*lgs(0) - lgs(vsm-ccounts.sum())
     return l
 
-def full_ldeath_ratio(v, alpha):
+def full_ldeath_ratio(v, alpha, table=None):
     '''
     Returns the log-likelihood ratio for a proposed child-complete death move.
 
@@ -125,10 +159,154 @@ def full_ldeath_ratio(v, alpha):
             tree as full) which is to be deactivated (possibly).
         alpha: the 'concentration' vector that is used to parameterise the
             Dirichlet prior on the nodes' categorical distributions.
+        table: an optional `LogGammaTable` for the tree's counts.
+    '''
+    return -full_lbirth_ratio(v, alpha, table)
+
+def lbirth_ratios(t, vs, alpha, table=None):
+    '''
+    Returns the log-likelihood ratios of the birth moves of several nodes.
+
+    The result is the same as that of calling `lbirth_ratio` for each node (so
+    that the ratio given for an active node is that of reversing its death),
+    but the nodes' counts are stacked into a single array, and the terms of
+    the whole batch are evaluated together.
+
+    Args:
+        t: the tree containing the nodes.
+        vs: an array of node IDs, none of which may be the root.
+        alpha: the 'concentration' vector that is used to parameterise the
+            Dirichlet prior on the nodes' categorical distributions.
+        table: an optional `LogGammaTable` for the tree's counts.
+    '''
+    entries, owners = tree._count_entries(t, vs)
+    xs, counts = t.symbols[entries], t.counts[entries]
+    us = t.parent[vs]
+    ucounts = tree._entry_counts_at(t, us, owners, xs, residual=True)
+    vsm = np.bincount(owners, counts, len(vs))
+    usm = t.residual_total[us].astype(np.float64)
+    active = t.is_active[vs]
+    ucounts += np.where(active[owners], counts, 0)
+    usm += np.where(active, vsm, 0)
+    lg, lga, lgs = _lgamma(alpha, table, np.max(usm, initial=0))
+    terms = lg(xs, ucounts-counts) - lg(xs, ucounts)
+    terms += lg(xs, counts) - lga(xs)
+    l = np.bincount(owners, terms, len(vs))
+    l += -lgs(usm-vsm) + lgs(usm)
+    l += -lgs(vsm) + lgs(0)
+    return l
+
+def full_lbirth_ratios(t, vs, alpha, table=None):
+    '''
+    Returns the log-likelihood ratios of the child-complete birth moves of
+    several nodes, as `full_lbirth_ratio` would for each node (see
+    `lbirth_ratios`).
+
+    Args:
+        t: the tree containing the nodes.
+        vs: an array of node IDs.
+        alpha: the 'concentration' vector that is used to parameterise the
+            Dirichlet prior on the nodes' categorical distributions.
+        table: an optional `LogGammaTable` for the tree's counts.
+    '''
+    entries, owners = tree._count_entries(t, vs)
+    xs, counts = t.symbols[entries], t.counts[entries]
+    vsm = np.bincount(owners, counts, len(vs))
+    lg, lga, lgs = _lgamma(alpha, table, np.max(vsm, initial=0))
+    ws = tree._children_of(t, vs)
+    parents = np.repeat(np.arange(len(vs)), t.child_count[vs])
+    valid = t.count_start[ws] >= 0
+    ws, parents = ws[valid], parents[valid]
+    wentries, wowners = tree._count_entries(t, ws)
+    wxs, wcounts = t.symbols[wentries], t.counts[wentries]
+    # Each child's counts are added to those of its parent for the same symbol,
+    # which are found by searching the keys of the parents' (sorted) entries.
+    m = len(t.alphabet)
+    keys = owners*m + xs
+    i = np.searchsorted(keys, parents[wowners]*m + wxs)
+    ccounts = np.bincount(i[wcounts > 0], wcounts[wcounts > 0], len(xs))
+    wsm = np.bincount(wowners, wcounts, len(ws))
+    terms = lg(xs, counts-ccounts) - lg(xs, counts)
+    l = np.bincount(owners, terms, len(vs)) + lgs(vsm)
+    l += np.bincount(parents[wowners], lg(wxs, wcounts) - lga(wxs), len(vs))
+    l += np.bincount(parents, -lgs(wsm) + lgs(0), len(vs))
+    l -= lgs(vsm - np.bincount(owners, ccounts, len(vs)))
+    return l
+
+class LogGammaTable:
+    '''
+    Tabulates the log-gamma terms of the Dirichlet likelihood for integers.
+
+    When counts are integers and `alpha` is fixed, every term of a likelihood
+    ratio has the form gammaln(n + alpha[x]) or gammaln(n + sum(alpha)) for
+    some count n, and can be looked up rather than computed. One row is stored
+    for each distinct value of alpha (usually there is only one).
+
+    Args:
+        alpha: the 'concentration' vector that is used to parameterise the
+            Dirichlet prior on the nodes' categorical distributions.
+        size: the largest count that should be tabulated.
     '''
-    return -full_lbirth_ratio(v, alpha)
+    def __init__(self, alpha, size):
+        self.size = size
+        values, groups = np.unique(alpha, return_inverse=True)
+        n = np.arange(size+1)
+        self.values = gammaln(n + values[:, None])
+        self.groups = groups.ravel() if len(values) > 1 else None
+        self.bases = gammaln(alpha)
+        self.sums = gammaln(n + np.sum(alpha))
+
+    def terms(self, xs, counts):
+        '''
+        Returns gammaln(counts + alpha[xs]).
+        '''
+        n = counts.astype(np.int64)
+        if self.groups is None:
+            return self.values[0][n]
+        return self.values[self.groups[xs], n]
+
+    def base_terms(self, xs):
+        '''
+        Returns gammaln(alpha[xs]).
+        '''
+        return self.bases[xs]
+
+    def sum_term(self, n):
+        '''
+        Returns gammaln(n + sum(alpha)) (for each entry, if `n` is an array).
+        '''
+        if isinstance(n, np.ndarray):
+            return self.sums[n.astype(np.int64)]
+        return self.sums[int(n)]
+
+def _log_gamma_table(alpha, root, max_entries=2**24):
+    # Returns a table for the counts of a tree that was built from (integer)
+    # data, or None if any of its counts are not integers (as is the case for
+    # trees with random counts). No count can exceed the total count of the
+    # root, but the table is capped in size, and larger counts are left to
+    # `gammaln`.
+    t = root.tree
+    counts = t.counts[:t.pool_size]
+    if t.count_start[root.id] < 0 or np.any(counts != np.round(counts)):
+        return None
+    size = int(np.sum(tree._sparse_counts(t, root.id)[1]))
+    rows = len(np.unique(alpha)) + 1
+    return LogGammaTable(alpha, min(size, max_entries//rows - 1))
 
-def _llhd(root, data, alphabet, alpha, lprior_ratio, opts):
+def _lgamma(alpha, table, n):
+    # Returns functions that evaluate gammaln(c + alpha[x]), gammaln(alpha[x]),
+    # and gammaln(c + sum(alpha)), using the given table if it covers counts as
+    # large as `n`. (The ratio functions are public, so `alpha` may still be a
+    # list here, which can't be indexed by an array of symbols.)
+    if table is not None and n <= table.size:
+        return table.terms, table.base_terms, table.sum_term
+    alpha = np.asarray(alpha, float)
+    asm = np.sum(alpha)
+    return (lambda xs, c: gammaln(c + alpha[xs]),
+            lambda xs: gammaln(alpha[xs]),
+            lambda c: gammaln(c + asm))
+
+def _llhd(root, data, alphabet, alpha, lprior_ratio, opts, table=None):
     '''
     Returns the unnormalised log-likelihood of a given tree.
 
@@ -138,6 +316,7 @@ def _llhd(root, data, alphabet, alpha, lprior_ratio, opts):
     Args:
         lprior_ratio: the ratio function of the model's prior, either
             `luniform_ratio`, `linverse_ratio`, or `lpoisson_ratio`.
+        table: an optional `LogGammaTable` for the tree's counts.
     '''
     # This algorithm proceeds by deactivating leaves, recording the change in
     # likelihood after each step.
@@ -146,9 +325,10 @@ def _llhd(root, data, alphabet, alpha, lprior_ratio, opts):
         v = tree.leaf(root, 0)
         nc, ac, vc = root.node_count, root.attachment_count, v.attachment_count
         if opts.full:
-            l -= full_ldeath_ratio(v, alpha) + lprior_ratio(nc+ac, nc+ac-vc)
+            l -= (full_ldeath_ratio(v, alpha, table) +
+                  lprior_ratio(nc+ac, nc+ac-vc))
         else:
-            l -= ldeath_ratio(v, alpha) + lprior_ratio(nc, nc-1)
+            l -= ldeath_ratio(v, alpha, table) + lprior_ratio(nc, nc-1)
         tree.deactivate(v)
         vs.append(v)
     for v in reversed(vs):
@@ -156,12 +336,14 @@ def _llhd(root, data, alphabet, alpha, lprior_ratio, opts):
     return l
 
 def bf(data, alphabet, max_height=np.inf, alpha=None, prior='uniform', 
-        full=False, fringe=False, height_step=1, kind='sequence'):
+        full=False, fringe=False, height_step=1, kind='sequence', suffix=False,
+        release=False):
     '''
     Computes the probabilities of all possible Markov trees by brute force.
     
     Args:
-        data: a list of integer indices, or an iterable set of such lists.
+        data: a list of integer indices, an iterable set of such lists, or a
+            `CountIndex` over the data.
         alphabet: the set of characters that appear in the original data set.
         max_height: only those trees whose height is less than or equal to the
             given value will be considered.
@@ -179,6 +361,13 @@ def bf(data, alphabet, max_height=np.inf, alpha=None, prior='uniform',
             tree's limits are reached and it needs to be extended with new,
             inactive nodes.
         kind: the data type, either 'sequence' or 'network'.
+        suffix: if true, node occurrences will be located using a suffix index
+            over the data rather than lists of checkpoints (sequence data
+            only), which greatly reduces memory use for long sequences.
+        release: if true, each node's checkpoints will be discarded once its
+            children's counts have been initialised, which reduces memory use
+            for large trees. If a filename is given, they will instead be
+            appended to that file.
     
     Returns:
         The root of a tree in which each node's sample count reflects the
@@ -188,53 +377,431 @@ def bf(data, alphabet, max_height=np.inf, alpha=None, prior='uniform',
     alpha = _verify_alpha(alpha, alphabet)
     opts = tree.Options(full, fringe, height_step, kind=kind)
     lpr = _prior_function(prior)
-    root = tree.create_tree(height_step, data, alphabet, kind)
+    root = tree.create_tree(height_step, data, alphabet, kind, suffix,
+                            release)
     if not full:
         tree.activate(root, data, alphabet, opts)
-    lsm = 0
-    for s in _subtrees(root, 0, max_height, data, alphabet, opts):
-        lhd = math.exp(_llhd(root, data, alphabet, alpha, lpr, opts))
-        lsm += lhd
-        tree.update_sample_counts(root, lhd, opts=opts)
+    table = _log_gamma_table(alpha, root)
+    t, limit = root.tree, max_height - 1 if full else max_height
+    sizes = lambda: root.node_count + (root.attachment_count if full else 0)
+    # The sample counts are accumulated lazily: each sampled node records the
+    # total likelihood at which it was last added to the sampled set, and is
+    # only credited with the difference once it leaves it.
+    ids = tree._subtree(t, root.id)
+    since = dict.fromkeys(ids[tree._sampled(t, ids, opts)].tolist(), 0.0)
+    l, lsm = 0, 1.0 # (the initial tree is the reference, with a ratio of 1.)
+    ratios = {} # the ratios of full trees don't depend on the active tree.
+    if not full:
+        vs = _growable(t, root.id, limit, full)
+        moves = _forest_moves(t, vs, limit, full, True, {})
+    elif root.attachment_count > 0 and limit >= 0:
+        moves = _tree_moves(t, root.id, limit, full, True, {})
+    else:
+        moves = []
+    for v, birth in moves:
+        k = sizes()
+        w = tree.Node(t, v)
+        if full:
+            f = t.first_child[v]
+            vs = np.arange(f, f+t.child_count[v])
+            vs = np.concatenate(([v], vs) if t.parent[v] < 0 else
+                                ([v, t.parent[v]], vs))
+            if v not in ratios:
+                ratios[v] = full_lbirth_ratio(w, alpha, table)
+            ratio = ratios[v]
+        else:
+            vs = np.array([v] if t.parent[v] < 0 else [v, t.parent[v]])
+            ratio = lbirth_ratio(w, alpha, table)
+        before = tree._sampled(t, vs, opts)
+        if birth:
+            tree.activate(w, data, alphabet, opts)
+            l += ratio + lpr(k, sizes())
+        else:
+            tree.deactivate(w)
+            l -= ratio - lpr(k, sizes())
+        after = tree._sampled(t, vs, opts)
+        for u in vs[before & ~after].tolist():
+            t.sample_count[u] += lsm - since.pop(u)
+        for u in vs[~before & after].tolist():
+            since[u] = lsm
+        lsm += math.exp(l)
+    for u, s in since.items():
+        t.sample_count[u] += lsm - s
+    while root.node_count > 0:
+        tree.deactivate(tree.leaf(root, 0))
     _scale_sample_counts(root, 1/lsm)
+    tree._update_index(data, root)
     return root
 
-def _subtrees(v, i, h, data, alphabet, opts):
+def _growable(t, v, limit, full):
+    # Returns the children of an active node that can be activated, given the
+    # maximum depth of an active node. (In the full case, a child must also
+    # have valid children of its own, whether or not it is active.)
+    ws = [w for w in tree._children(t, v)
+          if t.count_start[w] >= 0 and t.depth[w] <= limit]
+    if full:
+        ws = [w for w in ws if t.first_child[w] >= 0 and np.any(
+            t.count_start[tree._children(t, w)] >= 0)]
+    return ws
+
+def _tree_moves(t, v, limit, full, forward, parities):
     '''
-    Generates all possible subtrees of a given tree.
+    Generates the moves that visit every subtree rooted at a given node in
+    turn, such that consecutive subtrees differ by a single node.
+
+    The subtrees are ordered as in the Koda-Ruskey algorithm: first the empty
+    subtree, and then `v` together with each subforest of its children (see
+    `_forest_moves`).
 
     Args:
-        v: the root of the tree whose subtrees should be generated. If this node
-            is already active, the empty subtree (in which it is not active)
-            will not be yielded.
-        i: the index of the first child to consider when generating subtrees. If
-            0, all possible subtrees will be generated; otherwise, all possible
-            combinations of subtrees from those children of `v` whose indices
-            are greater than or equal to `i` are generated. (In this way
-            subtrees can be generated recursively, regardless of the arity of
-            the tree.)
-        h: the maximum height of the generated subtrees.
+        v: the root of the subtrees, which must be inactive if `forward` is
+            true, or else active together with the last of its subtrees.
+        limit: the maximum depth of an active node.
+        full: whether the tree is a full tree.
+        forward: whether to visit the subtrees in order (starting from the
+            empty subtree) or in reverse (ending with it).
+        parities: a dictionary that caches the parity of the number of
+            subtrees rooted at each node.
 
     Yields:
-        Each time this function yields (returning nothing), the active tree
-        rooted at `v` will be one of its possible subtrees.
-    '''
-    if not v.is_active and i == 0:
-        yield
-        if v.attachment_count > 0 and h >= (1 if opts.full else 0):
-            tree.activate(v, data, alphabet, opts)
-    if v.is_active:
-        if i == len(alphabet) - 1:
-            for s in _subtrees(v.children[i], 0, h-1, data, alphabet, opts):
-                yield
-        else:
-            for s in _subtrees(v.children[i], 0, h-1, data, alphabet, opts):
-                for t in _subtrees(v, i+1, h, data, alphabet, opts):
-                    yield
-        if i == 0:
-            tree.deactivate(v)
+        Pairs containing a node and whether it should be activated (rather than
+        deactivated) to reach the next subtree. Each move must be made before
+        the next one is requested.
+    '''
+    if forward:
+        yield v, True
+    ws = _growable(t, v, limit, full)
+    yield from _forest_moves(t, ws, limit, full, forward, parities)
+    if not forward:
+        yield v, False
+
+def _forest_moves(t, vs, limit, full, forward, parities):
+    '''
+    Generates the moves that visit every combination of the subtrees rooted at
+    the given nodes, such that consecutive combinations differ by a single node.
+
+    The subtrees of the first node are visited in order, and for each of them
+    the combinations of the remaining nodes are visited in alternating
+    directions (a reflected Gray code). The arguments are the same as those of
+    `_tree_moves`.
+    '''
+    if not vs:
+        return
+    v, rest = vs[0], vs[1:]
+    # In reverse, the combinations of the remaining nodes start where they
+    # ended in the forward order, which is in the forward direction if the
+    # number of subtrees rooted at `v` is odd.
+    direction = forward or not _parity(t, v, limit, full, parities)
+    yield from _forest_moves(t, rest, limit, full, direction, parities)
+    for move in _tree_moves(t, v, limit, full, forward, parities):
+        yield move
+        direction = not direction
+        yield from _forest_moves(t, rest, limit, full, direction, parities)
+
+def _parity(t, v, limit, full, parities):
+    # Whether the number of subtrees rooted at a node (including the empty one)
+    # is odd. The node's descendants must already have been grown.
+    if v not in parities:
+        # The count is one more than the product of those of its children.
+        parities[v] = any(not _parity(t, w, limit, full, parities)
+                          for w in _growable(t, v, limit, full))
+    return parities[v]
+
+def ctw(data, alphabet, max_height=np.inf, alpha=None, prior='uniform',
+        full=False, fringe=False, height_step=1, kind='sequence', suffix=False,
+        release=False):
+    '''
+    Computes the same probabilities as `bf`, by summing over all possible
+    Markov trees recursively rather than enumerating them.
+
+    In the manner of context-tree weighting, each node sums the likelihoods of
+    all of the subtrees rooted at it, which are then combined by its parent.
+    When the size prior is not uniform, each sum is kept as a polynomial whose
+    coefficients are split by tree size. For full trees the likelihood
+    factorises over the nodes, and the time taken is polynomial in the size of
+    the tree (linear for the uniform prior). Otherwise the residual counts of
+    each node depend on which of its children are active, and so each node
+    sums over every subset of its children: the time taken remains linear in
+    the size of the tree, but exponential in the number of children per node.
+
+    Args:
+        The arguments are the same as those of `bf`.
+
+    Returns:
+        The root of a tree in which each node's sample count reflects the
+        probability that its associated state was present in the model that
+        generated the data, and the log-evidence of the model (the logarithm of
+        the probability of the data, averaged over all of the trees under the
+        prior).
+    '''
+    alpha = _verify_alpha(alpha, alphabet)
+    opts = tree.Options(full, fringe, height_step, kind=kind)
+    lpr = _prior_function(prior)
+    root = tree.create_tree(height_step, data, alphabet, kind, suffix,
+                            release)
+    if not full:
+        tree.activate(root, data, alphabet, opts)
+    table = _log_gamma_table(alpha, root)
+    vs = _activate_all(root, max_height, data, alphabet, opts)
+    w = _Weighting(root.tree, alpha, table, lpr, opts)
+    lz = w.inside(root.id, vs)
+    w.outside(root.id, vs)
+    for v in reversed(vs):
+        tree.deactivate(tree.Node(root.tree, v))
+    tree._update_index(data, root)
+    return root, lz
+
+def _activate_all(root, h, data, alphabet, opts):
+    # Activates every node that can be active in a tree of height `h` or less,
+    # returning the active nodes in breadth-first order.
+    t, vs = root.tree, []
+    limit = h - 1 if opts.full else h
+    queue = collections.deque([root.id])
+    while queue:
+        v = queue.popleft()
+        if not t.is_active[v]:
+            if t.attachment_count[v] == 0 or t.depth[v] > limit:
+                continue
+            tree.activate(tree.Node(t, v), data, alphabet, opts)
+        vs.append(v)
+        ws = tree._children(t, v)
+        queue.extend(w for w in ws if t.count_start[w] >= 0)
+    return vs
+
+class _Weighting:
+    '''
+    Computes the inside and outside sums of `ctw` over a tree in which every
+    node that can be active is active.
+
+    The sums are polynomials in the size of the tree, stored as arrays of log
+    coefficients (of length 1 if the prior is uniform, in which case sizes need
+    not be tracked).
+    '''
+    def __init__(self, t, alpha, table, lprior_ratio, opts):
+        self.t = t
+        self.alpha = alpha
+        self.table = table
+        self.lprior_ratio = lprior_ratio
+        self.full = opts.full
+        self.fringe = opts.fringe
+        self.sizes = lprior_ratio is not luniform_ratio
+        self.leaves = {} # the sums for inactive nodes (full trees only).
+        self.sums = {} # the sums for active nodes.
+        self.kids = {} # the valid children of each active node.
+
+    def inside(self, root, vs):
+        '''
+        Computes the sums of every node from the bottom up, returning the
+        log-evidence.
+        '''
+        t, norms = self.t, {} # the sums with unit likelihoods.
+        if self.full:
+            xs, counts = tree._sparse_counts(t, root)
+            self.leaves[root] = self._shift(_lpoly(self._lml(xs, counts)))
+            norms[root] = self._shift(_lpoly(0))
+        for v in reversed(vs):
+            xs, counts = tree._sparse_counts(t, v)
+            kids = [w for w in tree._children(t, v) if t.count_start[w] >= 0]
+            child_counts = []
+            for w in kids:
+                wxs, wcounts = tree._sparse_counts(t, w)
+                c = np.zeros(len(xs))
+                c[np.searchsorted(xs, wxs)] = wcounts
+                child_counts.append(c)
+            self.kids[v] = kids, child_counts
+            residual = self._residual(v, counts)
+            if self.full:
+                product, norm = _lpoly(self._lml(xs, residual)), _lpoly(0)
+                for w, c in zip(kids, child_counts):
+                    n = 1 if w in self.sums else t.attachment_count[w]
+                    self.leaves[w] = self._shift(_lpoly(self._lml(xs, c)), n)
+                    if w not in self.sums:
+                        norms[w] = self._shift(_lpoly(0), n)
+                    product = _lmul(product, self._total(w))
+                    norm = _lmul(norm, norms[w])
+                self.sums[v] = self._shift(product)
+                norms[v] = _ladd(self._shift(_lpoly(0)), self._shift(norm))
+            else:
+                self.sums[v] = self._shift(self._subsets(v, xs, residual))
+                norm = _lpoly(0)
+                for w in kids:
+                    if w in self.sums:
+                        norm = _lmul(norm, _ladd(_lpoly(0), norms[w]))
+                norms[v] = self._shift(norm)
+        total = self._total(root) if self.full else self.sums[root]
+        self.priors = np.zeros(1)
+        if self.sizes:
+            self.priors = np.array([-np.inf] + [self.lprior_ratio(1, k)
+                                                for k in range(1, len(total))])
+        self.lz = _ldot(total, self.priors)
+        return self.lz - _ldot(norms[root], self.priors)
+
+    def outside(self, root, vs):
+        '''
+        Computes the posterior probability of each node from the top down, and
+        stores it as the node's sample count.
+
+        Rather than the outside sum of each node, which is as long as the whole
+        tree, the sum is correlated with the prior as it is passed down, so that
+        its length need not exceed that of the node's own sum.
+        '''
+        duals = {root: self.priors}
+        probs = {root: 1.0}
+        if self.full and self.fringe:
+            probs[root] = self._prob(self.leaves[root], self.priors)
+        for v in vs:
+            q = duals[v]
+            kids, child_counts = self.kids[v]
+            xs, counts = tree._sparse_counts(self.t, v)
+            residual = self._residual(v, counts)
+            if self.full:
+                totals = [self._total(w) for w in kids]
+                base = _lpoly(self._lml(xs, residual))
+                for w, total, rest in zip(kids, totals,
+                                          _exclusive_products(totals)):
+                    e = self._shift(_lmul(base, rest))
+                    duals[w] = _lcorrelate(q, e, len(total))
+                    probs[w] = self._prob(
+                        self.leaves[w] if self.fringe else total, duals[w])
+            else:
+                for i, w in enumerate(kids):
+                    if w in self.sums:
+                        e = self._shift(self._subsets(v, xs, residual, i))
+                        duals[w] = _lcorrelate(q, e, len(self.sums[w]))
+                        probs[w] = self._prob(self.sums[w], duals[w])
+                if self.fringe and kids and all(w in self.sums for w in kids):
+                    # Nodes whose valid children are all active are excluded.
+                    every = _lpoly(self._lml(xs, residual))
+                    for w in kids:
+                        every = _lmul(every, self.sums[w])
+                    probs[v] = max(0.0, probs[v] -
+                                   self._prob(self._shift(every), q))
+        ids = np.fromiter(probs, np.int64, len(probs))
+        self.t.sample_count[ids] = np.fromiter(probs.values(), float, len(ids))
+
+    def _residual(self, v, counts):
+        # The counts of a node that aren't attributed to any of its children
+        # (in full trees) or to any of its active children (otherwise).
+        residual = counts.copy()
+        for w, c in zip(*self.kids[v]):
+            if self.full or w in self.sums:
+                residual -= c
+        return residual
+
+    def _subsets(self, v, xs, residual, forced=None):
+        # Sums the likelihood of node `v` over every subset of its active
+        # children (which contribute their own sums if they are included, and
+        # their counts to the residual counts of `v` otherwise). If `forced` is
+        # given, only the subsets that include that child are summed, and its
+        # own sum is omitted.
+        kids, child_counts = self.kids[v]
+        states = {residual.tobytes(): (residual, _lpoly(0))}
+        for i, (w, c) in enumerate(zip(kids, child_counts)):
+            if w not in self.sums:
+                continue
+            merged = {}
+            for n, s in states.values():
+                if i == forced:
+                    _accumulate(merged, n, s)
+                else:
+                    _accumulate(merged, n + c, s)
+                    _accumulate(merged, n, _lmul(s, self.sums[w]))
+            states = merged
+        total = _lpoly(-np.inf)
+        for n, s in states.values():
+            total = _ladd(total, s + self._lml(xs, n))
+        return total
+
+    def _total(self, w):
+        # The sum of all of the subtrees rooted at `w`, including the empty one
+        # (full trees only).
+        if w in self.sums:
+            return _ladd(self.leaves[w], self.sums[w])
+        return self.leaves[w]
+
+    def _shift(self, a, n=1):
+        # Multiplies a polynomial by the size variable (n times).
+        if not self.sizes or n == 0:
+            return a
+        return np.concatenate((np.full(n, -np.inf), a))
+
+    def _prob(self, a, dual):
+        # The posterior probability of the trees summed by `a`, given the dual
+        # of their outside sum.
+        return float(np.exp(min(_ldot(a, dual) - self.lz, 0)))
+
+    def _lml(self, xs, counts):
+        # The log marginal likelihood of a set of counts.
+        n = counts.sum()
+        lg, lga, lgs = _lgamma(self.alpha, self.table, n)
+        return lg(xs, counts).sum() - lga(xs).sum() - lgs(n) + lgs(0)
+
+def _lpoly(x):
+    # A polynomial with a single (log) coefficient.
+    return np.array([x], float)
+
+def _ladd(a, b):
+    # Adds two polynomials whose coefficients are given as logarithms.
+    if len(a) < len(b):
+        a, b = b, a
+    c = a.copy()
+    c[:len(b)] = np.logaddexp(c[:len(b)], b)
+    return c
+
+def _lmul(a, b):
+    # Multiplies two polynomials whose coefficients are given as logarithms.
+    if len(b) == 1:
+        return a + b[0]
+    if len(a) == 1:
+        return b + a[0]
+    rows = np.arange(len(a))[:, None]
+    terms = np.full((len(a), len(a)+len(b)-1), -np.inf)
+    terms[rows, rows + np.arange(len(b))] = a[:, None] + b
+    return _lsum(terms, 0)
+
+def _lcorrelate(q, e, n):
+    # Returns the first `n` entries of the correlation of `q` with `e`: entry j
+    # is the sum of e[i]q[i+j] over all i.
+    if n == 1 and len(e) == 1:
+        return q[:1] + e
+    idx = np.arange(n)[:, None] + np.arange(len(e))
+    valid = idx < len(q)
+    terms = np.where(valid, q[np.minimum(idx, len(q)-1)] + e, -np.inf)
+    return _lsum(terms, 1)
+
+def _ldot(a, b):
+    # The log of the dot product of two vectors given as logarithms.
+    n = min(len(a), len(b))
+    if n == 1:
+        return float(a[0] + b[0])
+    return float(_lsum(a[:n] + b[:n], 0))
+
+def _lsum(a, axis):
+    # Returns log(sum(exp(a))) along an axis.
+    m = np.max(a, axis, keepdims=True)
+    m[~np.isfinite(m)] = 0
+    with np.errstate(divide='ignore'):
+        return (np.log(np.sum(np.exp(a - m), axis, keepdims=True)) +
+                m).squeeze(axis)
+
+def _exclusive_products(polys):
+    # Returns, for each polynomial, the product of all of the others.
+    prefix = [_lpoly(0)]
+    for p in polys[:-1]:
+        prefix.append(_lmul(prefix[-1], p))
+    products, suffix = [None] * len(polys), _lpoly(0)
+    for i in range(len(polys)-1, -1, -1):
+        products[i] = _lmul(prefix[i], suffix)
+        suffix = _lmul(suffix, polys[i])
+    return products
+
+def _accumulate(states, n, s):
+    # Adds a term to the sums of a dictionary of residual counts.
+    key = n.tobytes()
+    if key in states:
+        states[key] = (n, _ladd(states[key][1], s))
+    else:
+        states[key] = (n, s)
 
 def _scale_sample_counts(root, scale):
-    root.sample_count *= scale
-    for w in root.children:
-        _scale_sample_counts(w, scale)
\ No newline at end of file
+    root.tree.sample_count[tree._subtree(root.tree, root.id)] *= scale
\ No newline at end of file
@@ -3,18 +3,41 @@
 # Maximum Likelihood Functions
 #===============================================================================
 
-import math
+import collections
+import heapq
+import itertools
+import multiprocessing
+import os
 import numpy as np
 from . import tree
 from . import likelihood
 
 def mlhd(data, alphabet, runs, alpha=None, prior='poisson', full=False,
-        height_step=1, kind='sequence'):
+        height_step=1, kind='sequence', suffix=False, release=False,
+        patience=None, processes=1):
     '''
     Estimates the maximum likelihood or a posteriori tree for a given data set.
 
+    Each run starts from a random tree, which is grown from the singleton tree
+    (consisting of nothing but a root) by a sweep of births: each time, the
+    attachments are tried in a new random order, and the first birth that
+    would improve the tree's posterior probability is made, until none would.
+    The run then climbs to a local maximum with a best-first search: the gains
+    of every possible birth and death move are kept in priority queues, and the
+    best move is made until no move improves the posterior. (A sweep alone
+    stops at the first tree that no birth improves, and a best-first search
+    alone makes the same choices on every run.)
+
+    The tree of counts is built once and shared by every run: its deeper levels
+    are only counted when a run first reaches them, and are kept for the runs
+    that follow. If several processes are used, the first run is made before
+    the pool of workers is started (so that the levels it has counted are
+    shared with all of them), and the remaining runs are made in rounds of one
+    run per process. Each worker keeps the levels counted by its own runs.
+
     Args:
-        data: a list of integer indices, or an iterable set of such lists.
+        data: a list of integer indices, an iterable set of such lists, or a
+            `CountIndex` over the data.
         alphabet: the set of characters that appear in the original data set.
         alpha: the 'concentration' vector that is used to parameterise the
             Dirichlet prior on the nodes' categorical distributions. Will be
@@ -30,41 +53,284 @@ def mlhd(data, alphabet, runs, alpha=None, prior='poisson', full=False,
             tree's limits are reached and it needs to be extended with new,
             inactive nodes.
         kind: the data type, either 'sequence' or 'network'.
+        suffix: if true, node occurrences will be located using a suffix index
+            over the data rather than lists of checkpoints (sequence data
+            only), which greatly reduces memory use for long sequences.
+        release: if true, each node's checkpoints will be discarded once its
+            children's counts have been initialised, which reduces memory use
+            for large trees. If a filename is given, they will instead be
+            appended to that file (by the main process only; the workers
+            discard them).
+        patience: if given, the search is stopped early once this many
+            consecutive runs have failed to improve on the best tree.
+        processes: the number of worker processes across which the runs are
+            spread. Defaults to one, in which case every run is made in the
+            calling process; None selects the number of CPUs.
 
     Returns:
-        The root of the estimated tree.
+        The root of the estimated tree, and its log posterior probability
+        (relative to that of the singleton tree).
     '''
     alpha = likelihood._verify_alpha(alpha, alphabet)
     opts = tree.Options(full, height_step=height_step, kind=kind)
-    lpr = likelihood._prior_function(prior)
-    ml, mroot = None, None
-    for r in range(runs):
-        l, root = _mlhd(data, alphabet, alpha, lpr, opts)
-        if ml is None or l > ml:
-            ml, mroot = l, root
-    return mroot
-
-def _mlhd(data, alphabet, alpha, lprior_ratio, opts):
-    # This function attempts to find a tree of maximum likelihood by activating
-    # nodes randomly until an increase in likelihood is no longer possible.
-    root = tree.create_tree(opts.height_step, data, alphabet, opts.kind)
-    if not opts.full:
+    root = tree.create_tree(height_step, data, alphabet, kind, suffix, release)
+    if not full:
         tree.activate(root, data, alphabet, opts)
-    l, increased = 1, True
-    while increased:
-        increased = False
-        for a in np.random.permutation(root.attachment_count):
-            v = tree.attachment(root, a)
-            nc, ac = root.node_count, root.attachment_count
-            if opts.full:
-                vc = sum(w.counts is not None for w in v.children)
-                lr = likelihood.full_lbirth_ratio(v, alpha) + \
-                     lprior_ratio(nc+ac, nc+ac+vc)
+    table = likelihood._log_gamma_table(alpha, root)
+    args = (root, data, alphabet, alpha, prior, opts, table)
+    lpr = likelihood._prior_function(prior)
+    ml, paths = _mlhd(root, data, alphabet, alpha, lpr, opts, table)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    pool = None
+    if processes > 1 and runs > 1:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        pool = context.Pool(processes, _init_worker, args)
+    try:
+        r, stale = 1, 0 # the runs made, and those since the last improvement.
+        while r < runs and (patience is None or stale < patience):
+            n = min(processes, runs-r)
+            if pool is None:
+                results = [_mlhd(root, data, alphabet, alpha, lpr, opts, table)]
             else:
-                lr = likelihood.lbirth_ratio(v, alpha) + lprior_ratio(nc, nc+1)
-            if lr > 0:
-                tree.activate(v, data, alphabet, opts)
-                increased = True
-                l += lr
-                break
-    return l, root
\ No newline at end of file
+                seeds = np.random.randint(2**31, size=n).tolist()
+                results = pool.map(_run_worker, seeds, chunksize=1)
+            for l, ps in results:
+                r, stale = r+1, stale+1
+                if l > ml:
+                    ml, paths, stale = l, ps, 0
+                elif patience is not None and stale >= patience:
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+    _restore(root, paths, data, alphabet, opts)
+    tree._update_index(data, root)
+    return root, ml
+
+def _mlhd(root, data, alphabet, alpha, lprior_ratio, opts, table=None):
+    # Grows a tree by a random sweep of births, and then climbs to a local
+    # maximum of the posterior. Returns the log posterior (relative to the
+    # singleton tree) along with the paths to the active nodes, after returning
+    # the tree to its initial state.
+    search = _Search(root, data, alphabet, alpha, lprior_ratio, opts, table)
+    search.sweep()
+    l = search.climb()
+    t = root.tree
+    ids = np.flatnonzero(t.is_active[:t.size])
+    paths = [tuple(tree.path_to(tree.Node(t, v))) for v in ids.tolist()]
+    while root.node_count > (0 if opts.full else 1):
+        tree.deactivate(tree.nth_leaf(root, 0))
+    return l, paths
+
+def _restore(root, paths, data, alphabet, opts):
+    # Activates the nodes at the end of the given paths, which must form a
+    # valid active subtree, parents first.
+    t = root.tree
+    for path in sorted(paths, key=len):
+        v = 0
+        for x in path:
+            v = tree._child(t, v, x)
+        if not t.is_active[v]:
+            tree.activate(tree.Node(t, v), data, alphabet, opts)
+
+_worker_args = None # the arguments shared by the runs of a worker process.
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+    t = args[0].tree
+    if t.release and t.release is not True:
+        t.release = True
+
+def _run_worker(seed):
+    # Makes a run with the given random seed, and returns its log posterior and
+    # the paths to its active nodes.
+    root, data, alphabet, alpha, prior, opts, table = _worker_args
+    np.random.seed(seed)
+    lpr = likelihood._prior_function(prior)
+    return _mlhd(root, data, alphabet, alpha, lpr, opts, table)
+
+class _Search:
+    '''
+    A best-first local search over the active subtrees of a tree.
+
+    The likelihood ratio of each possible move (the birth of an attachment or
+    the death of an active leaf) is kept in a priority queue. There is one
+    queue for each change in tree size that a move can cause, so that the
+    ratios of the size prior, which depend on the size of the whole tree, can
+    be added when the queues are compared.
+
+    A move's ratio depends only on the counts of the node and the residual
+    counts of its parent, so when a node changes state only the ratios of its
+    siblings and children change. Rather than recomputing these straight away,
+    the entries of the queues record the version of the parent's residual
+    counts for which they were computed, and are recomputed if they reach the
+    front of a queue after it has changed. (In the full case ratios never
+    change, but the change in size caused by a birth is not known until a node
+    has been activated; until then, it is assumed to be zero.)
+    '''
+    def __init__(self, root, data, alphabet, alpha, lprior_ratio, opts,
+            table=None):
+        self.root = root
+        self.t = root.tree
+        self.data = data
+        self.alphabet = alphabet
+        self.alpha = alpha
+        self.table = table
+        self.lprior_ratio = lprior_ratio
+        self.opts = opts
+        self.l = 0
+        self.queues = {} # keyed by the change in tree size.
+        self.versions = collections.Counter() # of each node's residuals.
+        self.deltas = {} # the change in size caused by each (full) birth.
+        self.order = itertools.count() # breaks ties in favour of age.
+        t = self.t
+        inactive = ~t.is_active[:t.size]
+        for v in np.flatnonzero(inactive & (t.attachment_count[:t.size] > 0)):
+            self._push(int(v), True)
+        for v in np.flatnonzero(~inactive & (t.node_count[:t.size] == 1)):
+            if self._valid(int(v), False):
+                self._push(int(v), False)
+
+    def size(self):
+        '''
+        Returns the size of the tree, as seen by the size prior.
+        '''
+        if self.opts.full:
+            return self.root.node_count + self.root.attachment_count
+        return self.root.node_count
+
+    def move(self, v, birth):
+        '''
+        Activates or deactivates a node, returning the change in log posterior.
+        '''
+        t, w, k = self.t, tree.Node(self.t, v), self.size()
+        lr = self._ratio(v)
+        if birth:
+            tree.activate(w, self.data, self.alphabet, self.opts)
+            lr += self.lprior_ratio(k, self.size())
+        else:
+            tree.deactivate(w)
+            lr = self.lprior_ratio(k, self.size()) - lr
+        self.l += lr
+        u = t.parent[v]
+        if u >= 0:
+            self.versions[u] += 1
+        if self.opts.full and birth:
+            self.deltas[v] = int(t.attachment_count[v])
+        # Queue the moves that have just become possible.
+        self._push(v, not birth)
+        if birth:
+            f = t.first_child[v]
+            for w in range(f, f + t.child_count[v]):
+                if t.attachment_count[w] > 0:
+                    self._push(w, True)
+        elif u >= 0 and self._valid(int(u), False):
+            self._push(int(u), False)
+        return lr
+
+    def sweep(self):
+        '''
+        Makes the first birth (in a random order of the attachments) that would
+        increase the posterior, until none would, and returns the log posterior.
+        '''
+        improved = True
+        while improved:
+            improved = False
+            n = self.root.attachment_count
+            for i in np.random.permutation(n).tolist():
+                v = tree.nth_attachment(self.root, i).id
+                delta = self.deltas.get(v, 0) if self.opts.full else 1
+                gain = self._ratio(v) + self.lprior_ratio(self.size(),
+                                                          self.size() + delta)
+                if gain > _tolerance:
+                    if self.move(v, True) > _tolerance:
+                        improved = True
+                        break
+                    self.move(v, False) # (the change in size was larger.)
+        return self.l
+
+    def climb(self):
+        '''
+        Makes the best available move until none would increase the posterior,
+        and returns the final log posterior.
+        '''
+        while True:
+            best, gain = None, 0
+            for delta, queue in self.queues.items():
+                entry = self._front(queue)
+                if entry is not None:
+                    g = -entry[0] + self.lprior_ratio(self.size(),
+                                                      self.size() + delta)
+                    if g > gain + _tolerance:
+                        best, gain = queue, g
+            if best is not None:
+                _, _, v, birth, _ = heapq.heappop(best)
+                if self.move(v, birth) <= _tolerance and birth:
+                    self.move(v, False) # (the change in size was larger.)
+            elif not self._refresh():
+                return self.l
+
+    def _ratio(self, v):
+        # The log-likelihood ratio of activating a node (whether it is active or
+        # not).
+        w = tree.Node(self.t, v)
+        if self.opts.full:
+            return likelihood.full_lbirth_ratio(w, self.alpha, self.table)
+        return likelihood.lbirth_ratio(w, self.alpha, self.table)
+
+    def _push(self, v, birth):
+        # Queues a move, keyed by its (negated) likelihood ratio.
+        t = self.t
+        if birth:
+            delta = self.deltas.get(v, 0) if self.opts.full else 1
+        else:
+            delta = -int(t.attachment_count[v]) if self.opts.full else -1
+        lr = self._ratio(v) * (1 if birth else -1)
+        entry = (-lr, next(self.order), v, birth, self._version(v))
+        heapq.heappush(self.queues.setdefault(delta, []), entry)
+
+    def _version(self, v):
+        u = self.t.parent[v]
+        return 0 if self.opts.full or u < 0 else self.versions[u]
+
+    def _valid(self, v, birth):
+        # Whether a queued move is still possible.
+        t = self.t
+        if birth:
+            return not t.is_active[v] and t.attachment_count[v] > 0
+        return (t.is_active[v] and t.node_count[v] == 1 and
+                (self.opts.full or t.parent[v] >= 0))
+
+    def _front(self, queue):
+        # Returns the first entry of a queue, after discarding the moves that
+        # are no longer possible and requeueing those that are out of date.
+        while queue:
+            _, _, v, birth, version = entry = queue[0]
+            if not self._valid(v, birth):
+                heapq.heappop(queue)
+            elif version != self._version(v):
+                heapq.heappop(queue)
+                self._push(v, birth)
+            else:
+                return entry
+        return None
+
+    def _refresh(self):
+        # Recomputes every out-of-date entry, returning true if there were any.
+        stale = []
+        for queue in self.queues.values():
+            for _, _, v, birth, version in queue:
+                if self._valid(v, birth) and version != self._version(v):
+                    stale.append((v, birth))
+            queue[:] = [e for e in queue if e[4] == self._version(e[2])]
+            heapq.heapify(queue)
+        for v, birth in stale:
+            self._push(v, birth)
+        return len(stale) > 0
+
+_tolerance = 1e-9 # the smallest gain that counts as an improvement.
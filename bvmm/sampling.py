@@ -4,6 +4,9 @@
 #===============================================================================
 
 import math
+import multiprocessing
+import os
+import pickle
 import numpy as np
 from . import tree
 from . import likelihood
@@ -14,6 +17,7 @@ class Counts:
     '''
     def __init__(self):
         self.moves = 0
+        self.samples = 0
         self.skips = 0
         self.births = 0
         self.birth_attempts = 0
@@ -28,14 +32,33 @@ class Counts:
                 'deaths: {}/{} ({:.0%})\n'
                 'skips:  {}').format(b, ba, bf, d, da, df, self.skips)
 
+    def add(self, other):
+        '''
+        Adds the move counts of another run to these ones.
+        '''
+        self.moves += other.moves
+        self.samples += other.samples
+        self.skips += other.skips
+        self.births += other.births
+        self.birth_attempts += other.birth_attempts
+        self.deaths += other.deaths
+        self.death_attempts += other.death_attempts
+
 def mcmc(data, alphabet, samples, period=1, min_skip_prob=0.1, alpha=None,
         prior='poisson', full=False, fringe=False, height_step=1,
-        kind='sequence'):
+        kind='sequence', suffix=False, release=False, diagnostics=None,
+        checkpoint=None, checkpoint_interval=1000, tries=1):
     '''
     Samples trees according to their likelihoods using Markov chain Monte Carlo.
 
     Args:
-        data: a list of integer indices, or an iterable set of such lists.
+        data: a list of integer indices, an iterable set of such lists, a
+            `CountIndex` over the data, a `NetworkWindow`, or the root of an
+            existing tree (one returned by an earlier run, say, that has since
+            been given new data with `tree.extend`). In the last two cases the
+            chain runs on that tree, continuing from its active nodes (a warm
+            start), and leaves its own final tree active for the next run
+            (see `NetworkWindow`).
         alphabet: the set of characters that appear in the original data set.
         samples: the number of MCMC samples to generate.
         period: the number of MCMC moves to perform between consecutive samples.
@@ -57,6 +80,30 @@ def mcmc(data, alphabet, samples, period=1, min_skip_prob=0.1, alpha=None,
             tree's limits are reached and it needs to be extended with new,
             inactive nodes.
         kind: the data type, either 'sequence' or 'network'.
+        suffix: if true, node occurrences will be located using a suffix index
+            over the data rather than lists of checkpoints (sequence data
+            only), which greatly reduces memory use for long sequences.
+        release: if true, each node's checkpoints will be discarded once its
+            children's counts have been initialised, which reduces memory use
+            for large trees. If a filename is given, they will instead be
+            appended to that file.
+        diagnostics: an optional `Diagnostics` object, which will be updated
+            with convergence diagnostics as the run progresses. If its `stop`
+            option is set, the run will end early (with fewer than `samples`
+            samples) once it has converged.
+        checkpoint: if given, the name of a file to which the state of the run
+            will be written periodically, so that it can be continued using
+            `resume` if it is interrupted. Each checkpoint replaces the last
+            one atomically.
+        checkpoint_interval: the number of samples between checkpoints.
+        tries: the number of moves proposed at each step. If greater than one,
+            each step is a multiple-try Metropolis move: the posterior ratios
+            of all of the proposed moves are computed as a batch, and one of
+            them is chosen according to its posterior probability (see
+            `_multiple_try`). Steps are accepted more often than single moves,
+            but cost several times as much unless activations are expensive
+            (as they are for full network trees), since rejected tries are
+            never activated.
 
     Returns:
         The root of a tree in which each node's sample count reflects the number
@@ -65,64 +112,495 @@ def mcmc(data, alphabet, samples, period=1, min_skip_prob=0.1, alpha=None,
         of the probability that its associated state was present in the model
         that generated the data.
     '''
-    counts = Counts()
     alpha = likelihood._verify_alpha(alpha, alphabet)
-    opts = tree.Options(full, fringe, height_step, min_skip_prob, kind)
+    opts = tree.Options(full, fringe, height_step, min_skip_prob, kind,
+                        tries)
     lpr = likelihood._prior_function(prior)
-    root = tree.create_tree(height_step, data, alphabet, kind)
-    if not full:
+    root = _existing_root(data, full)
+    warm = root is not None
+    if warm:
+        root.tree.sample_count[:root.tree.size] = 0
+    else:
+        root = tree.create_tree(height_step, data, alphabet, kind, suffix,
+                                release)
+    if not full and not root.is_active:
         tree.activate(root, data, alphabet, opts)
-    for s in range(samples*period):
-        nc, ac = root.node_count, root.attachment_count
-        birth_move, death_move = _move_probs(nc, ac, opts)
-        m = np.random.rand()
-        if m < birth_move:
+    table = likelihood._log_gamma_table(alpha, root)
+    settings = {'samples': samples, 'period': period,
+                'min_skip_prob': min_skip_prob, 'alpha': alpha,
+                'prior': prior, 'full': full, 'fringe': fringe,
+                'height_step': height_step, 'kind': kind,
+                'checkpoint_interval': checkpoint_interval, 'tries': tries}
+    counts = _chain(root, data, alphabet, samples, period, alpha, lpr, opts,
+                    table, diagnostics, checkpoint, settings, reset=not warm)
+    likelihood._scale_sample_counts(root, 1/counts.samples)
+    tree._update_index(data, root)
+    return root, counts
+
+def _existing_root(data, full):
+    # Returns the root of the tree that a chain should run on if it is given a
+    # `NetworkWindow` or the root of an existing tree in place of the data, or
+    # None if it is given the data itself.
+    if isinstance(data, tree.NetworkWindow):
+        if full != data.full:
+            raise ValueError("The window's full setting does not match.")
+        return data.root
+    elif isinstance(data, tree.Node):
+        if data.parent is not None:
+            raise ValueError('Only the root of a tree can be given in place '
+                             'of the data.')
+        return data
+    return None
+
+def resume(checkpoint, data, alphabet, diagnostics=None):
+    '''
+    Continues an MCMC run from the last checkpoint that it wrote (see `mcmc`).
+
+    The run continues exactly as it would have if it had not been interrupted,
+    provided that it is given the same data, and it keeps writing checkpoints
+    to the same file.
+
+    Args:
+        checkpoint: the name of the checkpoint file.
+        data: the data set that was given to `mcmc`. If it was given a
+            `NetworkWindow` or the root of an existing tree, the same window or
+            root should be given here, and its tree is restored to its state at
+            the checkpoint (the window's entries must not have changed since).
+        alphabet: the alphabet that was given to `mcmc`.
+        diagnostics: an optional `Diagnostics` object, which will receive the
+            state of the run's diagnostics (if it was tracking any).
+
+    Returns:
+        The same values as `mcmc`.
+    '''
+    with np.load(checkpoint) as f:
+        state = dict(f)
+    settings = {k[len('setting_'):]: v if v.ndim > 0 else v.item()
+                for k, v in state.items() if k.startswith('setting_')}
+    alpha, samples = settings['alpha'], settings['samples']
+    opts = tree.Options(settings['full'], settings['fringe'],
+                        settings['height_step'], settings['min_skip_prob'],
+                        settings['kind'], settings.get('tries', 1))
+    lpr = likelihood._prior_function(settings['prior'])
+    root = _existing_root(data, opts.full)
+    warm = root is not None
+    if warm:
+        t = root.tree
+        root.tree = tree._restore_tree(state, t.arrays, alphabet,
+                                       t.suffix).tree
+    else:
+        root = tree._restore_tree(state, data, alphabet)
+    root.tree.sampling = opts
+    table = likelihood._log_gamma_table(alpha, root)
+    counts = Counts()
+    for name in vars(counts):
+        setattr(counts, name, int(state['count_' + name]))
+    if len(state['diagnostics']) > 0:
+        saved = pickle.loads(state['diagnostics'].tobytes())
+        if diagnostics is None:
+            diagnostics = saved
+        else:
+            diagnostics.__dict__.update(saved.__dict__)
+    elif diagnostics is not None:
+        diagnostics.reset()
+    np.random.set_state(('MT19937', state['rng_keys'],
+                         int(state['rng_position']),
+                         int(state['rng_has_gauss']),
+                         float(state['rng_gauss'])))
+    position = (int(state['position']), counts, float(state['lposterior']))
+    counts = _chain(root, data, alphabet, samples, settings['period'], alpha,
+                    lpr, opts, table, diagnostics, checkpoint, settings,
+                    position, reset=not warm)
+    likelihood._scale_sample_counts(root, 1/counts.samples)
+    tree._update_index(data, root)
+    return root, counts
+
+def mcmc_parallel(data, alphabet, samples, chains=None, period=1,
+        min_skip_prob=0.1, alpha=None, prior='poisson', full=False,
+        fringe=False, height_step=1, kind='sequence', suffix=False,
+        release=False, processes=None, tries=1):
+    '''
+    Samples trees using several independent MCMC chains in parallel.
+
+    The tree of counts is built once, and a copy of it is given to each of a
+    pool of worker processes (where processes can be forked, the copies share
+    memory with the original until they are extended). Each chain draws its own
+    random seed from numpy's global generator, and the chains' sample counts and
+    move statistics are combined once they have finished.
+
+    Args:
+        samples: the total number of MCMC samples to generate, which are divided
+            as evenly as possible among the chains.
+        chains: the number of independent chains to run. Defaults to the number
+            of CPUs.
+        processes: the number of worker processes to use. Defaults to the
+            number of chains.
+
+        The remaining arguments are as for `mcmc`, except that if `release` is
+        a filename, the workers discard checkpoints rather than appending them
+        to the (shared) file, and that if the data is a `NetworkWindow` or the
+        root of an existing tree, every chain starts from its active nodes,
+        which are left as they are (rather than replaced by the final tree of
+        one of the chains).
+
+    Returns:
+        The root of a tree in which each node's sample count reflects the
+        fraction of samples (across all chains) for which it was active, and a
+        `Counts` object that combines the move statistics of the chains.
+    '''
+    counts = Counts()
+    alpha = likelihood._verify_alpha(alpha, alphabet)
+    opts = tree.Options(full, fringe, height_step, min_skip_prob, kind,
+                        tries)
+    root = _existing_root(data, full)
+    if root is not None:
+        root.tree.sample_count[:root.tree.size] = 0
+    else:
+        root = tree.create_tree(height_step, data, alphabet, kind, suffix,
+                                release)
+    if not full and not root.is_active:
+        tree.activate(root, data, alphabet, opts)
+    table = likelihood._log_gamma_table(alpha, root)
+    if chains is None:
+        chains = os.cpu_count() or 1
+    shares = [samples//chains + (1 if c < samples % chains else 0)
+              for c in range(chains)]
+    seeds = np.random.randint(2**31, size=chains).tolist()
+    base = root.tree.size
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    args = (root, data, alphabet, period, alpha, prior, opts, table)
+    # Each chain is run by a fresh worker, so that the results do not depend on
+    # the number of processes. Since later workers are copies of the tree as it
+    # stands when they start, it is only updated once every chain is done.
+    with context.Pool(processes or chains, _init_worker, args,
+                      maxtasksperchild=1) as pool:
+        results = pool.map(_run_worker, zip(shares, seeds), chunksize=1)
+    for record, chain_counts in results:
+        tree._merge_samples(root.tree, base, *record)
+        counts.add(chain_counts)
+    likelihood._scale_sample_counts(root, 1/counts.samples)
+    tree._update_index(data, root)
+    return root, counts
+
+def _chain(root, data, alphabet, samples, period, alpha, lprior_ratio, opts,
+        table=None, diagnostics=None, checkpoint=None, settings=None,
+        position=None, reset=True):
+    '''
+    Runs a single MCMC chain, adding the number of samples for which each node
+    was active to its sample count.
+
+    The tree is returned to its initial state (in which only the root is
+    active, unless the tree is full) once the run is over, unless `reset` is
+    false, in which case the chain's final tree is left active.
+
+    Args:
+        checkpoint: an optional checkpoint file, to which the state of the
+            chain is written every `settings['checkpoint_interval']` samples
+            (see `_save_checkpoint`).
+        position: if the chain is being resumed, a triple containing the number
+            of moves already made, the `Counts` object, and the log posterior
+            at that point. The tree should have been restored as well.
+
+    Returns:
+        A `Counts` object containing the chain's move statistics.
+    '''
+    if position is None:
+        start, counts = 0, Counts()
+        lposterior = 0 # relative to that of the initial tree.
+        if diagnostics is not None:
+            diagnostics.reset()
+        tree.start_samples(root, opts)
+    else:
+        start, counts, lposterior = position
+    for s in range(start, samples*period):
+        if opts.tries > 1:
+            move, change = _multiple_try(root, data, alphabet, alpha,
+                                         lprior_ratio, opts, table)
+        else:
+            move, change = _move(root, data, alphabet, alpha, lprior_ratio,
+                                 opts, table)
+        if move > 0:
             counts.birth_attempts += 1
-            if _birth(root, data, alphabet, alpha, lpr, opts):
+            if change is not None:
                 counts.births += 1
-        elif m < birth_move + death_move:
+        elif move < 0:
             counts.death_attempts += 1
-            if _death(root, alpha, lpr, opts):
+            if change is not None:
                 counts.deaths += 1
         else:
             counts.skips += 1
+        if change is not None:
+            lposterior += change
         if (s+1) % period == 0:
-            tree.update_sample_counts(root, 1, opts=opts)
-    likelihood._scale_sample_counts(root, 1/samples)
-    while root.node_count > (0 if opts.full else 1):
-        tree.deactivate(tree.leaf(root, 0))
-    return root, counts
+            tree.add_sample(root)
+            counts.samples += 1
+            if (diagnostics is not None and
+                    diagnostics.record(root, lposterior)):
+                break
+            if (checkpoint is not None and
+                    counts.samples % settings['checkpoint_interval'] == 0):
+                _save_checkpoint(checkpoint, root, settings, s+1, counts,
+                                 lposterior, diagnostics)
+    if diagnostics is not None:
+        diagnostics.update()
+    tree.stop_samples(root)
+    while reset and root.node_count > (0 if opts.full else 1):
+        tree.deactivate(tree.nth_leaf(root, 0))
+    return counts
 
-def _birth(root, data, alphabet, alpha, lprior_ratio, opts):
+def _save_checkpoint(filename, root, settings, position, counts, lposterior,
+        diagnostics=None):
     '''
-    Attempts a birth move, returning true if the move was accepted.
+    Writes the state of an MCMC run to a file, which is replaced atomically.
+
+    The state is stored as a set of flat arrays (in numpy's .npz format): the
+    fields of the tree's nodes, the run's settings, its position (the number of
+    moves made), move counts, log posterior, diagnostics, and the state of the
+    random number generator.
     '''
-    # When attempting a birth move, we actually activate the proposed node by
-    # default, and only deactivate it if the move is rejected. This isn't ideal,
-    # but it is necessary, since we require counts that might only be available
-    # after the node's children have been initialised (during activation).
-    v = tree.attachment(root, np.random.randint(root.attachment_count))
-    tree.activate(v, data, alphabet, opts)
-    ldeath_prob = _ldeath_prob(v, root, alpha, lprior_ratio, opts)
-    if ldeath_prob != 0 and math.log(np.random.rand()) > -ldeath_prob:
+    state = tree._tree_state(root.tree)
+    for name, value in settings.items():
+        state['setting_' + name] = np.asarray(value)
+    for name, value in vars(counts).items():
+        state['count_' + name] = np.array(value)
+    state['position'] = np.array(position)
+    state['lposterior'] = np.array(lposterior)
+    state['diagnostics'] = np.frombuffer(
+        pickle.dumps(diagnostics) if diagnostics is not None else b'', np.uint8)
+    _, keys, pos, has_gauss, gauss = np.random.get_state()
+    state['rng_keys'] = keys
+    state['rng_position'] = np.array(pos)
+    state['rng_has_gauss'] = np.array(has_gauss)
+    state['rng_gauss'] = np.array(gauss)
+    # The state is written to a temporary file that then replaces the old one,
+    # so that an interruption never leaves a partial checkpoint behind.
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as f:
+        np.savez(f, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, filename)
+
+_worker_args = None # the arguments shared by the chains of a worker process.
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+    t = args[0].tree
+    if t.release and t.release is not True:
+        t.release = True
+
+def _run_worker(task):
+    # Runs a chain with the given number of samples and random seed, and
+    # returns the resulting sample counts.
+    samples, seed = task
+    root, data, alphabet, period, alpha, prior, opts, table = _worker_args
+    np.random.seed(seed)
+    lpr = likelihood._prior_function(prior)
+    counts = _chain(root, data, alphabet, samples, period, alpha, lpr, opts,
+                    table)
+    return tree._sample_record(root.tree), counts
+
+def _move(root, data, alphabet, alpha, lprior_ratio, opts, table=None):
+    '''
+    Proposes a birth, death, or identity move, and accepts or rejects it.
+
+    Returns:
+        The kind of move that was proposed (1 for a birth, -1 for a death, and 0
+        for the identity move), and the resulting change in the log posterior
+        probability of the tree if the move was accepted, or None otherwise.
+    '''
+    nc, ac = root.node_count, root.attachment_count
+    birth_move, death_move = _move_probs(nc, ac, opts)
+    m = np.random.rand()
+    if m < birth_move:
+        return 1, _birth(root, data, alphabet, alpha, lprior_ratio, opts, table)
+    elif m < birth_move + death_move:
+        return -1, _death(root, alpha, lprior_ratio, opts, table)
+    return 0, None
+
+def _multiple_try(root, data, alphabet, alpha, lprior_ratio, opts,
+        table=None):
+    '''
+    Makes a multiple-try Metropolis move (Liu, Liang & Wong, 2000).
+
+    `opts.tries` moves are proposed independently, just as `_move` would
+    propose them, and their posterior ratios are evaluated as a batch. One of
+    them is chosen with probability proportional to its weight: the posterior
+    probability of the tree that it leads to, times the probability of
+    proposing the reverse move from that tree. Once it has been made, a
+    reference set of moves is proposed from the new tree (the reverse move
+    making up the last of them), and the chosen move is accepted with the
+    ratio of the total weights of the two sets, or reversed otherwise.
+
+    Returns:
+        The same values as `_move`, for the move that was chosen.
+    '''
+    k = opts.tries
+    moves, nodes, lpost, lrev, lfwd = _tries(root, data, alphabet, alpha,
+                                             lprior_ratio, opts, table, k)
+    lw = lpost + lrev
+    i = _choose(lw)
+    move, v = int(moves[i]), tree.Node(root.tree, int(nodes[i]))
+    if move == 0:
+        return 0, None # (the tree is the same whether it is accepted or not.)
+    if move > 0:
+        tree.activate(v, data, alphabet, opts)
+    else:
+        tree.deactivate(v)
+    _, _, rpost, rrev, _ = _tries(root, data, alphabet, alpha, lprior_ratio,
+                                  opts, table, k-1)
+    # The reference weights are relative to the posterior of the new tree, and
+    # so are scaled to match those of the tries.
+    lref = np.append(rpost + rrev, lfwd[i] - lpost[i])
+    if math.log(np.random.rand()) <= _lsum(lw) - lpost[i] - _lsum(lref):
+        return move, float(lpost[i])
+    if move > 0:
         tree.deactivate(v)
-        return False
-    return True
+    else:
+        tree.activate(v, data, alphabet, opts)
+    return move, None
+
+def _tries(root, data, alphabet, alpha, lprior_ratio, opts, table, k):
+    '''
+    Proposes `k` independent moves from the current tree without making them.
+
+    The birth and death ratios of the proposed nodes are computed together
+    (see `likelihood.lbirth_ratios`), along with the numbers of leaves and
+    attachments of the trees that the moves lead to, which determine the
+    probabilities of proposing the reverse moves.
+
+    Returns:
+        For each move: its kind (as for `_move`), the node involved (or -1), the
+        log ratio of the posterior probabilities of the tree it leads to and
+        the current tree, and the log probabilities of proposing its reverse
+        and the move itself.
+    '''
+    t, full = root.tree, opts.full
+    nc, lc, ac = root.node_count, root.leaf_count, root.attachment_count
+    bm, dm = _move_probs(nc, ac, opts)
+    moves, nodes = [], []
+    # (Each try uses one uniform variate to pick its kind, and one to pick its
+    # node.)
+    for m, r in np.random.rand(k, 2).tolist():
+        if m < bm:
+            moves.append(1)
+            nodes.append(t.attachments.select(int(r*ac)))
+        elif m < bm + dm:
+            moves.append(-1)
+            nodes.append(t.leaves.select(int(r*lc)))
+        else:
+            moves.append(0)
+            nodes.append(-1)
+    moves, nodes = np.array(moves), np.array(nodes, np.int64)
+    births, deaths, tried = moves > 0, moves < 0, moves != 0
+    lpost = np.zeros(k)
+    lrev = np.full(k, math.log(1-bm-dm) if bm + dm < 1 else 0.0)
+    lfwd = lrev.copy()
+    if not np.any(tried):
+        return moves, nodes, lpost, lrev, lfwd
+    # The descendants of the nodes to be born are initialised first (as they
+    # would be by `tree.activate`), so that their new attachments are known.
+    vs = nodes[births]
+    gains = _attachment_gains(t, vs, opts)
+    ratios = likelihood.full_lbirth_ratios if full else likelihood.lbirth_ratios
+    lpost[tried] = moves[tried]*ratios(t, nodes[tried], alpha, table)
+    us = t.parent[vs]
+    nlcs = lc + 1 - ((us >= 0) & (t.node_count[us] == 1))
+    for i, nac, nlc in zip(np.flatnonzero(births).tolist(),
+                           (ac-1+gains).tolist(), nlcs.tolist()):
+        if full:
+            lpost[i] += lprior_ratio(nc+ac, nc+1+nac)
+        else:
+            lpost[i] += lprior_ratio(nc, nc+1)
+        lrev[i] = math.log(_move_probs(nc+1, nac, opts)[1]/nlc)
+        lfwd[i] = math.log(bm/ac)
+    nacs = ac + 1 - t.attachment_count[nodes[deaths]]
+    for i, nac in zip(np.flatnonzero(deaths).tolist(), nacs.tolist()):
+        if full:
+            lpost[i] += lprior_ratio(nc+ac, nc-1+nac)
+        else:
+            lpost[i] += lprior_ratio(nc, nc-1)
+        lrev[i] = math.log(_move_probs(nc-1, nac, opts)[0]/nac)
+        lfwd[i] = math.log(dm/lc)
+    return moves, nodes, lpost, lrev, lfwd
+
+def _attachment_gains(t, vs, opts):
+    # Returns the number of new attachments that the activation of each of the
+    # given attachments would create, after initialising their descendants as
+    # `tree.activate` would.
+    for v in sorted(set(vs.tolist())):
+        f, n = t.first_child[v], t.child_count[v]
+        if not opts.full and f < 0:
+            tree._expand(t, v, opts.height_step)
+        elif opts.full:
+            ws = np.arange(f, f+n)
+            if np.any(t.first_child[ws[t.count_start[ws] >= 0]] < 0):
+                tree._expand(t, v, opts.height_step+1)
+    ws = tree._children_of(t, vs)
+    parents = np.repeat(np.arange(len(vs)), t.child_count[vs])
+    valid = t.count_start[ws] >= 0
+    if opts.full:
+        # (A child is only an attachment if one of its own children is valid.)
+        xs = tree._children_of(t, ws)
+        owners = np.repeat(np.arange(len(ws)), t.child_count[ws])
+        valid &= np.bincount(owners, t.count_start[xs] >= 0, len(ws)) > 0
+    return np.bincount(parents, valid, len(vs)).astype(np.int64)
+
+def _choose(lw):
+    # Picks an index with probability proportional to exp(lw).
+    w = np.cumsum(np.exp(lw - np.max(lw)))
+    return int(np.searchsorted(w, np.random.rand()*w[-1], side='right'))
 
-def _death(root, alpha, lprior_ratio, opts):
+def _lsum(a):
+    # Returns log(sum(exp(a))).
+    m = np.max(a)
+    return m + math.log(np.sum(np.exp(a - m)))
+
+def _birth(root, data, alphabet, alpha, lprior_ratio, opts, table=None):
+    '''
+    Attempts a birth move.
+
+    Returns:
+        The resulting change in the log posterior probability of the tree if the
+        move was accepted, or None otherwise.
     '''
-    Attempts a death move, returning true if the move was accepted.
+    # The proposed node's descendants are initialised as they would be by
+    # `tree.activate`, so that the reverse death move can be evaluated without
+    # making the birth; the node is only activated if the move is accepted.
+    v = tree.nth_attachment(root, np.random.randint(root.attachment_count))
+    lposterior, lproposal = _lbirth_prob(v, root, alpha, lprior_ratio, opts,
+                                         table)
+    lbirth_prob = lposterior + lproposal
+    if lbirth_prob != 0 and math.log(np.random.rand()) > lbirth_prob:
+        return None
+    tree.activate(v, data, alphabet, opts)
+    return lposterior
+
+def _death(root, alpha, lprior_ratio, opts, table=None):
     '''
-    v = tree.leaf(root, np.random.randint(root.leaf_count))
-    ldeath_prob = _ldeath_prob(v, root, alpha, lprior_ratio, opts)
-    if math.log(np.random.rand()) <= ldeath_prob:
+    Attempts a death move.
+
+    Returns:
+        The resulting change in the log posterior probability of the tree if the
+        move was accepted, or None otherwise.
+    '''
+    v = tree.nth_leaf(root, np.random.randint(root.leaf_count))
+    lposterior, lproposal = _ldeath_prob(v, root, alpha, lprior_ratio, opts,
+                                         table)
+    if math.log(np.random.rand()) <= lposterior + lproposal:
         tree.deactivate(v)
-        return True
-    return False
+        return lposterior
+    return None
 
-def _ldeath_prob(v, root, alpha, lprior_ratio, opts):
+def _ldeath_prob(v, root, alpha, lprior_ratio, opts, table=None):
     '''
-    Returns the acceptance probability of a death move involving a given node.
+    Returns the (log) acceptance probability of a death move involving a given
+    node, split into the posterior ratio of the two trees and the ratio of the
+    probabilities with which the move and its reverse are proposed.
 
     Note that the probability of the corresponding birth move is the inverse of
     this death probability.
@@ -130,14 +608,55 @@ def _ldeath_prob(v, root, alpha, lprior_ratio, opts):
     nc, lc, ac = root.node_count, root.leaf_count, root.attachment_count
     nac = ac-v.attachment_count+1
     if opts.full:
-        lr = likelihood.full_ldeath_ratio(v, alpha)
+        lr = likelihood.full_ldeath_ratio(v, alpha, table)
         pr = lprior_ratio(nc+ac, nc-1+nac)
     else:
-        lr = likelihood.ldeath_ratio(v, alpha)
+        lr = likelihood.ldeath_ratio(v, alpha, table)
         pr = lprior_ratio(nc, nc-1)
     dm = _move_probs(nc, ac, opts)[1]
     bm = _move_probs(nc-1, nac, opts)[0]
-    return lr+pr + math.log((bm/nac)*(lc/dm))
+    return lr+pr, math.log((bm/nac)*(lc/dm))
+
+def _lbirth_prob(v, root, alpha, lprior_ratio, opts, table=None):
+    '''
+    Returns the (log) acceptance probability of a birth move involving a given
+    attachment, split as in `_ldeath_prob`.
+
+    The probability is the inverse of that of the reverse death move, which is
+    found from the numbers of nodes, leaves, and attachments that the tree
+    would have after the birth.
+    '''
+    t = root.tree
+    nc, lc, ac = root.node_count, root.leaf_count, root.attachment_count
+    u = t.parent[v.id]
+    nlc = lc + 1 - (u >= 0 and t.node_count[u] == 1)
+    nac = ac-1+_attachment_gain(t, v.id, opts)
+    if opts.full:
+        lr = likelihood.full_ldeath_ratio(v, alpha, table)
+        pr = lprior_ratio(nc+1+nac, nc+ac)
+    else:
+        lr = likelihood.ldeath_ratio(v, alpha, table)
+        pr = lprior_ratio(nc+1, nc)
+    dm = _move_probs(nc+1, nac, opts)[1]
+    bm = _move_probs(nc, ac, opts)[0]
+    return -(lr+pr), -math.log((bm/ac)*(nlc/dm))
+
+def _attachment_gain(t, v, opts):
+    # Returns the number of new attachments that the activation of attachment
+    # `v` would create (as `_attachment_gains` does for a batch of them).
+    f, n = t.first_child[v], t.child_count[v]
+    if not opts.full:
+        if f < 0:
+            tree._expand(t, v, opts.height_step)
+            f, n = t.first_child[v], t.child_count[v]
+        return int(np.count_nonzero(t.count_start[f:f+n] >= 0))
+    ws = f + np.flatnonzero(t.count_start[f:f+n] >= 0)
+    if min(t.first_child[ws].tolist(), default=0) < 0:
+        tree._expand(t, v, opts.height_step+1)
+    gain = 0
+    for g, m in zip(t.first_child[ws].tolist(), t.child_count[ws].tolist()):
+        gain += max(t.count_start[g:g+m].tolist(), default=-1) >= 0
+    return gain
 
 def _move_probs(node_count, attachment_count, opts):
     '''
@@ -0,0 +1,119 @@
+#===============================================================================
+# BVMM
+# Suffix Array Functions
+#===============================================================================
+
+import numpy as np
+
+class SuffixIndex:
+    '''
+    Indexes the contexts that precede each position in a set of sequences.
+
+    The context of a position is the string of symbols that precede it, read in
+    reverse, so that the path from the root of a tree to one of its nodes spells
+    out the context of every position at which the node's state occurs. Sorting
+    the positions by their contexts (building a suffix array over the reversed
+    data) places the occurrences of each state in a contiguous range of the
+    index, and the ranges of a node's children can then be found by splitting
+    that range using binary search.
+
+    Args:
+        data: a list of integer indices, or an iterable set of such lists.
+        max_depth: if given, contexts are only sorted up to this length, which
+            suffices for trees whose height is no greater than this value.
+    '''
+    def __init__(self, data, max_depth=None):
+        try:
+            arrays = []
+            for array in data:
+                iter(array)
+                arrays.append(np.asarray(array, np.int32))
+        except TypeError:
+            arrays = [np.asarray(data, np.int32)]
+        if len(arrays) == 0:
+            arrays = [np.zeros(0, np.int32)]
+        self.data = np.concatenate(arrays)
+        # The number of symbols preceding each position in its own sequence.
+        self.lengths = np.concatenate([np.arange(len(a), dtype=np.int32)
+                                       for a in arrays])
+        self.order = _sort_contexts(self.data, self.lengths, max_depth)
+
+    def key(self, p, depth):
+        '''
+        Returns the symbol that precedes the first `depth` symbols of the
+        context of position `p`, or -1 if the context is too short.
+        '''
+        return self.data[p-depth-1] if self.lengths[p] > depth else -1
+
+    def find(self, lo, hi, depth, x):
+        '''
+        Returns the subrange of `lo:hi` in which symbol `x` follows the first
+        `depth` symbols of each position's context.
+        '''
+        return (self._search(lo, hi, depth, x, False),
+                self._search(lo, hi, depth, x, True))
+
+    def split(self, lo, hi, depth):
+        '''
+        Splits a range according to the symbols that follow the first `depth`
+        symbols of each position's context.
+
+        Yields:
+            A triple containing each symbol that occurs and its subrange.
+        '''
+        while lo < hi:
+            x = self.key(self.order[lo], depth)
+            end = self._search(lo, hi, depth, x, True)
+            if x >= 0:
+                yield x, lo, end
+            lo = end
+
+    def counts(self, lo, hi, n):
+        '''
+        Returns the symbol counts of the positions in a range.
+
+        Args:
+            n: the size of the alphabet.
+        '''
+        return np.bincount(self.data[self.order[lo:hi]], minlength=n)
+
+    def _search(self, lo, hi, depth, x, right):
+        # A binary search for the first position whose key is greater than (or
+        # greater than or equal to) `x`; keys increase within a node's range.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            y = self.key(self.order[mid], depth)
+            if y < x or right and y == x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+def _sort_contexts(data, lengths, max_depth=None):
+    '''
+    Returns the positions of a data array sorted by their (reversed) contexts.
+
+    This uses prefix doubling: after each round, the rank of a position reflects
+    the first `h` symbols of its context, and the ranks for `2h` symbols are
+    obtained by pairing the rank of each position with that of the position `h`
+    places before it. Rank 0 is reserved for the empty context, which makes the
+    shorter of two otherwise identical contexts sort first.
+    '''
+    n = len(data)
+    positions = np.arange(n, dtype=np.int32)
+    ranks = np.where(lengths > 0, data[positions-1] + 1, 0).astype(np.int32)
+    classes, h = len(np.unique(ranks)), 1
+    # Once a round fails to split any of the classes, none of the later ones
+    # will either.
+    while classes < n and (max_depth is None or h < max_depth):
+        shifted = np.where(lengths >= h, ranks[np.maximum(positions-h, 0)], 0)
+        order = np.lexsort((shifted, ranks))
+        changes = ((ranks[order][1:] != ranks[order][:-1]) |
+                   (shifted[order][1:] != shifted[order][:-1]))
+        ranks = np.empty(n, np.int32)
+        ranks[order[0]] = 0
+        ranks[order[1:]] = np.cumsum(changes)
+        if np.sum(changes) + 1 == classes:
+            break
+        classes, h = np.sum(changes) + 1, 2*h
+    return np.lexsort((positions, ranks)).astype(np.int32)
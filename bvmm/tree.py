@@ -3,8 +3,364 @@
 # Tree Manipulation Functions
 #===============================================================================
 
+import bisect
 import collections
+import hashlib
+import os
 import numpy as np
+from .fenwick import IndexedSet
+from .suffix import SuffixIndex
+
+class Tree:
+    '''
+    Stores the nodes of a tree as a set of parallel arrays.
+
+    Nodes are identified by their position in the arrays (the root is always
+    node 0). The children of a node occupy a contiguous block of positions,
+    starting at `first_child` and ordered by symbol index, so that they can be
+    traversed and summarised using slices. Children are only created for the
+    symbols that actually precede a node's state in the data, unless the tree
+    is dense, in which case every node has a child for each symbol. A node that
+    has not yet been expanded has a `first_child` of -1.
+
+    Counts are stored sparsely: the non-zero counts of a node occupy a
+    contiguous region of the shared `symbols` and `counts` pools, starting at
+    `count_start` and ordered by symbol index. Nodes whose states do not occur
+    have a `count_start` of -1, and every other node costs no more than a
+    handful of integers and an entry for each distinct successor. Alongside its
+    counts, each node maintains its residual counts (in the `residual` pool):
+    its own counts minus those of its active children, which are the counts
+    that are attributed to its state by the model.
+
+    The active leaves and the attachments of the tree are also tracked by two
+    order-statistic indices (`leaves` and `attachments`), keyed by node ID, so
+    that one of them can be selected in logarithmic time.
+
+    While samples are being recorded (see `start_samples`), sample counts are
+    accumulated lazily: the tree keeps a running total of samples taken
+    (`sample_clock`), and each node records the value it had when the node
+    last changed state (`sampled_since`). The elapsed interval is only added to
+    a node's sample count when its state changes again, or when recording
+    stops.
+
+    The occurrences of each node's state are recorded as checkpoints: one array
+    of data indices per input sequence (or structured array of triples, for
+    network data). A node's checkpoints are only needed to initialise the counts
+    of its children, and are released once that has been done if the tree's
+    `release` option is set. If the tree is backed by a suffix index, nodes
+    instead record the range of the index (`lo` to `hi`) that holds the
+    occurrences of their states.
+
+    Args:
+        alphabet: the set of characters that appear in the original data set.
+        capacity: the number of nodes for which space should be reserved.
+        suffix: an optional `SuffixIndex` over the (sequence) data set.
+        dense: whether every node should have a child for each symbol.
+    '''
+    _fields = (('index', np.int32), ('parent', np.int32),
+               ('first_child', np.int32), ('child_count', np.int32),
+               ('depth', np.int32),
+               ('count_start', np.int64), ('count_size', np.int32),
+               ('is_active', np.bool_),
+               ('node_count', np.int32), ('leaf_count', np.int32),
+               ('attachment_count', np.int32), ('sample_count', np.float64),
+               ('residual_total', np.float64), ('sampled_since', np.int64))
+
+    def __init__(self, alphabet, capacity=64, suffix=None, dense=False):
+        self.alphabet = alphabet
+        self.dense = dense
+        self.size = 0
+        self.suffix = suffix
+        if suffix is not None:
+            self._fields += (('lo', np.int64), ('hi', np.int64))
+        for name, dtype in self._fields:
+            setattr(self, name, np.zeros(capacity, dtype))
+        self.checkpoints = [] # data indices at which each state appears.
+        self.symbols = np.zeros(capacity, np.int32)
+        self.counts = np.zeros(capacity)
+        self.residual = np.zeros(capacity)
+        self.pool_size = 0 # no. of entries of the count pools in use.
+        self.kind = 'sequence'
+        self.arrays = [] # the data, as one integer array per sequence.
+        self.dest_index = [] # network entries by destination (per sequence).
+        self.release = False
+        self.spilled = {} # the file locations of checkpoints written to disk.
+        self.leaves = IndexedSet(capacity)
+        self.attachments = IndexedSet(capacity)
+        self.sampling = None # the options under which samples are recorded.
+        self.sample_clock = 0
+
+def _reserve(t, n):
+    '''
+    Ensures that there is space in a tree's arrays for `n` additional nodes.
+    '''
+    capacity = len(t.index)
+    if t.size + n > capacity:
+        capacity = max(2*capacity, t.size+n)
+        for name, dtype in t._fields:
+            array = np.zeros(capacity, dtype)
+            array[:t.size] = getattr(t, name)[:t.size]
+            setattr(t, name, array)
+        t.leaves.resize(capacity)
+        t.attachments.resize(capacity)
+
+def _add_children(t, parents, ps, xs):
+    '''
+    Creates the children of a set of childless parents, and returns the IDs of
+    the children that correspond to each of the given (parent, symbol) pairs.
+
+    A child is created for each distinct pair, unless the tree is dense, in
+    which case every parent receives a full block of children. Parents with no
+    children are still marked as expanded, with an empty block.
+    '''
+    k, s = len(t.alphabet), t.size
+    keys = ps.astype(np.int64)*k + xs
+    if t.dense:
+        blocks = np.sort(parents).astype(np.int64)[:, None]*k + np.arange(k)
+        blocks = blocks.ravel()
+    else:
+        blocks = np.unique(keys)
+    n = len(blocks)
+    _reserve(t, n)
+    t.index[s:s+n] = blocks % k
+    t.parent[s:s+n] = blocks // k
+    t.depth[s:s+n] = t.depth[blocks // k] + 1
+    t.first_child[s:s+n] = -1
+    t.child_count[s:s+n] = 0
+    t.count_start[s:s+n] = -1
+    t.count_size[s:s+n] = 0
+    t.sampled_since[s:s+n] = t.sample_clock
+    t.first_child[parents] = s + n
+    t.child_count[parents] = 0
+    owners, starts, sizes = np.unique(blocks // k, return_index=True,
+                                      return_counts=True)
+    t.first_child[owners] = s + starts
+    t.child_count[owners] = sizes
+    t.checkpoints.extend([None] * n)
+    t.size = s + n
+    return (s + np.searchsorted(blocks, keys)).astype(np.int32)
+
+def _reserve_counts(t, n):
+    '''
+    Ensures that there is space in a tree's count pool for `n` more entries.
+    '''
+    capacity = len(t.counts)
+    if t.pool_size + n > capacity:
+        capacity = max(2*capacity, t.pool_size+n)
+        for name, dtype in (('symbols', np.int32), ('counts', np.float64),
+                            ('residual', np.float64)):
+            array = np.zeros(capacity, dtype)
+            array[:t.pool_size] = getattr(t, name)[:t.pool_size]
+            setattr(t, name, array)
+
+def _set_counts(t, v, symbols, values):
+    '''
+    Stores the counts of a node, given as sorted symbol indices and values.
+    '''
+    s, n = t.pool_size, len(symbols)
+    _reserve_counts(t, n)
+    t.symbols[s:s+n] = symbols
+    t.counts[s:s+n] = values
+    t.count_start[v], t.count_size[v] = s, n
+    t.pool_size = s + n
+    _reset_residual(t, v)
+
+def _add_counts(t, nodes, symbols, weights):
+    '''
+    Sets the counts of a set of new nodes from their (weighted) occurrences.
+    '''
+    k, s = len(t.alphabet), t.pool_size
+    keys, inverse = np.unique(nodes.astype(np.int64)*k + symbols,
+                              return_inverse=True)
+    n = len(keys)
+    _reserve_counts(t, n)
+    # The unique keys are ordered by node, so each node's counts are contiguous
+    # and ordered by symbol.
+    t.symbols[s:s+n] = keys % k
+    t.counts[s:s+n] = np.bincount(inverse.ravel(),
+                                  np.broadcast_to(weights, inverse.shape), n)
+    vs, starts, sizes = np.unique(keys // k, return_index=True,
+                                  return_counts=True)
+    t.count_start[vs] = s + starts
+    t.count_size[vs] = sizes
+    t.pool_size = s + n
+    # New nodes have no active children.
+    t.residual[s:s+n] = t.counts[s:s+n]
+    t.residual_total[vs] = np.add.reduceat(t.counts[s:s+n], starts)
+
+def _clear_counts(t, vs):
+    '''
+    Removes the counts of a set of nodes (their entries are simply abandoned).
+    '''
+    t.count_start[vs] = -1
+    t.count_size[vs] = 0
+
+def _sparse_counts(t, v):
+    '''
+    Returns the symbol indices and values of a node's non-zero counts.
+    '''
+    s = t.count_start[v]
+    e = s + t.count_size[v]
+    return t.symbols[s:e], t.counts[s:e]
+
+def _count_entries(t, vs):
+    '''
+    Returns the positions (in the pool of counts) of the non-zero counts of
+    several nodes, one node after another, along with the index in `vs` of the
+    node to which each entry belongs.
+    '''
+    n = t.count_size[vs].astype(np.int64)
+    owners = np.repeat(np.arange(len(vs)), n)
+    shifts = t.count_start[vs] - np.cumsum(n) + n
+    return np.repeat(shifts, n) + np.arange(np.sum(n)), owners
+
+def _child_entries(t, v):
+    '''
+    Returns the positions of the non-zero counts of a node's children, as
+    `_count_entries` would for those children that have counts, along with the
+    number of such children.
+    '''
+    f, n = t.first_child[v], t.child_count[v]
+    if n > _few_counts:
+        ws = f + np.flatnonzero(t.count_start[f:f+n] >= 0)
+        return _count_entries(t, ws) + (len(ws),)
+    # A few children are cheaper to gather one by one than as arrays.
+    entries, owners, k = [], [], 0
+    for s, m in zip(t.count_start[f:f+n].tolist(),
+                    t.count_size[f:f+n].tolist()):
+        if s >= 0:
+            entries.extend(range(s, s+m))
+            owners.extend([k]*m)
+            k += 1
+    return np.array(entries, np.int64), np.array(owners, np.int64), k
+
+def _counts_at(t, v, xs, residual=False):
+    '''
+    Returns a node's counts (or residual counts) for the given (sorted) symbol
+    indices.
+    '''
+    s, n = t.count_start[v], t.count_size[v]
+    pool = t.residual if residual else t.counts
+    if n == 0:
+        return np.zeros(len(xs))
+    elif n == len(t.alphabet):
+        return pool[s+xs] # (every symbol has a count, in order.)
+    symbols = t.symbols[s:s+n]
+    i = np.minimum(np.searchsorted(symbols, xs), n-1)
+    return np.where(symbols[i] == xs, pool[s+i], 0)
+
+def _entry_counts_at(t, vs, owners, xs, residual=False):
+    '''
+    Returns the counts (or residual counts) of nodes `vs[owners[i]]` for symbol
+    indices `xs[i]`, for every `i` at once.
+    '''
+    us, inverse = np.unique(vs, return_inverse=True)
+    entries, positions = _count_entries(t, us)
+    if len(entries) == 0:
+        return np.zeros(len(xs))
+    # Each entry is keyed by its node's position in `us` and its symbol, which
+    # orders the keys of all of the nodes' (sorted) entries.
+    m = len(t.alphabet)
+    keys = positions*m + t.symbols[entries]
+    queries = inverse.ravel()[owners].astype(np.int64)*m + xs
+    i = np.minimum(np.searchsorted(keys, queries), len(keys)-1)
+    pool = t.residual if residual else t.counts
+    return np.where(keys[i] == queries, pool[entries[i]], 0)
+
+def _adjust_residual(t, u, v, sign):
+    '''
+    Adds a child's counts to (or subtracts them from) its parent's residuals.
+    '''
+    s, n = t.count_start[u], t.count_size[u]
+    if s < 0 or t.count_start[v] < 0:
+        return
+    xs, counts = _sparse_counts(t, v)
+    if n <= _few_counts:
+        # A few counts are cheaper to adjust one by one than as arrays.
+        symbols = t.symbols[s:s+n].tolist()
+        total = 0
+        for x, c in zip(xs.tolist(), counts.tolist()):
+            i = bisect.bisect_left(symbols, x)
+            if i < n and symbols[i] == x:
+                t.residual[s+i] += sign*c
+            total += c
+        t.residual_total[u] += sign*total
+        return
+    if n > 0:
+        # (Counts that were set by hand need not be consistent.)
+        i = np.minimum(np.searchsorted(t.symbols[s:s+n], xs), n-1)
+        valid = t.symbols[s+i] == xs
+        t.residual[s+i[valid]] += sign*counts[valid]
+    t.residual_total[u] += sign*np.sum(counts)
+
+_few_counts = 16 # the most counts that are adjusted one by one.
+
+def _reset_residual(t, v):
+    '''
+    Recomputes a node's residual counts from its counts and active children.
+    '''
+    s, n = t.count_start[v], t.count_size[v]
+    t.residual[s:s+n] = t.counts[s:s+n]
+    t.residual_total[v] = np.sum(t.counts[s:s+n])
+    for w in _children(t, v):
+        if t.is_active[w]:
+            _adjust_residual(t, v, w, -1)
+
+def _dense_counts(t, v):
+    '''
+    Returns a node's counts as a vector with an entry for every symbol.
+    '''
+    counts = np.zeros(len(t.alphabet))
+    symbols, values = _sparse_counts(t, v)
+    counts[symbols] = values
+    return counts
+
+def _children(t, v):
+    '''
+    Returns the range of node IDs occupied by the children of a node.
+    '''
+    f = t.first_child[v]
+    return range(f, f + t.child_count[v])
+
+def _child(t, v, x):
+    '''
+    Returns the ID of the child of a node associated with symbol index `x`, or
+    -1 if there is no such child.
+    '''
+    f, n = t.first_child[v], t.child_count[v]
+    i = np.searchsorted(t.index[f:f+n], x) if n > 0 else 0
+    return int(f + i) if i < n and t.index[f+i] == x else -1
+
+def _children_of(t, vs):
+    '''
+    Returns the IDs of the children of all of the given nodes, as an array.
+    '''
+    n = t.child_count[vs]
+    vs, n = vs[n > 0], n[n > 0]
+    if len(vs) == 0:
+        return np.zeros(0, np.int32)
+    # Each child's ID is its offset within the output plus a per-block shift.
+    shifts = t.first_child[vs] - np.cumsum(n) + n
+    return (np.repeat(shifts, n) + np.arange(np.sum(n))).astype(np.int32)
+
+def _subtree(t, v):
+    '''
+    Returns the IDs of the nodes in the subtree rooted at `v`, as an array.
+    '''
+    if v == 0:
+        return np.arange(t.size)
+    ids, level = [np.array([v], np.int32)], np.array([v], np.int32)
+    while len(level) > 0:
+        level = _children_of(t, level)
+        ids.append(level)
+    return np.concatenate(ids)
+
+def _field(name, cast):
+    def get(self):
+        return cast(getattr(self.tree, name)[self.id])
+    def set(self, value):
+        getattr(self.tree, name)[self.id] = value
+    return property(get, set)
 
 class Node:
     '''
@@ -22,23 +378,104 @@ class Node:
     Nodes also maintain certain statistics about their subtrees, facilitating
     the traversal, growth, and pruning of the tree.
 
+    Node objects are lightweight views: the data itself is held in the arrays
+    of a `Tree`, and any number of views of the same node may exist at once.
+
     Args:
-        i: the integer index assigned to this node's symbol.
-        x: the symbol this node represents.
-        parent: the first node along the path from this node to the root.
-    '''
-    def __init__(self, i, x, parent):
-        self.index = i
-        self.symbol = x
-        self.counts = None
-        self.parent = parent
-        self.children = []
-        self.node_count = 0 # no. of active nodes in the subtree rooted here.
-        self.leaf_count = 0 # no. of active leaves.
-        self.attachment_count = 0 # no. of valid (occurring), inactive nodes.
-        self.sample_count = 0
-        self.is_active = False
-        self.checkpoints = [] # data indices at which this state appears.
+        tree: the `Tree` in which the node's data is stored.
+        id: the node's position in the tree's arrays.
+    '''
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+
+    def __eq__(self, other):
+        return (isinstance(other, Node) and self.tree is other.tree and
+                self.id == other.id)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.id))
+
+    # The node count is the no. of active nodes in the subtree rooted at a node,
+    # the leaf count the no. of active leaves, and the attachment count the no.
+    # of valid (occurring), inactive nodes.
+    index = _field('index', int)
+    depth = _field('depth', int)
+    node_count = _field('node_count', int)
+    leaf_count = _field('leaf_count', int)
+    attachment_count = _field('attachment_count', int)
+    sample_count = _field('sample_count', float)
+    is_active = _field('is_active', bool)
+
+    @property
+    def symbol(self):
+        i = self.tree.index[self.id]
+        return 'λ' if i < 0 else self.tree.alphabet[i]
+
+    # Counts that were set by hand (or that cover every symbol) are returned as
+    # a view that can be modified in place (although residual counts will only
+    # be updated if the counts are reassigned); sparse counts are returned as a
+    # read-only copy.
+    @property
+    def counts(self):
+        t, v = self.tree, self.id
+        if t.count_start[v] < 0:
+            return None
+        elif t.count_size[v] == len(t.alphabet):
+            return _sparse_counts(t, v)[1]
+        counts = _dense_counts(t, v)
+        counts.flags.writeable = False
+        return counts
+
+    @counts.setter
+    def counts(self, counts):
+        t, v, k = self.tree, self.id, len(self.tree.alphabet)
+        if counts is None:
+            _clear_counts(t, v)
+        elif t.count_size[v] == k:
+            _sparse_counts(t, v)[1][:] = counts
+            _reset_residual(t, v)
+        else:
+            _set_counts(t, v, np.arange(k), counts)
+        u = t.parent[v]
+        if u >= 0 and t.is_active[v]:
+            _reset_residual(t, u)
+
+    @property
+    def sparse_counts(self):
+        '''
+        The symbol indices and values of the node's non-zero counts.
+        '''
+        if self.tree.count_start[self.id] < 0:
+            return None
+        return _sparse_counts(self.tree, self.id)
+
+    @property
+    def parent(self):
+        u = self.tree.parent[self.id]
+        return None if u < 0 else Node(self.tree, u)
+
+    @property
+    def children(self):
+        return [Node(self.tree, w) for w in _children(self.tree, self.id)]
+
+    def child(self, x):
+        '''
+        Returns the child associated with symbol index `x`, or None if the node
+        has no such child (because the symbol never precedes its state).
+        '''
+        w = _child(self.tree, self.id, x)
+        return None if w < 0 else Node(self.tree, w)
+
+    @property
+    def checkpoints(self): # data indices at which this state appears.
+        return _checkpoints(self.tree, self.id) or []
+
+    @checkpoints.setter
+    def checkpoints(self, checkpoints):
+        self.tree.checkpoints[self.id] = checkpoints
 
 class Options:
     '''
@@ -58,90 +495,392 @@ class Options:
             probability will be greater whenever birth or death moves are
             impossible.
         kind: the data type, either 'sequence' or 'network'.
+        tries: the number of moves proposed at each MCMC step (see
+            `sampling.mcmc`).
     '''
     def __init__(self, full=False, fringe=False, height_step=1,
-            min_skip_prob=1/3, kind='sequence'):
+            min_skip_prob=1/3, kind='sequence', tries=1):
         self.full = full
         self.fringe = fringe
         self.height_step = height_step
         self.min_skip_prob = min_skip_prob
         self.kind = kind
+        self.tries = tries
 
-def create_tree(height, data, alphabet, kind='sequence'):
+def create_tree(height, data, alphabet, kind='sequence', suffix=False,
+        release=False, dense=False):
     '''
     Creates a full, inactive tree with initialised occurrence counts.
 
     Args:
         height: the depth to which the tree should be grown (a singleton tree
             has a height of zero).
-        data: a list of integer indices, or an iterable set of such lists.
+        data: a list of integer indices, an iterable set of such lists, or a
+            `CountIndex` over the data, in which case the tree is a copy of the
+            index's tree (and `suffix` is ignored).
         alphabet: the set of characters that appear in the original data set.
         kind: the data type, either 'sequence' or 'network'.
+        suffix: if true, node occurrences will be located using a suffix index
+            over the data rather than lists of checkpoints (sequence data
+            only). An existing `SuffixIndex` over the same data may also be
+            given, in which case it will be shared.
+        release: if true, each node's checkpoints will be discarded as soon as
+            its children's counts have been initialised, since they are not
+            needed again. If a filename is given, they will instead be moved to
+            that file (and read back if they are requested).
+        dense: if true, each node will be given a child for every symbol in the
+            alphabet, including those that do not occur in the data (which is
+            useful for trees whose counts are to be set by hand). Otherwise
+            children are only created for the symbols that occur.
 
     Returns:
         The root node of the tree.
     '''
-    root = Node(-1, 'λ', None)
-    _add_children(root, 1, height, alphabet)
-    _initialise_counts(root, data, alphabet, kind)
-    if root.counts is not None:
-        root.attachment_count = 1
-    return root
-
-def _add_children(v, depth, max_depth, alphabet):
-    if depth <= max_depth:
-        v.children = [Node(i, x, v) for i, x in enumerate(alphabet)]
-        for w in v.children:
-            _add_children(w, depth+1, max_depth, alphabet)
-
-def _initialise_counts(v, data, alphabet, kind):
-    v.counts = np.zeros(len(alphabet))
-    v.checkpoints = []
-    if kind.lower() == 'sequence':
-        count_func = _sequence_counts
-    elif kind.lower() == 'network':
-        count_func = _network_counts
+    if isinstance(data, CountIndex):
+        return data._copy(height, alphabet, kind, release)
+    t = Tree(alphabet, suffix=_suffix_index(data, kind, suffix), dense=dense)
+    t.release = release
+    t.size = 1
+    t.index[0], t.parent[0], t.first_child[0] = -1, -1, -1
+    t.count_start[0] = -1
+    t.checkpoints.append(None)
+    _initialise_root(t, data, kind)
+    _expand(t, 0, height)
+    if t.count_start[0] >= 0:
+        t.attachment_count[0] = 1
+        t.attachments.add(0)
+    return Node(t, 0)
+
+class CountIndex:
+    '''
+    Holds the counts and occurrences of the contexts of a data set, to whatever
+    depth they have been counted, so that they can be shared by several
+    estimates (made with different priors, for example).
+
+    An index can be given to `mcmc`, `mlhd`, `bf` and so on in place of the
+    data set. Each of them works on a copy of the index's tree, and once it is
+    done, any levels that it has counted are added to the index (see
+    `update`), so that later estimates need not count them again.
+
+    If a cache directory is given, the index is stored there in a file named
+    after a hash of the data set and its kind, and an index that is later
+    created for the same data reads its counts from that file rather than
+    counting them. The file is rewritten whenever the index grows.
+
+    Args:
+        data: a list of integer indices, or an iterable set of such lists.
+        alphabet: the set of characters that appear in the original data set.
+        kind: the data type, either 'sequence' or 'network'.
+        height: the depth to which the contexts should be counted straight
+            away.
+        suffix: if true, node occurrences will be located using a suffix index
+            over the data rather than lists of checkpoints (see `create_tree`).
+        cache: an optional directory in which the index should be stored.
+    '''
+    def __init__(self, data, alphabet, kind='sequence', height=1, suffix=False,
+            cache=None):
+        self.data = data
+        self.alphabet = alphabet
+        self.kind = kind.lower()
+        self.cache = cache
+        self.key = _data_key(data, self.kind, suffix is not False and
+                                              suffix is not None)
+        filename = self.filename()
+        if filename is not None and os.path.exists(filename):
+            with np.load(filename) as f:
+                state = dict(f)
+            self.root = _restore_tree(state, data, alphabet)
+            self.lengths = _data_lengths(self.root.tree)
+            self.expand(height)
+        else:
+            self.root = create_tree(height, data, alphabet, kind, suffix, True)
+            self.lengths = _data_lengths(self.root.tree)
+            self.save()
+
+    @property
+    def size(self):
+        '''
+        The number of contexts (nodes) that have been counted so far.
+        '''
+        return self.root.tree.size
+
+    def filename(self):
+        '''
+        Returns the name of the file in which the index is cached, or None.
+        '''
+        if self.cache is None:
+            return None
+        return os.path.join(self.cache, self.key + '.npz')
+
+    def expand(self, height):
+        '''
+        Counts the contexts of the data set up to the given depth.
+        '''
+        size = self.size
+        _expand(self.root.tree, 0, height)
+        if self.size > size:
+            self.save()
+
+    def update(self, root):
+        '''
+        Adds the levels that have been counted in a tree created from the index
+        (by any of the estimation functions) to the index itself.
+
+        Trees that have been extended with new data, or whose checkpoints have
+        been moved to disk, are ignored.
+        '''
+        t = root.tree
+        if (t.size <= self.size or t.spilled or t.kind != self.kind or
+                _data_lengths(t) != self.lengths):
+            return
+        u = _copy_tree(t, self.data, self.alphabet, self.root.tree.suffix)
+        # The copy is returned to its initial, inactive state.
+        u.sampling, u.release = None, True
+        root = Node(u, 0)
+        while root.node_count > 0:
+            deactivate(nth_leaf(root, 0))
+        u.sample_count[:u.size] = 0
+        u.sampled_since[:u.size] = 0
+        u.sample_clock = 0
+        ids = np.arange(u.size)
+        _release(u, ids[(u.first_child[:u.size] >= 0) &
+                        (u.count_start[:u.size] >= 0)].tolist())
+        self.root = root
+        self.save()
+
+    def save(self):
+        '''
+        Writes the index to its cache directory (if it has one).
+        '''
+        filename = self.filename()
+        if filename is None:
+            return
+        os.makedirs(self.cache, exist_ok=True)
+        # As with checkpoints, the file is replaced atomically.
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as f:
+            np.savez(f, **_tree_state(self.root.tree))
+        os.replace(temp, filename)
+
+    def _copy(self, height, alphabet, kind, release):
+        # Returns a copy of the index's tree, grown to the given height.
+        if kind.lower() != self.kind:
+            raise ValueError("The data type does not match that of the index.")
+        t = _copy_tree(self.root.tree, self.data, alphabet,
+                       self.root.tree.suffix)
+        t.release = release
+        _expand(t, 0, height)
+        return Node(t, 0)
+
+def _data_key(data, kind, suffix):
+    # Returns a hash of a data set, its kind, and whether it is to be indexed
+    # by suffix, as a hexadecimal string.
+    h = hashlib.sha1('{} {}'.format(kind, suffix).encode())
+    for array in _arrays(data, kind):
+        h.update(np.array(array.shape, np.int64).tobytes())
+        h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+def _data_lengths(t):
+    # The lengths of the sequences from which a tree was built.
+    if t.suffix is not None:
+        return [len(a) for a in _suffix_arrays(t.suffix)]
+    return [len(a) for a in t.arrays]
+
+def _copy_tree(t, data, alphabet, suffix=None):
+    # Returns an independent copy of a tree (built from the given data).
+    return _restore_tree(_tree_state(t), data, alphabet, suffix).tree
+
+class NetworkWindow:
+    '''
+    Maintains a tree of counts over the entries of a temporal network that fall
+    within a sliding window of time.
+
+    New entries are added to the tree with `extend` and expired ones removed
+    with `retire`, so that its counts are updated incrementally rather than
+    recounted for each window. The window can be given to `mcmc` in place of
+    the data, in which case the chain runs on the window's own tree, starting
+    from the active tree that the previous run left behind (a warm start), and
+    leaving its own final tree active for the next run.
+
+    Args:
+        alphabet: the set of characters that appear in the data set.
+        span: the length of the window, in the units of the entries' timestamps.
+            Entries whose timestamps are no later than the latest timestamp
+            minus the span are retired, in the order in which they were added
+            (so an entry that arrives out of order is kept until those before
+            it have expired as well).
+        height: the depth to which the tree is grown as entries are added (the
+            nodes below it are only counted once their parents are activated).
+        full: whether or not the tree's active nodes are interpreted as a full
+            tree (which must agree with the `full` argument given to `mcmc`).
+    '''
+    def __init__(self, alphabet, span, height=1, full=False):
+        self.alphabet = alphabet
+        self.span = span
+        self.height = height
+        self.full = full
+        self.root = create_tree(height, [], alphabet, 'network')
+        self.times = np.zeros(0) # the timestamps of the entries in the window.
+        self.latest = -np.inf
+
+    def update(self, entries, times):
+        '''
+        Adds new entries to the window and retires those that have expired.
+
+        Args:
+            entries: a list of (source, destination) pairs of symbol indices.
+            times: the entries' timestamps.
+
+        Returns:
+            The number of entries that were retired.
+        '''
+        times = np.asarray(times, np.float64)
+        if len(times) != len(entries):
+            raise ValueError('Every entry must have a timestamp.')
+        if len(times) > 0:
+            extend(self.root, np.asarray(entries, np.int32).reshape(-1, 2),
+                   self.full)
+            # (The nodes that the new entries create are counted to the same
+            # depth as the rest of the tree.)
+            _expand(self.root.tree, 0, self.height)
+            self.times = np.concatenate((self.times, times))
+            self.latest = max(self.latest, np.max(times))
+        live = self.times > self.latest - self.span
+        n = int(np.argmax(live)) if np.any(live) else len(self.times)
+        retire(self.root, n, self.full)
+        self.times = self.times[n:]
+        return n
+
+def _update_index(data, root):
+    # Adds the levels counted in a tree to the index that it was created from
+    # (if it was created from one).
+    if isinstance(data, CountIndex):
+        data.update(root)
+
+def _suffix_index(data, kind, suffix):
+    if suffix is False or suffix is None:
+        return None
+    elif kind.lower() != 'sequence':
+        raise ValueError('Suffix indices are only supported for sequence data.')
+    elif isinstance(suffix, SuffixIndex):
+        return suffix
     else:
-        raise ValueError("Invalid data type specified. Valid options are "
-                         "'sequence' and 'network'.")
+        return SuffixIndex(data)
+
+def _index_dtype(n):
+    return np.int32 if n < 2**31 else np.int64
+
+def _network_dtype(n):
+    # Network checkpoints are triples of preceding index, final symbol, and
+    # count (see `_network_counts`).
+    return np.dtype([('k', _index_dtype(n)), ('j', np.int32), ('c', np.int32)])
+
+def _arrays(data, kind):
+    # Returns the data as a list of integer arrays, one for each sequence.
     try:
-        for i, array in enumerate(data):
+        arrays = []
+        for array in data:
             iter(array)
             if kind == 'network' and len(array) > 0:
                 iter(array[0]) # the array should contain tuples.
-            count_func(v, array, alphabet, i)
+            arrays.append(array)
     except TypeError:
-        count_func(v, data, alphabet, 0)
-
-def _init_structs(v, alphabet, array_index):
-    if v.counts is None:
-        v.counts = np.zeros(len(alphabet))
-    while len(v.checkpoints) <= array_index:
-        v.checkpoints.append([])
-
-def _sequence_counts(v, array, alphabet, array_index):
-    # To avoid traversing the entire array, each node keeps track of the indices
-    # at which its state (prefix string) appears -- specifically, the index of
-    # the first character following the prefix string. A node's checkpoints are
-    # necessarily a subset of those of its parent.
-    m = len(path_to(v)) # length of the prefix.
-    u = v.parent
-    uchks = u.checkpoints[array_index] if u is not None else range(len(array))
-    for j in uchks:
-        i = j - m # first index of the prefix.
-        if array[i] == v.index or v.parent is None:
-            w = v
-            while True: # update counts along the (extended) prefix's path.
-                _init_structs(w, alphabet, array_index)
-                w.counts[array[j]] += 1
-                w.checkpoints[array_index].append(j)
-                if i > 0 and w.children:
-                    i -= 1
-                    w = w.children[array[i]]
-                else:
-                    break
-
-def _network_counts(v, array, alphabet, array_index):
+        arrays = [data]
+    if kind == 'network':
+        return [np.asarray(a, np.int32).reshape(-1, 2) for a in arrays]
+    else:
+        return [np.asarray(a, np.int32) for a in arrays]
+
+def _initialise_root(t, data, kind):
+    if kind.lower() not in ('sequence', 'network'):
+        raise ValueError("Invalid data type specified. Valid options are "
+                         "'sequence' and 'network'.")
+    t.kind, k = kind.lower(), len(t.alphabet)
+    counts, chks = np.zeros(k), []
+    if t.suffix is not None:
+        t.lo[0], t.hi[0] = 0, len(t.suffix.order)
+        counts += t.suffix.counts(0, len(t.suffix.order), k)
+    else:
+        t.arrays = _arrays(data, t.kind)
+    for array in t.arrays:
+        n = len(array)
+        if t.kind == 'sequence':
+            counts += np.bincount(array, minlength=k)
+            chks.append(np.arange(n, dtype=_index_dtype(n)))
+        else:
+            counts += np.bincount(array[:, 1], minlength=k)
+            chks.append(np.zeros(n, _network_dtype(n)))
+            chks[-1]['k'] = np.arange(n)
+            chks[-1]['j'] = array[:, 1]
+            chks[-1]['c'] = 1
+    xs = np.flatnonzero(counts)
+    _set_counts(t, 0, xs, counts[xs])
+    t.checkpoints[0] = chks
+
+def _expand(t, v, height):
+    # Grows the subtree rooted at `v` level by level so that it is full to the
+    # given height. Nodes that have already been expanded are left as they are.
+    # The children of the remaining nodes, and their counts, are found using
+    # the parents' checkpoints, after which those checkpoints are no longer
+    # needed.
+    level, m = np.array([v], np.int32), t.depth[v]
+    for d in range(height):
+        parents = level[t.first_child[level] < 0]
+        if len(parents) > 0:
+            if t.suffix is not None:
+                _suffix_counts(t, parents, m)
+            elif t.kind == 'sequence':
+                _sequence_counts(t, parents, m)
+            else:
+                _network_counts(t, parents)
+            _release(t, parents[t.count_start[parents] >= 0])
+        level, m = _children_of(t, level), m+1
+
+def _sequence_counts(t, parents, m):
+    # Each checkpoint is the index of the first symbol following an occurrence
+    # of a node's state (prefix string), and the symbol preceding the occurrence
+    # (if there is one) identifies the child whose state it extends. A child's
+    # checkpoints are necessarily a subset of those of its parent.
+    counted = parents[t.count_start[parents] >= 0] # (states that occur.)
+    occurrences = []
+    for s, array in enumerate(t.arrays):
+        chks = [_checkpoints(t, p)[s] for p in counted]
+        js = np.concatenate(chks) if chks else np.zeros(0, np.int32)
+        ps = np.repeat(counted, [len(c) for c in chks])
+        valid = js > m # the prefix is preceded by the symbol at index js-m-1.
+        occurrences.append((ps[valid], js[valid]))
+    ps = np.concatenate([ps for ps, js in occurrences] + [counted[:0]])
+    xs = np.concatenate([array[js-m-1] for array, (ps, js)
+                         in zip(t.arrays, occurrences)] + [counted[:0]])
+    children = _add_children(t, parents, ps, xs)
+    symbols = np.concatenate([array[js] for array, (ps, js)
+                              in zip(t.arrays, occurrences)] + [counted[:0]])
+    chks, n = [], 0
+    for ps, js in occurrences:
+        chks.append((children[n:n+len(js)], js))
+        n += len(js)
+    _add_occurrences(t, children, symbols, 1, chks)
+
+def _suffix_counts(t, parents, m):
+    # The occurrences of each state form a contiguous range of the suffix index,
+    # and the ranges of a node's children are found by splitting that range
+    # according to the next symbol of each occurrence's context, so there is no
+    # need to store the occurrences themselves.
+    s = t.suffix
+    splits = [(p, x, lo, hi) for p in parents[t.count_start[parents] >= 0]
+              for x, lo, hi in s.split(t.lo[p], t.hi[p], m)]
+    ps = np.array([p for p, x, lo, hi in splits], np.int32)
+    xs = np.array([x for p, x, lo, hi in splits], np.int32)
+    children = _add_children(t, parents, ps, xs)
+    t.lo[children] = [lo for p, x, lo, hi in splits]
+    t.hi[children] = [hi for p, x, lo, hi in splits]
+    sizes = t.hi[children] - t.lo[children]
+    positions = s.order[np.repeat(t.lo[children] - np.cumsum(sizes) + sizes,
+                                  sizes) + np.arange(np.sum(sizes))]
+    _add_counts(t, np.repeat(children, sizes), s.data[positions], 1)
+
+def _network_counts(t, parents):
     # Like we do for sequence data, we maintain checkpoints of where each state
     # appears so that we can avoid having to traversing the whole data array
     # each time we want to initialise a set of nodes' counts. Doing so for
@@ -157,64 +896,716 @@ def _network_counts(v, array, alphabet, array_index):
     # checkpoint for the state 'ab' with respect to the entries above (ignoring
     # the omitted entries) would be (0, 'c', 2), and the checkpoints for 'abc'
     # would be (1, 'd', 1). To make it easy to find preceding entries without
-    # traversing the data in reverse, we also initialise a map that contains,
-    # for each symbol, the indices of the entries in which it appears as a
-    # destination (second element).
-    dest_chks = _network_dests(v, array, alphabet, array_index)
-    if v.parent is None:
-        _init_structs(v, alphabet, array_index)
-        chks = v.checkpoints[array_index]
-        for k, (i, j) in enumerate(array):
-            v.counts[j] += 1
-            chks.append((k, j, 1))
-        for w in v.children:
-            _network_counts(w, array, alphabet, array_index)
+    # traversing the data in reverse, we also build an index that groups the
+    # entries by their destinations (second elements), and search it for every
+    # occurrence at once (see `_network_dests`).
+    counted = parents[t.count_start[parents] >= 0] # (states that occur.)
+    occurrences = []
+    for s, array in enumerate(t.arrays):
+        chks = [_checkpoints(t, p)[s] for p in counted]
+        ps = np.repeat(counted, [len(c) for c in chks])
+        chks = np.concatenate(chks) if chks else np.zeros(0, _network_dtype(0))
+        sources = array[chks['k'], 0]
+        # Find the indices that can be used to extend the children's states.
+        ks = _preceding(t, s, sources, chks['k'])
+        occurrences.append((ps, sources, chks, ks))
+    ps = np.concatenate([o[0] for o in occurrences] + [counted[:0]])
+    xs = np.concatenate([o[1] for o in occurrences] + [counted[:0]])
+    children = _add_children(t, parents, ps, xs)
+    symbols = np.concatenate([o[2]['j'] for o in occurrences] + [counted[:0]])
+    weights = np.concatenate([o[2]['c'] for o in occurrences] + [counted[:0]])
+    extended, n = [], 0
+    for ps, sources, chks, ks in occurrences:
+        cs = children[n:n+len(chks)]
+        chks = chks[ks >= 0]
+        chks['k'] = ks[ks >= 0]
+        extended.append((cs[ks >= 0], chks))
+        n += len(cs)
+    _add_occurrences(t, children, symbols, weights, extended)
+
+def _preceding(t, array_index, sources, ks):
+    # Returns the index of the last entry before each entry `k` whose
+    # destination is the given source symbol, or -1 if there is none. Each
+    # query is keyed in the same way as the destination index, so that a single
+    # binary search finds the last key less than each one, which is only a
+    # match if it belongs to the same destination.
+    keys = _network_dests(t, array_index)
+    if len(keys) == 0:
+        return np.full(len(ks), -1, np.int64)
+    n = len(t.arrays[array_index])
+    i = np.searchsorted(keys, sources.astype(np.int64)*n + ks) - 1
+    found = keys[np.maximum(i, 0)]
+    return np.where((i >= 0) & (found // n == sources), found % n, -1)
+
+def _network_dests(t, array_index):
+    # Returns the destination index of a sequence of network entries, which is
+    # built the first time it is needed. The entries are grouped by destination
+    # and ordered by position within each group, as in a compressed sparse row
+    # layout, but rather than storing the groups' offsets each entry's position
+    # `k` is stored as the key `j*n + k` (for destination `j`, and `n` entries),
+    # so that the whole array is sorted.
+    while len(t.dest_index) <= array_index:
+        t.dest_index.append(None)
+    if t.dest_index[array_index] is None:
+        array = t.arrays[array_index]
+        n = len(array)
+        keys = array[:, 1].astype(np.int64)*n + np.arange(n)
+        keys.sort()
+        t.dest_index[array_index] = keys
+    return t.dest_index[array_index]
+
+def _add_occurrences(t, nodes, symbols, weights, checkpoints):
+    # Sets the counts of a set of new nodes from the given (weighted) symbol
+    # occurrences, along with their checkpoints, which are given as a pair of
+    # node and checkpoint arrays for each sequence (nodes that are given no
+    # checkpoints for a sequence receive empty ones).
+    _add_counts(t, nodes, symbols, weights)
+    empty = [chks[:0] for vs, chks in checkpoints]
+    for v in np.unique(nodes).tolist():
+        t.checkpoints[v] = list(empty)
+    for s, (vs, chks) in enumerate(checkpoints):
+        order = np.argsort(vs, kind='stable')
+        vs, starts = np.unique(vs[order], return_index=True)
+        for v, c in zip(vs.tolist(), np.split(chks[order], starts[1:])):
+            t.checkpoints[v][s] = c
+
+def _checkpoints(t, v):
+    # Returns a node's checkpoints, reading them from disk if necessary.
+    if t.checkpoints[v] is None and v in t.spilled:
+        chks = []
+        with open(t.release, 'rb') as f:
+            for offset, n, dtype in t.spilled[v]:
+                f.seek(offset)
+                chks.append(np.fromfile(f, dtype, n))
+        # (Sequences added since the checkpoints were written, by `extend`,
+        # contain no occurrences.)
+        return chks + [np.zeros(0, _checkpoint_dtype(t, len(a)))
+                       for a in t.arrays[len(chks):]]
+    return t.checkpoints[v]
+
+def _release(t, vs):
+    # Discards the checkpoints of a set of (expanded) nodes, or moves them to
+    # disk, depending on the tree's `release` option. (Trees with a suffix index
+    # have no checkpoints to release.)
+    if not t.release or t.suffix is not None:
+        return
+    elif t.release is not True:
+        with open(t.release, 'ab') as f:
+            for v in vs:
+                t.spilled[v] = []
+                for chks in t.checkpoints[v]:
+                    t.spilled[v].append((f.tell(), len(chks), chks.dtype))
+                    chks.tofile(f)
+    for v in vs:
+        t.checkpoints[v] = None
+
+def extend(root, data, full=False):
+    '''
+    Adds new observations to the data set from which a tree was built.
+
+    The counts of every node that has been created are updated, along with the
+    checkpoints of the nodes that keep them, so that nodes that are expanded
+    later see the new data as well. Active nodes and sample counts are left as
+    they are, but nodes may gain children (which become attachments where
+    appropriate). The children of a node must be contiguous, so any node that
+    gains a child has its block of children moved, and once the space that is
+    left behind outnumbers that in use, the tree is compacted (see `_compact`).
+    The IDs of the nodes other than the root (and any `Node` objects that refer
+    to them) are therefore no longer valid.
+
+    Args:
+        root: the root of the tree.
+        data: the new data, in the same form as that given to `create_tree`. A
+            single list of symbol indices (or of pairs, for network data) is
+            appended to the last sequence, so that contexts may straddle the old
+            and new data. Otherwise the i-th list is appended to the i-th
+            sequence, and any further lists are added as new sequences.
+        full: whether or not the active nodes are interpreted as a full tree,
+            which determines the nodes that count as attachments.
+    '''
+    t = root.tree
+    arrays = t.arrays if t.suffix is None else _suffix_arrays(t.suffix)
+    new = _arrays(data, t.kind)
+    if _nested(data, t.kind):
+        targets = range(len(new))
     else:
-        for k, j, c in v.parent.checkpoints[array_index]:
-            if array[k][0] == v.index:
-                w = v
-                while True:
-                    _init_structs(w, alphabet, array_index)
-                    w.counts[j] += c
-                    # Find the index that can be used to extend the state.
-                    i = array[k][0]
-                    if dest_chks[i] is None:
-                        break
-                    d = np.searchsorted(dest_chks[i], k) - 1 # last less than k.
-                    if d < 0:
-                        break
-                    k = dest_chks[i][d]
-                    w.checkpoints[array_index].append((k, j, c))
-                    if not w.children:
-                        break
-                    w = w.children[array[k][0]]
-        
-def _network_dests(v, array, alphabet, array_index):
-    root = _root(v)
-    if not hasattr(root, '_dest_checkpoints'):
-        root._dest_checkpoints = []
-    while len(root._dest_checkpoints) <= array_index:
-        root._dest_checkpoints.append(None)
-    if root._dest_checkpoints[array_index] is None:
-        # We store destination checkpoints as an array of indices for each
-        # possible destination symbol.
-        dest_chks = [None] * len(alphabet)
-        for k, (i, j) in enumerate(array):
-            if dest_chks[j] is None:
-                dest_chks[j] = []
-            dest_chks[j].append(k)
-        root._dest_checkpoints[array_index] = dest_chks
-    return root._dest_checkpoints[array_index]
+        targets = [max(len(arrays)-1, 0)]
+    items = []
+    for s, array in zip(targets, new):
+        if s < len(arrays):
+            n = len(arrays[s])
+            arrays[s] = np.concatenate((arrays[s], array))
+        else:
+            n = 0
+            arrays.append(array)
+        items.append((s, np.arange(n, len(arrays[s]))))
+    if t.suffix is None:
+        _pad_checkpoints(t, arrays)
+        t.dest_index = [] # (the keys depend on the sequences' lengths.)
+    touched = _add_new_occurrences(t, arrays, items)
+    if t.suffix is not None:
+        t.suffix = SuffixIndex(arrays)
+        _suffix_ranges(t)
+    for v in touched[t.is_active[touched]].tolist():
+        _reset_residual(t, v)
+    _add_new_attachments(t, touched, full)
+    _compact(t)
+
+def _nested(data, kind):
+    # Whether a data set is a list of sequences rather than a single one.
+    try:
+        first = next(iter(data))
+        iter(first)
+        if kind == 'network':
+            iter(first[0])
+        return True
+    except (TypeError, StopIteration):
+        return False
+
+def _suffix_arrays(s):
+    # Recovers the sequences from which a suffix index was built.
+    return np.split(s.data, np.flatnonzero(s.lengths == 0)[1:])
+
+def _pad_checkpoints(t, arrays):
+    # Gives every node that keeps checkpoints an (empty) array for each new
+    # sequence.
+    for v, chks in enumerate(t.checkpoints):
+        if chks is not None and len(chks) < len(arrays):
+            t.checkpoints[v] = chks + [
+                np.zeros(0, _checkpoint_dtype(t, len(a)))
+                for a in arrays[len(chks):]]
+
+def _add_new_occurrences(t, arrays, items):
+    '''
+    Adds the occurrences at the given (new) positions of the data to every node
+    whose state they extend, creating nodes where necessary.
+
+    The occurrences are followed down the tree one level at a time, in the same
+    way as `_sequence_counts` and `_network_counts` find the occurrences of a
+    node's children, until they reach nodes that have not been expanded.
+
+    Returns:
+        The IDs of the nodes whose counts were changed.
+    '''
+    level = []
+    for s, positions in items:
+        if t.kind == 'sequence':
+            occ = positions
+        else:
+            occ = np.zeros(len(positions), _checkpoint_dtype(t, len(arrays[s])))
+            occ['k'] = positions
+            occ['j'] = arrays[s][positions, 1]
+            occ['c'] = 1
+        level.append((s, np.zeros(len(occ), np.int64), occ,
+                      np.ones(len(occ), np.bool_)))
+    touched, respill, d = [], set(), 0
+    while len(level) > 0:
+        # Every occurrence is counted, but (for networks) only those that can
+        # be extended further are stored as checkpoints.
+        nodes = np.concatenate([vs for s, vs, occ, stored in level])
+        if t.kind == 'sequence':
+            symbols = [arrays[s][occ] for s, vs, occ, stored in level]
+            weights = [np.ones(len(occ)) for s, vs, occ, stored in level]
+        else:
+            symbols = [occ['j'] for s, vs, occ, stored in level]
+            weights = [occ['c'] for s, vs, occ, stored in level]
+        _merge_counts(t, nodes, np.concatenate(symbols),
+                      np.concatenate(weights))
+        touched.append(np.unique(nodes))
+        if t.suffix is None:
+            for s, vs, occ, stored in level:
+                _append_checkpoints(t, arrays, s, vs[stored], occ[stored],
+                                    respill)
+        extended, ps, xs = [], [], []
+        for s, vs, occ, stored in level:
+            keep = stored & (t.first_child[vs] >= 0)
+            if t.kind == 'sequence':
+                keep &= occ > d
+                occ = occ[keep]
+                x = arrays[s][occ-d-1]
+                extended.append((s, occ, np.ones(len(occ), np.bool_)))
+            else:
+                occ = occ[keep]
+                x = arrays[s][occ['k'], 0]
+                ks = _preceding(t, s, x, occ['k'])
+                occ['k'] = np.where(ks >= 0, ks, occ['k'])
+                extended.append((s, occ, ks >= 0))
+            ps.append(vs[keep])
+            xs.append(x)
+        children = _find_children(t, np.concatenate(ps), np.concatenate(xs))
+        level, n = [], 0
+        for s, occ, stored in extended:
+            if len(occ) > 0:
+                level.append((s, children[n:n+len(occ)], occ, stored))
+            n += len(occ)
+        d += 1
+    if respill:
+        _release(t, sorted(respill))
+    return np.unique(np.concatenate(touched))
+
+def _merge_counts(t, nodes, symbols, weights):
+    '''
+    Adds (weighted) symbol occurrences to the counts of a set of nodes, which
+    may already have counts of their own. The nodes' residual counts are reset
+    to their counts.
+
+    The counts of nodes that gain no new symbols are updated in place, and
+    those of the others are rewritten at the end of the pool (abandoning their
+    old entries, which `_compact` reclaims).
+    '''
+    vs = np.unique(nodes)
+    vs = vs[t.count_start[vs] >= 0]
+    entries, owners = _count_entries(t, vs)
+    k = len(t.alphabet)
+    keys = vs[owners].astype(np.int64)*k + t.symbols[entries]
+    queries = nodes.astype(np.int64)*k + symbols
+    if len(keys) > 0:
+        i = np.minimum(np.searchsorted(keys, queries), len(keys)-1)
+        found = keys[i] == queries
+    else:
+        i, found = queries, np.zeros(len(queries), np.bool_)
+    moved = np.unique(nodes[~found])
+    inplace = ~np.isin(nodes, moved)
+    t.counts[entries] += np.bincount(i[inplace], weights[inplace],
+                                     len(entries))
+    t.residual[entries] = t.counts[entries]
+    t.residual_total[vs] = np.bincount(owners, t.counts[entries], len(vs))
+    vs = vs[np.isin(vs, moved)]
+    sizes = t.count_size[vs]
+    entries = _count_entries(t, vs)[0]
+    _add_counts(t, np.concatenate((np.repeat(vs, sizes), nodes[~inplace])),
+                np.concatenate((t.symbols[entries], symbols[~inplace])),
+                np.concatenate((t.counts[entries], weights[~inplace])))
+
+def _append_checkpoints(t, arrays, s, nodes, occ, respill):
+    # Adds new occurrences to the checkpoints of the nodes that keep them,
+    # reading them back from disk (and noting that they need to be written out
+    # again) if they have been moved there.
+    if len(nodes) == 0:
+        return
+    order = np.argsort(nodes, kind='stable')
+    vs, starts = np.unique(nodes[order], return_index=True)
+    dtype = _checkpoint_dtype(t, len(arrays[s]))
+    for v, c in zip(vs.tolist(), np.split(occ[order], starts[1:])):
+        if t.checkpoints[v] is None and v not in t.spilled:
+            continue
+        chks = list(_checkpoints(t, v))
+        chks += [np.zeros(0, _checkpoint_dtype(t, len(a)))
+                 for a in arrays[len(chks):]]
+        # (Concatenating structured arrays is slow, so they are copied.)
+        merged = np.empty(len(chks[s]) + len(c), dtype)
+        merged[:len(chks[s])], merged[len(chks[s]):] = chks[s], c
+        chks[s] = merged
+        t.checkpoints[v] = chks
+        if v in t.spilled:
+            respill.add(v)
+
+def _find_children(t, ps, xs):
+    '''
+    Returns the IDs of the children of the given nodes that are associated with
+    the given symbols, creating any that do not yet exist.
+    '''
+    def find():
+        kids = _children_of(t, np.unique(ps))
+        if len(kids) == 0:
+            return np.full(len(queries), -1)
+        keys = t.parent[kids].astype(np.int64)*k + t.index[kids]
+        order = np.argsort(keys)
+        keys, kids = keys[order], kids[order]
+        i = np.minimum(np.searchsorted(keys, queries), len(keys)-1)
+        return np.where(keys[i] == queries, kids[i], -1)
+
+    k = len(t.alphabet)
+    queries = ps.astype(np.int64)*k + xs
+    children = find()
+    if np.any(children < 0):
+        _grow_children(t, ps[children < 0], xs[children < 0])
+        children = find()
+    return children
+
+def _grow_children(t, ps, xs):
+    '''
+    Adds children to nodes that have already been expanded.
+
+    Since the children of a node must be contiguous, each node's block of
+    children is moved to the end of the tree (along with its new children). The
+    nodes that were moved leave behind empty, unreachable entries, which are
+    reclaimed by `_compact`.
+    '''
+    k = len(t.alphabet)
+    keys = np.unique(ps.astype(np.int64)*k + xs)
+    parents, starts = np.unique(keys // k, return_index=True)
+    for p, new_xs in zip(parents.tolist(), np.split(keys % k, starts[1:])):
+        f, n = t.first_child[p], t.child_count[p]
+        old, xs = np.arange(f, f+n), np.union1d(t.index[f:f+n], new_xs)
+        s, m = t.size, len(xs)
+        _reserve(t, m)
+        moved = s + np.searchsorted(xs, t.index[old])
+        for name, _ in t._fields:
+            getattr(t, name)[moved] = getattr(t, name)[old]
+        new = s + np.searchsorted(xs, new_xs)
+        t.index[new] = new_xs
+        t.parent[new] = p
+        t.depth[new] = t.depth[p] + 1
+        t.first_child[new] = -1
+        t.count_start[new] = -1
+        t.sampled_since[new] = t.sample_clock
+        grandchildren = _children_of(t, moved)
+        t.parent[grandchildren] = np.repeat(moved, t.child_count[moved])
+        t.checkpoints.extend([None] * m)
+        for v in new.tolist():
+            t.checkpoints[v] = (None if t.suffix is not None else
+                                [np.zeros(0, _checkpoint_dtype(t, len(a)))
+                                 for a in t.arrays])
+        for u, v in zip(old.tolist(), moved.tolist()):
+            t.checkpoints[v], t.checkpoints[u] = t.checkpoints[u], None
+            if u in t.spilled:
+                t.spilled[v] = t.spilled.pop(u)
+        for index in (t.leaves, t.attachments):
+            flagged = index.flags[old]
+            index.update(old[flagged], False)
+            index.update(moved[flagged], True)
+        t.first_child[old] = -1
+        t.child_count[old] = 0
+        t.count_start[old] = -1
+        t.count_size[old] = 0
+        for name in ('is_active', 'node_count', 'leaf_count',
+                     'attachment_count', 'sample_count', 'residual_total'):
+            getattr(t, name)[old] = 0
+        t.first_child[p], t.child_count[p] = s, m
+        t.size = s + m
+
+def _compact(t):
+    '''
+    Packs the nodes and count entries of a tree that are in use into the fronts
+    of its arrays, once the unused ones outnumber them.
+
+    Nodes are unused if they are unreachable (having been left behind by
+    `_grow_children`) or, unless the tree is dense, if neither they nor any of
+    their descendants are active, valid attachments, or have counts (as is the
+    case for nodes whose states no longer occur once data has been retired).
+    Entries are unused if they lie outside every node's counts. The nodes that
+    remain keep their order, so the children of each node are still contiguous
+    and ordered by symbol, but every node other than the root may be given a
+    new ID.
+    '''
+    n = t.size
+    ids = np.arange(n)
+    ps = np.maximum(t.parent[:n], 0)
+    f = t.first_child[ps]
+    used = (f <= ids) & (ids < f + t.child_count[ps])
+    if not t.dense:
+        used &= ((t.count_start[:n] >= 0) | t.is_active[:n] |
+                 (t.attachment_count[:n] > 0))
+        # The parents of the nodes that are used are used as well.
+        for d in range(int(np.max(t.depth[:n])), 0, -1):
+            used[t.parent[ids[used & (t.depth[:n] == d)]]] = True
+    used[0] = True
+    m, k = int(np.count_nonzero(used)), int(np.sum(t.count_size[:n]))
+    if n - m <= m and t.pool_size - k <= k:
+        return
+    old, new = ids[used], np.full(n, -1, np.int64)
+    new[old] = np.arange(m)
+    capacity = 2*m
+    for name, dtype in t._fields:
+        array = np.zeros(capacity, dtype)
+        array[:m] = getattr(t, name)[old]
+        setattr(t, name, array)
+    # The blocks of children are found again from the children's new parents
+    # (nodes that have been expanded but have no children left are given an
+    # empty block).
+    t.parent[1:m] = new[t.parent[1:m]]
+    t.first_child[:m] = np.where(t.first_child[:m] >= 0, m, -1)
+    t.child_count[:m] = 0
+    owners, starts, sizes = np.unique(t.parent[1:m], return_index=True,
+                                      return_counts=True)
+    t.first_child[owners] = 1 + starts
+    t.child_count[owners] = sizes
+    t.checkpoints = [t.checkpoints[v] for v in old.tolist()]
+    t.spilled = {int(new[v]): entries for v, entries in t.spilled.items()
+                 if new[v] >= 0}
+    for name in ('leaves', 'attachments'):
+        members = new[np.flatnonzero(getattr(t, name).flags[:n])]
+        index = IndexedSet(capacity)
+        index.update(members[members >= 0], True)
+        setattr(t, name, index)
+    vs = np.flatnonzero(t.count_start[:m] >= 0)
+    entries = _count_entries(t, vs)[0]
+    for name, dtype in (('symbols', np.int32), ('counts', np.float64),
+                        ('residual', np.float64)):
+        array = np.zeros(max(2*k, 1), dtype)
+        array[:k] = getattr(t, name)[entries]
+        setattr(t, name, array)
+    sizes = t.count_size[vs].astype(np.int64)
+    t.count_start[vs] = np.cumsum(sizes) - sizes
+    t.size, t.pool_size = m, k
+
+def _suffix_ranges(t):
+    # Recomputes the ranges of the suffix index that hold the occurrences of
+    # each node's state, level by level.
+    t.lo[0], t.hi[0] = 0, len(t.suffix.order)
+    level = np.zeros(1, np.int32)
+    while len(level) > 0:
+        level = _children_of(t, level)
+        for v in level.tolist():
+            p = t.parent[v]
+            t.lo[v], t.hi[v] = t.suffix.find(t.lo[p], t.hi[p], t.depth[p],
+                                             t.index[v])
+
+def _add_new_attachments(t, vs, full=False):
+    # Marks those of the given nodes that have become valid attachments (by
+    # gaining counts or, for full trees, valid children of their own) as such.
+    parents = t.parent[vs]
+    vs = vs[~t.is_active[vs] & (t.attachment_count[vs] == 0) &
+            ((parents < 0) | t.is_active[parents])]
+    for v in vs.tolist():
+        if full and t.parent[v] >= 0:
+            if t.first_child[v] < 0:
+                _expand(t, v, 1)
+            f = t.first_child[v]
+            valid = np.any(t.count_start[f:f+t.child_count[v]] >= 0)
+        else:
+            valid = t.count_start[v] >= 0
+        if valid:
+            _update_counts(t, v, attachments=1)
+            t.attachments.add(v)
+
+def retire(root, n, full=False):
+    '''
+    Removes the oldest observations from the (network) data set from which a
+    tree was built.
+
+    The first `n` entries of the first sequence are discarded, along with every
+    occurrence of a state that includes one of them, so that the counts and
+    checkpoints of the tree's nodes are those that the remaining data would
+    give them. Since the occurrences are found using the nodes' checkpoints,
+    only trees that keep them (that were created without the `release` option)
+    are supported. Active nodes and sample counts are left as they are, except
+    that active nodes that would no longer be valid attachments (whose states,
+    or for full trees all of whose children's states, no longer occur) are
+    deactivated along with their descendants, and inactive nodes that are no
+    longer valid attachments are unmarked. Once the nodes whose states no
+    longer occur outnumber the rest, the tree is compacted (see `_compact`),
+    and the IDs of the nodes other than the root are no longer valid.
+
+    Args:
+        root: the root of the tree.
+        n: the number of entries to remove.
+        full: whether or not the active nodes are interpreted as a full tree,
+            which determines the nodes that count as attachments.
+    '''
+    t = root.tree
+    if t.kind != 'network':
+        raise ValueError('Only network data can be retired.')
+    elif t.release:
+        raise ValueError('Data cannot be retired from trees whose checkpoints '
+                         'are released.')
+    n = min(n, len(t.arrays[0])) if t.arrays else 0
+    if n == 0:
+        return
+    # Each occurrence (checkpoint) that would next be extended by a retired
+    # entry stays with its node, but its extensions, which are counted by the
+    # node's children, no longer occur. The occurrences of the root are the
+    # entries themselves. The checkpoints of every node (for the first
+    # sequence) are handled at once, as a single array.
+    array = t.arrays[0]
+    vs = [v for v in np.flatnonzero(t.count_start[:t.size] >= 0).tolist()
+          if t.checkpoints[v] is not None]
+    dtype = _checkpoint_dtype(t, len(array))
+    sizes = [len(t.checkpoints[v][0]) for v in vs]
+    slots = np.repeat(np.arange(len(vs)), sizes)
+    chks, ends = np.empty(len(slots), dtype), np.cumsum(sizes).tolist()
+    for v, a, b in zip(vs, [0] + ends, ends):
+        chks[a:b] = t.checkpoints[v][0]
+    old = chks['k'] < n
+    lost, owners = chks[old], np.array(vs, np.int64)[slots[old]]
+    expanded = t.first_child[owners] >= 0
+    children = _find_children(t, owners[expanded],
+                              array[lost['k'][expanded], 0])
+    nodes = [owners[owners == 0], children]
+    symbols = [lost['j'][owners == 0], lost['j'][expanded]]
+    weights = [lost['c'][owners == 0], lost['c'][expanded]]
+    kept = chks[~old]
+    kept['k'] -= n
+    sizes = np.bincount(slots[~old], minlength=len(vs))
+    ends = np.cumsum(sizes)
+    for v, a, b in zip(vs, (ends - sizes).tolist(), ends.tolist()):
+        t.checkpoints[v] = [kept[a:b]] + t.checkpoints[v][1:]
+    t.arrays[0] = array[n:]
+    t.dest_index = [] # (the keys depend on the sequences' lengths.)
+    touched = _subtract_counts(t, np.concatenate(nodes),
+                               np.concatenate(symbols),
+                               np.concatenate(weights))
+    # Active nodes that would no longer be valid attachments are deactivated
+    # from the bottom up, after which the residuals and attachments of the
+    # affected nodes are brought up to date.
+    parents = t.parent[touched]
+    affected = np.unique(np.concatenate((touched, parents[parents >= 0])))
+    gone = [v for v in affected[t.is_active[affected]].tolist()
+            if (full or v != 0) and not _valid_attachment(t, v, full)]
+    vs = np.unique(np.concatenate([_subtree(t, v) for v in gone] +
+                                  [affected[:0]]))
+    vs = vs[t.is_active[vs]]
+    for v in vs[np.argsort(-t.depth[vs], kind='stable')].tolist():
+        deactivate(Node(t, v))
+    affected = np.union1d(affected, vs)
+    for v in affected[t.is_active[affected]].tolist():
+        _reset_residual(t, v)
+    _remove_lost_attachments(t, affected, full)
+    _compact(t)
+
+def _subtract_counts(t, nodes, symbols, weights):
+    '''
+    Removes (weighted) symbol occurrences from the counts of a set of nodes,
+    discarding the counts that reach zero, and clearing the counts of nodes that
+    are left with none at all. The nodes' residual counts are reset to their
+    counts.
+
+    Since no symbols are added, the counts that remain are written back in
+    place, at the front of each node's entries.
+
+    Returns:
+        The IDs of the nodes whose counts were changed.
+    '''
+    vs = np.unique(nodes)
+    vs = vs[t.count_start[vs] >= 0]
+    entries, owners = _count_entries(t, vs)
+    if len(entries) == 0:
+        return vs
+    k = len(t.alphabet)
+    keys = vs[owners].astype(np.int64)*k + t.symbols[entries]
+    queries = nodes.astype(np.int64)*k + symbols
+    i = np.minimum(np.searchsorted(keys, queries), len(keys)-1)
+    found = keys[i] == queries
+    totals = t.counts[entries] - np.bincount(i[found], weights[found],
+                                             len(entries))
+    keep = totals > 0
+    sizes = np.bincount(owners[keep], minlength=len(vs))
+    # Each node's remaining entries are shifted down over the discarded ones.
+    owners, starts = owners[keep], np.cumsum(sizes) - sizes
+    kept = t.count_start[vs][owners] + np.arange(len(owners)) - starts[owners]
+    t.symbols[kept] = t.symbols[entries[keep]]
+    t.counts[kept] = t.residual[kept] = totals[keep]
+    t.count_size[vs] = sizes
+    t.residual_total[vs] = np.bincount(owners, totals[keep], len(vs))
+    _clear_counts(t, vs[sizes == 0])
+    return vs
+
+def _valid_attachment(t, v, full=False):
+    # Whether a node's state occurs and, for (non-root) nodes of full trees,
+    # whether the state of one of its children does as well.
+    if t.count_start[v] < 0:
+        return False
+    elif full and t.parent[v] >= 0:
+        f = t.first_child[v]
+        return bool(np.any(t.count_start[f:f+t.child_count[v]] >= 0))
+    return True
+
+def _remove_lost_attachments(t, vs, full=False):
+    # Unmarks those of the given nodes that are no longer valid attachments
+    # (having lost their counts or, for full trees, their valid children).
+    vs = vs[~t.is_active[vs] & (t.attachment_count[vs] > 0)]
+    for v in vs.tolist():
+        if not _valid_attachment(t, v, full):
+            _update_counts(t, v, attachments=-1)
+            t.attachments.remove(v)
+
+def _tree_state(t):
+    '''
+    Returns the state of a tree as a dictionary of flat arrays, from which it
+    can be restored (given the same data) by `_restore_tree`.
+
+    Node IDs are preserved, along with the checkpoints of nodes that have not
+    yet been expanded (which are concatenated into a single array). The leaf
+    and attachment indices are not stored, since they follow from the nodes'
+    fields.
+    '''
+    state = {'node_' + name: getattr(t, name)[:t.size] for name, _ in t._fields}
+    for name in ('symbols', 'counts', 'residual'):
+        state[name] = getattr(t, name)[:t.pool_size]
+    state['kind'] = np.array(t.kind)
+    state['dense'] = np.array(t.dense)
+    state['suffix'] = np.array(t.suffix is not None)
+    state['release'] = np.array(bool(t.release))
+    state['spill_file'] = np.array(t.release if isinstance(t.release, str)
+                                   else '')
+    state['sample_clock'] = np.array(t.sample_clock)
+    dtype = _checkpoint_dtype(t, max([len(a) for a in t.arrays] + [0]))
+    nodes = [v for v in range(t.size) if t.checkpoints[v] is not None]
+    chks = [c for v in nodes for c in t.checkpoints[v]]
+    state['chk_nodes'] = np.array(nodes, np.int64)
+    state['chk_sizes'] = np.array([len(c) for c in chks], np.int64)
+    state['chk_data'] = np.concatenate([c.astype(dtype) for c in chks] +
+                                       [np.zeros(0, dtype)])
+    state['spilled'] = np.array([(v, s, offset, n)
+                                 for v, entries in t.spilled.items()
+                                 for s, (offset, n, _) in enumerate(entries)],
+                                np.int64).reshape(-1, 4)
+    return state
+
+def _restore_tree(state, data, alphabet, suffix=None):
+    '''
+    Rebuilds a tree from the state returned by `_tree_state`, given the data
+    set from which it was originally created (or its `CountIndex`), and
+    optionally an existing suffix index over it.
+    '''
+    if isinstance(data, CountIndex):
+        data = data.data
+    kind, size = str(state['kind']), len(state['node_index'])
+    if not state['suffix']:
+        suffix = None
+    elif suffix is None:
+        suffix = SuffixIndex(data)
+    t = Tree(alphabet, max(size, 1), suffix, bool(state['dense']))
+    t.kind, t.size = kind, size
+    for name, dtype in t._fields:
+        getattr(t, name)[:size] = state['node_' + name]
+    t.pool_size = len(state['counts'])
+    for name, dtype in (('symbols', np.int32), ('counts', np.float64),
+                        ('residual', np.float64)):
+        array = np.zeros(max(t.pool_size, 1), dtype)
+        array[:t.pool_size] = state[name]
+        setattr(t, name, array)
+    t.release = str(state['spill_file']) or bool(state['release'])
+    t.sample_clock = int(state['sample_clock'])
+    if suffix is None:
+        t.arrays = _arrays(data, kind)
+    # Each node's checkpoints hold one array per sequence.
+    t.checkpoints = [None] * size
+    m, sizes = len(t.arrays), state['chk_sizes'].tolist()
+    ends = np.cumsum([0] + sizes).tolist()
+    for i, v in enumerate(state['chk_nodes'].tolist()):
+        t.checkpoints[v] = [
+            state['chk_data'][ends[i*m+s]:ends[i*m+s+1]].astype(
+                _checkpoint_dtype(t, len(t.arrays[s]))) for s in range(m)]
+    for v, s, offset, n in state['spilled'].tolist():
+        dtype = _checkpoint_dtype(t, len(t.arrays[s]))
+        t.spilled.setdefault(v, []).append((offset, n, dtype))
+    ids = np.arange(size)
+    t.leaves.update(ids[t.is_active[:size] & (t.node_count[:size] == 1)],
+                    True)
+    t.attachments.update(ids[~t.is_active[:size] &
+                             (t.attachment_count[:size] == 1)], True)
+    return Node(t, 0)
+
+def _checkpoint_dtype(t, n):
+    # The type of the checkpoints of a sequence of length `n`.
+    return _network_dtype(n) if t.kind == 'network' else _index_dtype(n)
 
 def update_counts(v, nodes=0, leaves=0, attachments=0):
     '''
     Increases or decreases counts along the path from a node to the root.
     '''
-    v.node_count += nodes
-    v.leaf_count += leaves
-    v.attachment_count += attachments
-    if v.parent is not None:
-        update_counts(v.parent, nodes, leaves, attachments)
+    _update_counts(v.tree, v.id, nodes, leaves, attachments)
+
+def _update_counts(t, v, nodes=0, leaves=0, attachments=0):
+    while v >= 0:
+        t.node_count[v] += nodes
+        if leaves != 0:
+            t.leaf_count[v] += leaves
+        if attachments != 0:
+            t.attachment_count[v] += attachments
+        v = t.parent[v]
 
 def update_sample_counts(v, samples, opts):
     '''
@@ -224,59 +1615,188 @@ def update_sample_counts(v, samples, opts):
         v: the root of the subtree to be updated.
         samples: the amount that should be added to each sample count.
     '''
-    if opts.full and v.parent is not None and not v.parent.is_active:
-        return
-    elif not opts.full and not v.is_active:
-        return
+    t = v.tree
+    ids = _subtree(t, v.id)
+    t.sample_count[ids[_sampled(t, ids, opts)]] += samples
+
+def start_samples(v, opts):
+    '''
+    Begins recording samples of a tree lazily.
+
+    Until `stop_samples` is called, each call to `add_sample` has the same
+    effect as a call to `update_sample_counts` with the root of the tree and a
+    single sample, but takes constant time: the nodes whose sample counts would
+    change are instead brought up to date whenever they are activated or
+    deactivated (or their neighbours are), and when recording stops.
+    '''
+    t = v.tree
+    t.sampling = opts
+    t.sample_clock = 0
+    t.sampled_since[:t.size] = 0
+
+def add_sample(v):
+    '''
+    Records a single sample of the tree containing `v` (see `start_samples`).
+    '''
+    v.tree.sample_clock += 1
+
+def stop_samples(v):
+    '''
+    Adds all outstanding samples to the sample counts of a tree, and stops
+    recording samples lazily.
+    '''
+    t = v.tree
+    _flush_samples(t, np.arange(t.size))
+    t.sampling = None
+
+def _sample_record(t):
+    '''
+    Returns the IDs, parents, symbol indices and sample counts of the nodes of a
+    tree that have non-zero sample counts, together with their ancestors, in
+    order of node ID.
+    '''
+    needed = t.sample_count[:t.size] != 0
+    level = np.flatnonzero(needed)
+    while len(level) > 0:
+        level = t.parent[level]
+        level = level[level >= 0]
+        level = level[~needed[level]]
+        needed[level] = True
+    ids = np.flatnonzero(needed)
+    return ids, t.parent[ids], t.index[ids], t.sample_count[ids]
+
+def _merge_samples(t, base, ids, parents, symbols, samples):
+    '''
+    Adds the sample counts recorded by a copy of a tree (see `_sample_record`)
+    to the tree itself.
 
-    # A node is a fringe node if it is a leaf or if any of its valid children
-    # are inactive.
-    on_fringe = (not v.is_active) if opts.full else (v.node_count == 1)
-    for w in v.children:
-        if w.counts is not None:
-            update_sample_counts(w, samples, opts)
-            if not opts.full and not w.is_active:
-                on_fringe = True
-    if not opts.fringe or on_fringe:
-        v.sample_count += samples
+    The copy must have been made when the tree contained `base` nodes. Nodes
+    that the copy created later are matched by their paths, and are created in
+    the tree itself where necessary. This relies on every node having a larger
+    ID than its parent.
+    '''
+    size = max(base, int(ids[-1])+1) if len(ids) > 0 else base
+    mapping = np.full(size, -1, np.int64)
+    mapping[:base] = np.arange(base)
+    for i in np.flatnonzero(ids >= base).tolist():
+        p = mapping[parents[i]]
+        if t.first_child[p] < 0:
+            _expand(t, p, 1)
+        mapping[ids[i]] = _child(t, p, symbols[i])
+    t.sample_count[mapping[ids]] += samples
+
+def _current_sample_counts(t, ids):
+    '''
+    Returns the sample counts of the given nodes, including any samples that
+    have been recorded but not yet added to them (see `start_samples`).
+    '''
+    counts = t.sample_count[ids]
+    if t.sampling is not None:
+        elapsed = t.sample_clock - t.sampled_since[ids]
+        counts = counts + np.where(_sampled(t, ids, t.sampling), elapsed, 0)
+    return counts
+
+def _flush_samples(t, ids):
+    # Brings the sample counts of a set of nodes up to date, before their
+    # states change.
+    sampled = ids[_sampled(t, ids, t.sampling)]
+    t.sample_count[sampled] += t.sample_clock - t.sampled_since[sampled]
+    t.sampled_since[ids] = t.sample_clock
+
+def _sampled(t, ids, opts):
+    '''
+    Returns a mask of the given nodes whose sample counts are increased when
+    the tree is sampled.
+    '''
+    has_counts = t.count_start[ids] >= 0
+    parents = t.parent[ids]
+    if opts.full:
+        # Nodes are visited if their parents are active (or if they are roots);
+        # a node is a fringe node if it is inactive itself.
+        visited = has_counts & ((parents < 0) | t.is_active[parents])
+        on_fringe = ~t.is_active[ids]
+    else:
+        # Only active nodes are visited. A node is a fringe node if it is a leaf
+        # or if any of its valid children are inactive.
+        visited = t.is_active[ids]
+        on_fringe = t.node_count[ids] == 1
+        if opts.fringe:
+            kids = _children_of(t, ids)
+            owners = np.repeat(np.arange(len(ids)), t.child_count[ids])
+            invalid = (t.count_start[kids] >= 0) & ~t.is_active[kids]
+            on_fringe[owners[invalid]] = True
+    if opts.fringe:
+        visited &= on_fringe
+    return visited
 
 def path_to(v):
     '''
     Returns the path from the root to a given node as a list of symbols/indices.
     '''
-    if v.parent is None:
-        return []
-    path = path_to(v.parent)
-    path.append(v.index)
+    t, v = v.tree, v.id
+    path = [0] * int(t.depth[v])
+    for i in range(len(path)-1, -1, -1):
+        path[i] = int(t.index[v])
+        v = t.parent[v]
     return path
 
-def _root(v):
-    root = v
-    while root.parent is not None:
-        root = root.parent
-    return root
-
 def leaf(v, l):
     '''
     Returns leaf `l` of a given subtree, indexed in depth-first order.
     '''
-    if v.node_count == 1:
-        return v
-    for w in v.children:
-        if l < w.leaf_count:
-            return leaf(w, l)
-        l -= w.leaf_count
+    return Node(v.tree, _select(v.tree, v.id, l, v.tree.leaf_count, 1))
 
 def attachment(v, a):
     '''
     Returns attachment `a` of a given subtree, indexed in depth-first order.
     '''
-    if v.node_count == 0:
-        return v
-    for w in v.children:
-        if a < w.attachment_count:
-            return attachment(w, a)
-        a -= w.attachment_count
+    return Node(v.tree, _select(v.tree, v.id, a, v.tree.attachment_count, 0))
+
+def nth_leaf(v, l):
+    '''
+    Returns leaf `l` of the tree containing `v`, indexed in order of node ID.
+
+    Unlike `leaf`, this function takes logarithmic time, regardless of the
+    shape of the tree.
+    '''
+    return Node(v.tree, v.tree.leaves.select(l))
+
+def nth_attachment(v, a):
+    '''
+    Returns attachment `a` of the tree containing `v`, indexed in order of node
+    ID.
+
+    Unlike `attachment`, this function takes logarithmic time, regardless of
+    the shape of the tree.
+    '''
+    return Node(v.tree, v.tree.attachments.select(a))
+
+def add_attachment(v):
+    '''
+    Marks an inactive node as a valid attachment.
+
+    This is only needed for nodes whose counts have been set by hand, since
+    nodes whose states occur in the data are marked when their parents are
+    activated.
+
+    Args:
+        v: an inactive node with an active parent, which is not already a
+            valid attachment.
+    '''
+    _update_counts(v.tree, v.id, attachments=1)
+    v.tree.attachments.add(v.id)
+
+def _select(t, v, k, counts, node_count):
+    # Descends from `v` until reaching a node with the given node count, at each
+    # level choosing the child whose (cumulative) count covers `k`.
+    while t.node_count[v] != node_count:
+        f = t.first_child[v]
+        for c, x in enumerate(counts[f:f+t.child_count[v]].tolist()):
+            if k < x:
+                break
+            k -= x
+        v = f + c
+    return int(v)
 
 def activate(v, data, alphabet, opts):
     '''
@@ -293,40 +1813,48 @@ def activate(v, data, alphabet, opts):
         data: a list of integer indices, or an iterable set of such lists.
         alphabet: the set of characters that appear in the original data set.
     '''
-    v.is_active = True
-    v.node_count = 1
-    v.leaf_count = 1
-    v.attachment_count = 0
+    t, v = v.tree, v.id
+    if t.sampling is not None:
+        _flush_neighbours(t, v)
+    if t.attachment_count[v] > 0:
+        t.attachments.remove(v)
+    t.is_active[v] = True
+    t.node_count[v] = 1
+    t.leaf_count[v] = 1
+    t.attachment_count[v] = 0
+    t.leaves.add(v)
     if not opts.full:
-        if not v.children:
-            _add_children(v, 1, opts.height_step, alphabet)
-            _initialise_counts(v, data, alphabet, opts.kind)
-        for w in v.children:
-            if w.counts is not None:
-                w.attachment_count = 1
-                v.attachment_count += 1
+        if t.first_child[v] < 0:
+            _expand(t, v, opts.height_step)
+        f, n = t.first_child[v], t.child_count[v]
+        ws = f + np.flatnonzero(t.count_start[f:f+n] >= 0)
+        t.attachment_count[ws] = 1
+        t.attachment_count[v] += len(ws)
+        t.attachments.update(ws, True)
     else:
         # In the full case, a child node is a valid attachment if it has valid
         # children (with non-zero occurrence counts) of its own. If these
-        # depth-two descendants have not yet been created, we know that v has
-        # never been activated, and we can safely reinitialise its children
-        # without affecting any sample counts.
-        for w in v.children:
-            if w.counts is not None and not w.children:
-                v.children = []
-                _add_children(v, 1, opts.height_step+1, alphabet)
-                _initialise_counts(v, data, alphabet, opts.kind)
-                break
-        for w in v.children:
-            if w.counts is None:
-                continue
-            if any(x.counts is not None for x in w.children):
-                w.attachment_count = 1
-                v.attachment_count += 1
-    if v.parent is not None:
-        leaves = 1 if v.parent.node_count > 1 else 0
-        update_counts(v.parent, nodes=1, leaves=leaves,
-                      attachments=v.attachment_count-1)
+        # depth-two descendants have not yet been created, we grow them from
+        # the children's checkpoints; the children themselves are left as they
+        # are.
+        ws = np.arange(t.first_child[v], t.first_child[v]+t.child_count[v])
+        ws = ws[t.count_start[ws] >= 0]
+        if np.any(t.first_child[ws] < 0):
+            _expand(t, v, opts.height_step+1)
+        for w in ws:
+            f = t.first_child[w]
+            if np.any(t.count_start[f:f+t.child_count[w]] >= 0):
+                t.attachment_count[w] = 1
+                t.attachment_count[v] += 1
+                t.attachments.add(w)
+    u = t.parent[v]
+    if u >= 0:
+        leaves = 1 if t.node_count[u] > 1 else 0
+        if leaves == 0: # (the parent is no longer a leaf.)
+            t.leaves.remove(u)
+        _update_counts(t, u, nodes=1, leaves=leaves,
+                       attachments=t.attachment_count[v]-1)
+        _adjust_residual(t, u, v, -1)
 
 def deactivate(v):
     '''
@@ -336,14 +1864,62 @@ def deactivate(v):
         v: the node to be deactivated: `v` must be an active leaf (all of its
             children should be inactive).
     '''
-    v.is_active = False
-    v.node_count = 0
-    v.leaf_count = 0
-    if v.parent is not None:
-        leaves = -1 if v.parent.node_count > 2 else 0
-        update_counts(v.parent, nodes=-1, leaves=leaves,
-                      attachments=1-v.attachment_count)
-    if v.attachment_count > 0:
-        for w in v.children:
-            w.attachment_count = 0
-    v.attachment_count = 1
\ No newline at end of file
+    t, v = v.tree, v.id
+    if t.sampling is not None:
+        _flush_neighbours(t, v)
+    t.is_active[v] = False
+    t.node_count[v] = 0
+    t.leaf_count[v] = 0
+    t.leaves.remove(v)
+    u = t.parent[v]
+    if u >= 0:
+        leaves = -1 if t.node_count[u] > 2 else 0
+        if leaves == 0: # (the parent is now a leaf.)
+            t.leaves.add(u)
+        _update_counts(t, u, nodes=-1, leaves=leaves,
+                       attachments=1-t.attachment_count[v])
+        _adjust_residual(t, u, v, 1)
+    if t.attachment_count[v] > 0:
+        f = t.first_child[v]
+        ws = f + np.flatnonzero(t.attachment_count[f:f+t.child_count[v]])
+        t.attachments.update(ws, False)
+        t.attachment_count[ws] = 0
+    t.attachment_count[v] = 1
+    t.attachments.add(v)
+
+def _flush_neighbours(t, v):
+    # Brings the sample counts of the neighbours of node `v` up to date before
+    # its state changes. A node's few neighbours are handled one by one (with
+    # the test of `_sampled` for a single node), which is much cheaper than
+    # building arrays of them.
+    opts = t.sampling
+    f, n = t.first_child[v], t.child_count[v] if opts.full else 0
+    if opts.fringe or n > _few_neighbours:
+        _flush_samples(t, _neighbours(t, v))
+        return
+    clock, u = t.sample_clock, int(t.parent[v])
+    ids = [v] if u < 0 else [v, u]
+    if n > 0:
+        ids.extend(range(f, f+n))
+    for w in ids:
+        if opts.full:
+            # (Nodes are visited if they have counts and their parents are
+            # active, or if they are roots.)
+            p = t.parent[w]
+            sampled = t.count_start[w] >= 0 and (p < 0 or t.is_active[p])
+        else:
+            sampled = t.is_active[w]
+        if sampled:
+            t.sample_count[w] += clock - t.sampled_since[w]
+        t.sampled_since[w] = clock
+
+_few_neighbours = 16 # the most children that are flushed one by one.
+
+def _neighbours(t, v):
+    # The nodes whose sampling status can depend on the state of node `v`: the
+    # node itself, its parent and (for full trees) its children.
+    ids = [v] if t.parent[v] < 0 else [v, t.parent[v]]
+    if t.sampling.full:
+        f = t.first_child[v]
+        ids = np.concatenate((ids, np.arange(f, f+t.child_count[v])))
+    return np.asarray(ids)
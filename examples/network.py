@@ -3,17 +3,20 @@ import bvmm
 import pickle
 
 #%%
-def read_data(filename, sep='-', max_length=None):
+def read_data(filename, sep='-', max_length=None, times=False):
     with open(filename, 'r') as f:
-        data = []
+        data, stamps = [], []
         for l in f:
-            v, w = l.split()[:2]
+            v, w, *rest = l.split()
             data.append((sep+v, sep+w))
+            stamps.append(float(rest[0]) if rest else len(stamps))
     if max_length is not None:
-        data = data[:max_length]
+        data, stamps = data[:max_length], stamps[:max_length]
     data, alphabet = bvmm.create_index(data, kind='network')
     print('Sequence characters:', len(data))
     print('Distinct characters:', len(alphabet))
+    if times:
+        return data, alphabet, stamps
     return data, alphabet
 
 def save_tree(root, filename):
@@ -47,6 +50,22 @@ save_tree(mcmc, f'out/network_eu{k}.pickle')
 filename = f'out/network_eu{k}.net'
 bvmm.write_tree(mcmc, alphabet, filename, min_samples=0.1)
 
+#%% Friends (rolling two-week window)
+%%time
+data, alphabet, times = read_data('dat/network_friends.txt', sep='_',
+                                  times=True)
+window = bvmm.NetworkWindow(alphabet, span=14*24*60*60)
+day = 24*60*60
+start = 0
+while start < len(data):
+    end = start
+    while end < len(data) and times[end] < times[start] + day:
+        end += 1
+    window.update(data[start:end], times[start:end])
+    mcmc, counts = bvmm.mcmc(window, alphabet, 10_000, 10, kind='network')
+    start = end
+bvmm.print_tree(mcmc, alphabet, min_samples=0.1, max_counts=3)
+
 #%% Radoslaw
 %%time
 data, alphabet = read_data('dat/network_radoslaw.txt')
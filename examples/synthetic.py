@@ -26,7 +26,7 @@ alphabet = ['0', '1']
 
 #%%
 opts = bvmm.tree.Options()
-root = bvmm.tree.create_tree(2, [], alphabet)
+root = bvmm.tree.create_tree(2, [], alphabet, dense=True)
 for v in [root, root.children[0], root.children[1],
           root.children[1].children[0], root.children[1].children[1]]:
     v.counts = np.zeros(2)
@@ -101,8 +101,9 @@ bvmm.write_tree(mcmc, alphabet, 'dat/synthetic_3_{}.net'.format(n),
 # %%
 def activate_same(v1, v2):
     print(''.join(str(x) for x in bvmm.path_to(v1)), ''.join(str(x) for x in bvmm.path_to(v2)))
-    for w1, w2 in zip(v1.children, v2.children):
-        if w1.is_active:
+    for w1 in v1.children:
+        w2 = v2.child(w1.index)
+        if w1.is_active and w2 is not None:
             bvmm.tree.activate(w2, data, alphabet, bvmm.tree.Options())
             activate_same(w1, w2)
     
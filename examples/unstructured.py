@@ -26,7 +26,7 @@ for n in (10, 100, 1000, 2000, 5000, 10_000):
 df = pd.DataFrame(columns=['x', 'p', 'n', 'i'])
 for n, trees in ps.items():
     for i, (r, c) in enumerate(trees):
-        data = zip(alphabet, [w.sample_count for w in r.children])
+        data = [(alphabet[w.index], w.sample_count) for w in r.children]
         ndf = pd.DataFrame(data, columns=['x', 'p'])
         ndf['n'], ndf['i'] = n, i
         df = pd.concat((df, ndf), sort=False)